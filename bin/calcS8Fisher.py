@@ -26,12 +26,12 @@ pzcutoff = Config.getfloat('general','photoZCutOff')
 
 bigDataDir = Config.get('general','bigDataDirectory')
 saveId = sfisher.save_id(expName,gridName,calName,version)
-derivRoot = sfisher.deriv_root(bigDataDir,saveId)
+derivRoot = sfisher.deriv_sources(bigDataDir,saveId)
 
 fsky = Config.getfloat(expName,'fsky')
 
-NFid_mzq = np.load(bigDataDir+"N_mzq_"+saveId+"_fid_sigma8.npy")
-NFid_mzq_alt = np.load(bigDataDir+"N_mzq_"+saveId+"_fid.npy")
+NFid_mzq = sfisher.fid_counts(bigDataDir,saveId,"fid_sigma8")
+NFid_mzq_alt = sfisher.fid_counts(bigDataDir,saveId)
 try:
     assert np.all(np.isclose(NFid_mzq,NFid_mzq_alt))
 except:
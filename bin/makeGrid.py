@@ -10,7 +10,9 @@ import numpy as np
 from orphics.lensing import NFWMatchedFilterSN
 from szar.counts import ClusterCosmology,Halo_MF
 from szar.szproperties import SZ_Cluster_Model
+from szar import taskfarm
 import szar.fisher as sfisher
+import os
 comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 numcores = comm.Get_size()    
@@ -31,7 +33,7 @@ if rank == 0:
     import argparse
 
     parser = argparse.ArgumentParser(description='Make an M,z grid using MPI. Currently implements CMB lensing \
-    matched filter and SZ variance.')
+    matched filter and SZ variance. The SZ variance alone does not need more than one core.')
     parser.add_argument('expName', type=str,help='The name of the experiment in input/pipeline.ini')
     parser.add_argument('gridName', type=str,help='The name of the grid in input/pipeline.ini')
     parser.add_argument('lensName', nargs='?',type=str,help='The name of the CMB lensing calibration in input/pipeline.ini. Not required if using --skip-lensing option.',default="")
@@ -47,6 +49,10 @@ if rank == 0:
     # #parser.add_argument('--skip-ray', dest='skipRay', action='store_const',
     #                     const=True, default=False,
     #                     help='Skip miscentered lensing.')
+    parser.add_argument("--block-size",type=int,help='Number of M,z cells handed to a worker at a time.',default=4)
+    parser.add_argument("--checkpoint-every",type=int,help='Write the partial lensing grid every this many finished blocks.',default=10)
+    parser.add_argument('--restart', action='store_true',help='Ignore a partial lensing grid from an earlier run and start over.')
+    parser.add_argument('--lens-kernel', dest='lensKernel', action='store_true',help='Make the lensing grids from tabulated NFW profiles (szar.lensgrid) on the boss instead of farming out per cell stamps.')
 
     
     args = parser.parse_args()
@@ -57,6 +63,9 @@ if rank == 0:
     lensName = args.lensName
     lkneeTOverride = args.lknee
     alphaTOverride = args.alpha
+    blockSize = args.block_size
+    checkpointEvery = args.checkpoint_every
+    lensKernel = args.lensKernel
 
     suffix = ""
     if lkneeTOverride is not None:
@@ -328,6 +337,7 @@ else:
     doFg = None
     dotsz_cib = None
     v3mode = None
+    lensKernel = None
 
 if rank==0: print("Broadcasting...")
 #doRayDeriv = comm.bcast(doRayDeriv, root = 0)
@@ -338,6 +348,7 @@ rayFid = comm.bcast(rayFid, root = 0)
 rayStep = comm.bcast(rayStep, root = 0)
 doLens = comm.bcast(doLens, root = 0)
 doSZ = comm.bcast(doSZ, root = 0)
+lensKernel = comm.bcast(lensKernel, root = 0)
 #beamY = comm.bcast(beamY, root = 0)
 #miscentering = comm.bcast(miscentering, root = 0)
 mgrid = comm.bcast(mgrid, root = 0)
@@ -363,67 +374,42 @@ if rank==0: print("Broadcasted.")
 
 
 cc = ClusterCosmology(fparams,constDict,clTTFixFile=clttfile)
-if doSZ:
+# The SZ variance grid is a single vectorized call, done by the boss after the lensing loop
+if doSZ and rank==0:
     HMF = Halo_MF(cc,mgrid,zgrid,kh=kh,powerZK=pk)
     SZCluster = SZ_Cluster_Model(cc,clusterDict,rms_noises = noise,fwhms=beam,freqs=freq,lknee=lkneeT,alpha=alphaT,fg=doFg,tsz_cib=dotsz_cib,v3mode=v3mode,fsky=fsky)
 
 numms = mgrid.size
 numzs = zgrid.size
-if doLens:
-    MerrGrid = np.zeros((numms,numzs))
-    if True: #doRayDeriv:
-        MerrGridUp = np.zeros((numms,numzs))
-        MerrGridDn = np.zeros((numms,numzs))
-        
-if doSZ: siggrid = np.zeros((numms,numzs))
 numes = numms*numzs
 
+# stamp size, resolution and largest ell of the lensing matched filter
+arcStamp = 100.
+pxStamp = 0.05
+kmax = 8000
 
-
-indices = np.arange(numes)
-splits = np.array_split(indices,numcores)
-
-if rank==0:
-    lengths = [len(split) for split in splits]
-    mintasks = min(lengths)
-    maxtasks = max(lengths)
-    print("I have ",numcores, " cores to work with.")
-    print("And I have ", numes, " tasks to do.")
-    print("Each worker gets at least ", mintasks, " tasks and at most ", maxtasks, " tasks.")
-    zfrac = float(len(z_edges[np.where(z_edges>pzcut)]))/len(z_edges)
-    #zfrac = old_div(float(len(z_edges[np.where( check_pzcut_less(z_edges, pzcut) )])),len(z_edges))
-    buestguess = (0.5*int(doSZ)+((1.+(2.*zfrac))*5.0*int(doLens)))*maxtasks
-    print("My best guess is that this will take ", buestguess, " seconds.")
-    print("Starting the slow part...")
-
-
-mySplitIndex = rank
-
-mySplit = splits[mySplitIndex]
-
-if doLens: 
+if doLens and not(lensKernel): 
     #import pixell.fft as fftfast
     import enlib.fft as fftfast
-    arcStamp = 100.
-    pxStamp = 0.05
     Npix = int(old_div(arcStamp,pxStamp))
     B = fftfast.fft(np.zeros((Npix,Npix)),axes=[-2,-1],flags=['FFTW_MEASURE'])
 # Ndown = fftfast.fft_len(Npix,direction="below")
 # Nup = fftfast.fft_len(Npix,direction="above")
 # print Npix,Ndown,Nup
 
-for index in mySplit:
-            
-    mindex,zindex = np.unravel_index(index,(numms,numzs))
-    mass = mgrid[mindex]
-    z = zgrid[zindex]
+def lens_cells(indices):
+    # 1/SN of the lensing matched filter, and with the miscentering
+    # sigR stepped up and down, for a block of flat M,z cell indices
+    merr = np.zeros((3,len(indices)))
+    for i,index in enumerate(indices):
+        mindex,zindex = np.unravel_index(index,(numms,numzs))
+        mass = mgrid[mindex]
+        z = zgrid[zindex]
 
-    if doLens:
-        kmax = 8000
         overdensity = 500
         critical = True
         atClusterZ = True
-        concentration = cc.Mdel_to_cdel(mass,z,overdensity) #1.18
+        concentration = cc.Mdel_to_cdel(10.**mass,z,overdensity) #1.18
         # if miscentering:
         #     ray = beamY/2.
         # else:
@@ -434,73 +420,102 @@ for index in mySplit:
             ray = None
         
         snRet,k500,std = NFWMatchedFilterSN(cc,mass,concentration,z,ells=ls,Nls=Nls,kellmax=kmax,overdensity=overdensity,critical=critical,atClusterZ=atClusterZ,saveId=None,rayleighSigmaArcmin=ray,arcStamp=arcStamp,pxStamp=pxStamp)
-        MerrGrid[mindex,zindex] = old_div(1.,snRet)
-        if True: #doRayDeriv:
+        if check_pzcut_less(z, pzcut):
             rayUp = rayFid+old_div(rayStep,2.)
-            if check_pzcut_less(z, pzcut):
-                snRetUp,k500Up,stdUp = NFWMatchedFilterSN(cc,mass,concentration,z,ells=ls,Nls=Nls,kellmax=kmax,overdensity=overdensity,critical=critical,atClusterZ=atClusterZ,saveId=None,rayleighSigmaArcmin=rayUp,arcStamp=arcStamp,pxStamp=pxStamp)
-            else:
-                snRetUp = snRet
-            MerrGridUp[mindex,zindex] = old_div(1.,snRetUp)
+            snRetUp,k500Up,stdUp = NFWMatchedFilterSN(cc,mass,concentration,z,ells=ls,Nls=Nls,kellmax=kmax,overdensity=overdensity,critical=critical,atClusterZ=atClusterZ,saveId=None,rayleighSigmaArcmin=rayUp,arcStamp=arcStamp,pxStamp=pxStamp)
             rayDn = rayFid-old_div(rayStep,2.)
-            if check_pzcut_less(z, pzcut):
-                snRetDn,k500Dn,stdDn = NFWMatchedFilterSN(cc,mass,concentration,z,ells=ls,Nls=Nls,kellmax=kmax,overdensity=overdensity,critical=critical,atClusterZ=atClusterZ,saveId=None,rayleighSigmaArcmin=rayDn,arcStamp=arcStamp,pxStamp=pxStamp)
+            snRetDn,k500Dn,stdDn = NFWMatchedFilterSN(cc,mass,concentration,z,ells=ls,Nls=Nls,kellmax=kmax,overdensity=overdensity,critical=critical,atClusterZ=atClusterZ,saveId=None,rayleighSigmaArcmin=rayDn,arcStamp=arcStamp,pxStamp=pxStamp)
+        else:
+            snRetUp = snRet
+            snRetDn = snRet
+        merr[:,i] = old_div(1.,np.array([snRet,snRetUp,snRetDn]))
+    return merr
+
+tasks = []
+if rank==0 and doLens and lensKernel:
+    # All cells at once from the tabulated profiles, with the stamp's
+    # lowest mode and kmax as the ell range of the matched filter
+    from szar.lensgrid import LensMassKernel
+    print("Calculating lensing grids from the NFW profile kernel...")
+    lmin = 2.*np.pi/(arcStamp*np.pi/180./60.)
+    kernelElls = np.asarray(ls)[(np.asarray(ls)>=lmin) & (np.asarray(ls)<=kmax)]
+    lensMassKernel = LensMassKernel(cc,mgrid,zgrid,kernelElls,overdensity=500.,critical=True,atClusterZ=True)
+    miscentered = np.array([check_pzcut_less(z, pzcut) for z in zgrid],dtype=bool)
+    MerrGrids = lensMassKernel.merr_grids(Nls,ls,rayFid,rayStep,miscentered)
+    done = np.ones((numms,numzs),dtype=bool)
+    partialFile = None
+    on_result = None
+elif rank==0 and doLens:
+    # Cells finished so far are kept in a partial grid file, so that an
+    # interrupted run (e.g. one point of an lknee/alpha sweep) restarts
+    # from there
+    partialFile = bigDataDir+"lensgrid_partial_"+expName+"_"+gridName+"_"+lensName+"_v"+version+suffix+".npz"
+    MerrGrids = np.zeros((3,numms,numzs))
+    done = np.zeros((numms,numzs),dtype=bool)
+    if os.path.exists(partialFile) and not(args.restart):
+        with np.load(partialFile) as data:
+            same = data['MerrGrids'].shape==MerrGrids.shape and np.allclose(data['Mexp_edges'],Mexp_edges) and \
+                   np.allclose(data['z_edges'],z_edges) and data['Nls'].shape==np.shape(Nls) and np.allclose(data['Nls'],Nls) and \
+                   np.allclose(data['ray'],[rayFid,rayStep])
+            if same:
+                MerrGrids = data['MerrGrids'].copy()
+                done = data['done'].copy()
+                print("Resuming from ",partialFile," with ",done.sum()," of ",numes," cells done.")
             else:
-                snRetDn = snRet
-            MerrGridDn[mindex,zindex] = old_div(1.,snRetDn)
-
-        
-    if doSZ:
-        var = SZCluster.quickVar(10**mass,z)
-        siggrid[mindex,zindex] = np.sqrt(var)
+                print("WARNING: ",partialFile," was made with a different grid or lensing noise. Starting over.")
 
+    def save_partial():
+        tmp = partialFile+".tmp"+str(os.getpid())+".npz"
+        np.savez(tmp,MerrGrids=MerrGrids,done=done,Mexp_edges=Mexp_edges,z_edges=z_edges,Nls=Nls,ray=[rayFid,rayStep])
+        os.replace(tmp,partialFile)
 
+    # Miscentered cells run the matched filter three times, so they are
+    # handed out first to keep them from straggling at the end
+    todo = np.where(~done.ravel())[0]
+    zs_todo = zgrid[np.unravel_index(todo,(numms,numzs))[1]]
+    costly = np.array([check_pzcut_less(z, pzcut) for z in zs_todo],dtype=bool)
+    todo = np.append(todo[costly],todo[~costly])
+    tasks = [tuple(todo[i:i+blockSize]) for i in range(0,todo.size,blockSize)]
 
+    print("I have ",numcores, " cores to work with.")
+    print("And I have ", todo.size, " cells left to do in ", len(tasks), " blocks.")
+    zfrac = float(len(z_edges[np.where(z_edges>pzcut)]))/len(z_edges)
+    #zfrac = old_div(float(len(z_edges[np.where( check_pzcut_less(z_edges, pzcut) )])),len(z_edges))
+    buestguess = old_div((1.+(2.*zfrac))*5.0*int(doLens)*todo.size,max(numcores-1,1))
+    print("My best guess is that this will take ", buestguess, " seconds.")
+    print("Starting the slow part...")
 
-if rank!=0:
-    if doLens:
-        MerrGrid = MerrGrid.astype(np.float64)
-        comm.Send(MerrGrid, dest=0, tag=77)
-        if True:#doRayDeriv:
-            MerrGridUp = MerrGridUp.astype(np.float64)
-            MerrGridDn = MerrGridDn.astype(np.float64)
-            comm.Send(MerrGridUp, dest=0, tag=98)
-            comm.Send(MerrGridDn, dest=0, tag=99)
-            
-    if doSZ:
-        siggrid = siggrid.astype(np.float64)
-        comm.Send(siggrid, dest=0, tag=78)
-    
+    nresults = [0]
+    def on_result(indices,merr):
+        mindex,zindex = np.unravel_index(np.array(indices),(numms,numzs))
+        MerrGrids[:,mindex,zindex] = merr
+        done[mindex,zindex] = True
+        nresults[0] += 1
+        if nresults[0] % checkpointEvery == 0: save_partial()
 else:
-    print("Waiting for workers...")
+    on_result = None
+
+if doLens and not(lensKernel):
+    taskfarm.run_tasks(lens_cells,tasks,on_result,pool="mpi",name="cell block")
 
+if rank==0:
     import pickle as pickle
 
     if doLens:
-        for i in range(1,numcores):
-            print("Waiting for lens ", i ," / ", numcores)
-            data = np.zeros(MerrGrid.shape, dtype=np.float64)
-            comm.Recv(data, source=i, tag=77)
-            MerrGrid += data.copy()
-            if True:#doRayDeriv:
-                data = np.zeros(MerrGridUp.shape, dtype=np.float64)
-                comm.Recv(data, source=i, tag=98)
-                MerrGridUp += data.copy()
-                data = np.zeros(MerrGridDn.shape, dtype=np.float64)
-                comm.Recv(data, source=i, tag=99)
-                MerrGridDn += data.copy()
-                
-
+        assert np.all(done)
+        MerrGrid, MerrGridUp, MerrGridDn = MerrGrids
         pickle.dump((Mexp_edges,z_edges,MerrGrid),open(sfisher.mass_grid_name_cmb(bigDataDir,expName,gridName,lensName,version+suffix),'wb'))
         pickle.dump((Mexp_edges,z_edges,MerrGridUp),open(sfisher.mass_grid_name_cmb_up(bigDataDir,expName,gridName,lensName,version+suffix),'wb'))
         pickle.dump((Mexp_edges,z_edges,MerrGridDn),open(sfisher.mass_grid_name_cmb_dn(bigDataDir,expName,gridName,lensName,version+suffix),'wb'))
+        if partialFile is not None and os.path.exists(partialFile): os.remove(partialFile)
         
     if doSZ:
-        for i in range(1,numcores):
-            print("Waiting for sz ", i," / ", numcores)
-            data = np.zeros(siggrid.shape, dtype=np.float64)
-            comm.Recv(data, source=i, tag=78)
-            siggrid += data.copy()
+        print("Calculating SZ variance grid...")
+        # the experiment independent kernel is cached, so only the
+        # contraction with this experiment's noise is redone
+        from szar.varkernel import var_kernel_from_config
+        varKernel = var_kernel_from_config(Config,bigDataDir,gridName,SZCluster,Mexp_edges,z_edges)
+        siggrid = varKernel.sigN(SZCluster.varNoise())
 
 
         pickle.dump((Mexp_edges,z_edges,siggrid),open(bigDataDir+"szgrid_"+expName+"_"+gridName+ "_v" + version+suffix+".pkl",'wb'))
@@ -2,12 +2,15 @@ import matplotlib
 matplotlib.use('Agg')
 import sys
 import numpy as np
-from szar.counts import ClusterCosmology,Halo_MF,sampleVarianceOverNsquareOverBsquare,haloBias,getTotN
+from szar.counts import ClusterCosmology,Halo_MF,haloBias,getTotN
+from szar.samplevariance import cap_mask_weights,mask_weights_from_file,shell_covariance
+from szar.fisher import sample_var_grid_name,sample_var_cov_name,sample_var_bias_name
 #from szar.szproperties import SZ_Cluster_Model
 from orphics.io import Plotter,dict_from_section,list_from_config
 from configparser import SafeConfigParser 
 
 lmax = 1000
+lmax_exact = 30
 
 expName = sys.argv[1]
 gridName = sys.argv[2]
@@ -34,7 +37,6 @@ cc = ClusterCosmology(fparams,constDict,skipCls=True)
 
 fsky = Config.getfloat(expName,'fsky')
 
-saveId = expName + "_" + gridName + "_v" + version
 
 ms = list_from_config(Config,gridName,'mexprange')
 mrange = np.arange(ms[0],ms[1]+ms[2],ms[2])
@@ -44,15 +46,26 @@ zrange = np.arange(zs[0],zs[1]+zs[2],zs[2])
 
 hmf = Halo_MF(cc,mrange,zrange)
 zcents, hb = haloBias(mrange,zrange,cc.rhoc0om,hmf.kh,hmf.pk)
-powers = sampleVarianceOverNsquareOverBsquare(cc,hmf.kh,hmf.pk,zrange,fsky,lmax=lmax)
 
-sovernsquarebsquare = np.outer(powers,np.ones([len(mrange)-1])).transpose()
-
-sovernsquare = hb*hb*sovernsquarebsquare
+# footprint weights from the experiment's healpix mask if it has one
+# (cached next to the grids), else a cap covering fsky
+try:
+    maskFile = Config.get(expName,'mask_file')
+except:
+    maskFile = None
+if maskFile is None:
+    Kl = cap_mask_weights(fsky,lmax)
+else:
+    Kl = mask_weights_from_file(maskFile,lmax,cache_file=bigDataDir+"maskWeights_"+expName+".npy")
 
+# shell to shell covariance of the mean overdensity
+S = shell_covariance(cc,hmf.kh,hmf.pk,zrange,Kl,lmax_exact=lmax_exact)
 
-np.savetxt(bigDataDir+"sampleVarGrid_"+saveId+".txt",sovernsquare)
-
+sovernsquarebsquare = np.outer(np.diagonal(S),np.ones([len(mrange)-1])).transpose()
 
+sovernsquare = hb*hb*sovernsquarebsquare
 
 
+np.savetxt(sample_var_grid_name(bigDataDir,expName,gridName,version),sovernsquare)
+np.savetxt(sample_var_cov_name(bigDataDir,expName,gridName,version),S)
+np.savetxt(sample_var_bias_name(bigDataDir,expName,gridName,version),hb)
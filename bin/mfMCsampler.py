@@ -40,23 +40,23 @@ for (key, val) in Config.items('params'):
 
 mgrid,zgrid,siggrid = pickle.load(open(bigDataDir+"szgrid_"+expName+"_"+gridName+ "_v" + version+".pkl",'rb'))
 
-start = time.clock()
+start = time.time()
 cc = ClusterCosmology(fparams,constDict,clTTFixFile=clttfile)
-elapsed1 = (time.clock() - start)
+elapsed1 = (time.time() - start)
 print(elapsed1)
-start = time.clock()
+start = time.time()
 HMF = Halo_MF(cc,mgrid,zgrid)
-elapsed1 = (time.clock() - start)
+elapsed1 = (time.time() - start)
 print(elapsed1)
 
-start = time.clock()
-samples = HMF.mcsample_mf(200.,200,mthresh=[np.log10(3e14),np.log10(7e15)])
-elapsed1 = (time.clock() - start)
+start = time.time()
+samples = HMF.sample_mf(200.,20000,mthresh=[np.log10(3e14),np.log10(7e15)])
+elapsed1 = (time.time() - start)
 print(elapsed1)
 print(len(samples))
 
 nclust = 100
-ids = np.random.randint(old_div(len(samples),2.),size=nclust)
+ids = np.random.randint(len(samples),size=nclust)
 
 plt.plot(samples[:,0],samples[:,1],'x')
 plt.plot(samples[ids,0],samples[ids,1],'o')
@@ -32,7 +32,7 @@ bigDataDir = Config.get('general','bigDataDirectory')
 version = Config.get('general','version')
 pzcutoff = Config.getfloat('general','photoZCutOff')
 saveId = sfisher.save_id(expName,gridName,calName,version)
-derivRoot = sfisher.deriv_root(bigDataDir,saveId)
+derivRoot = sfisher.deriv_sources(bigDataDir,saveId)
 YWLcorrflag = Config.getfloat('general','ywl_corr_flag')    
 
 # get mass and z grids
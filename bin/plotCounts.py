@@ -9,6 +9,7 @@ import sys
 
 from szar.counts import ClusterCosmology,Halo_MF,getNmzq
 from szar.szproperties import SZ_Cluster_Model
+import szar.fisher as sfisher
 import numpy as np
 
 from orphics.maps import interpolate_grid
@@ -134,7 +135,7 @@ for expName,col in zip(expList,colList):
     #sys.exit()
 
     saveId = expName + "_" + gridName + "_" + cal + "_v" + version
-    Nmzq = np.load(bigDataDir+"N_mzq_"+saveId+"_fid.npy")*fsky
+    Nmzq = sfisher.fid_counts(bigDataDir,saveId)*fsky
     Nmz = Nmzq.sum(axis=-1)
     Nz = Nmzq.sum(axis=0).sum(axis=-1)
     print(Nz.shape)
@@ -16,7 +16,6 @@ from nemo import simsTools
 
 import emcee
 import time, sys, os
-# from emcee.utils import MPIPool
 import argparse
 # Parse command line
 parser = argparse.ArgumentParser(description='Run likelihood.')
@@ -29,9 +28,19 @@ parser.add_argument("-S", "--simpars", action='store_true',help='Do a test quick
 parser.add_argument("-p", "--printtest", action='store_true',help='Do quick print tests of likelihood functions.')
 parser.add_argument("-m", "--mockcat", action='store_true',help='test making a mock catalog.')
 parser.add_argument("-r", "--randcat", action='store_true',help='making a random catalog.')
+parser.add_argument("--pk-cache-dir", type=str,  default=None,help="Directory for the on-disk CAMB power spectrum cache.")
+parser.add_argument("--pool", type=str, default="serial", choices=["serial","process","mpi"],help="How walkers are evaluated: serially, on a local process pool, or on an MPI pool (run under mpirun).")
+parser.add_argument("--nprocs", type=int, default=None,help="Number of processes for --pool process. Defaults to the number of cores.")
+parser.add_argument("--seed", type=int, default=None,help="Seed for the initial walker positions and the sampler, so that chains are reproducible.")
+parser.add_argument("--chain-format", type=str, default="npz", choices=["npz","txt"],help="npz: buffered binary chain directory that can be resumed. txt: the old appended text file.")
+parser.add_argument("--flush-every", type=int, default=10,help="Steps buffered between writes of an npz chain.")
+parser.add_argument("--resume", action='store_true',help='Continue an npz chain from its last flushed state.')
 
 args = parser.parse_args()
 
+from szar import pkcache
+if args.pk_cache_dir is not None: pkcache.set_cache_dir(args.pk_cache_dir)
+
 # index = int(sys.argv[1])
 print("Index ", args.index)
 index = args.index
@@ -171,7 +180,9 @@ if args.mockcat or args.randcat:
     print('sample time',time.time() - start)    
     sys.exit(0)
 
-CL = lk.clusterLike(iniFile,pardict,nemoOutputDir,noise_file,fix_params,fitsfile,test=args.test,simtest=simtst,simpars=args.simpars)
+like_args = (iniFile,pardict,nemoOutputDir,noise_file,fix_params,fitsfile)
+like_kwargs = {'test':args.test,'simtest':simtst,'simpars':args.simpars}
+CL = lk.clusterLike(*like_args,**like_kwargs)
 
 if (args.printtest):
 
@@ -263,15 +274,31 @@ if (args.simpars):
 
 P0 = np.array(parvals)
 
-pos = [P0 + P0*1e-1*np.random.randn(Ndim) for i in range(nwalkers)]
+rng = np.random.RandomState(args.seed)
+pos = [P0 + P0*1e-1*rng.randn(Ndim) for i in range(nwalkers)]
+
+# Walkers are evaluated through lk.pool_lnprob, which uses the clusterLike
+# of whichever process runs it, so nothing holding CAMB state gets pickled.
+pool = None
+lnprob = CL.lnprob
+if args.pool=="process":
+    import multiprocessing, functools
+    pool = multiprocessing.Pool(args.nprocs,initializer=functools.partial(lk.init_pool_like,**like_kwargs),initargs=like_args)
+    lnprob = lk.pool_lnprob
+elif args.pool=="mpi":
+    try:
+        from emcee.utils import MPIPool
+    except ImportError:
+        from schwimmbad import MPIPool
+    lk.set_pool_like(CL)
+    pool = MPIPool()
+    if not pool.is_master():
+        pool.wait()
+        sys.exit(0)
+    lnprob = lk.pool_lnprob
 
 start = time.time()
 
-# pool = MPIPool()
-# if not pool.is_master():
-#     pool.wait()
-#     sys.exit(0)
-
 if args.simtest:
     
     filename = chain_out+"/sz_likelival_"+args.chain_name+".dat"
@@ -293,23 +320,45 @@ else:
     Nruns = args.nruns #int(1e6)
     print(nwalkers,Nruns)
 #nwalkers = 1
-    sampler = emcee.EnsembleSampler(nwalkers,Ndim,CL.lnprob,args =(parlist,priorvals,priorlist))#,pool=pool)
+    sampler = emcee.EnsembleSampler(nwalkers,Ndim,lnprob,args =(parlist,priorvals,priorlist),pool=pool)
+    if args.seed is not None: sampler.random_state = rng.get_state()
 #sampler.run_mcmc(pos,Nruns)
 
+    lnprob0 = None
+    blobs0 = None
+    if args.chain_format=="npz":
+        from szar.chainio import ChainWriter
+        chain_dir = chain_out+"/sz_chain_"+args.chain_name+"_"+str(index)
+        writer = ChainWriter(chain_dir,nwalkers,Ndim,flush_every=args.flush_every,resume=args.resume)
+        state = writer.last_state()
+        if state is not None:
+            print("Resuming ", chain_dir, " after ", state['nsteps'], " steps.")
+            pos = state['position']
+            lnprob0 = state['lnprob']
+            blobs0 = state['blobs']
+            sampler.random_state = state['random_state']
+            Nruns -= state['nsteps']
+    else:
+        filename = chain_out+"/sz_chain_"+args.chain_name+"_"+str(index)+".dat"
+        f = open(filename, "w")
+        f.close()
     
-    filename = chain_out+"/sz_chain_"+args.chain_name+"_"+str(index)+".dat"
-    f = open(filename, "w")
-    f.close()
-    
-    for result in sampler.sample(pos, iterations=Nruns, storechain=False):
+    for it, result in enumerate(sampler.sample(pos, lnprob0=lnprob0, blobs0=blobs0, iterations=Nruns, storechain=False)):
         position = result[0]
-        s8 = np.array(result[3]).reshape((len(result[3]),1))
-        f = open(filename, "ab")
-        savemat = np.concatenate((position,s8),axis=1)
-        np.savetxt(f,savemat)
-        f.close()
-        print("Saved a sample.")
-
-# pool.close()
-
-print (time.time() - start)  
+        if args.chain_format=="npz":
+            writer.add(position,result[1],result[3],result[2])
+        else:
+            s8 = np.array(result[3]).reshape((len(result[3]),1))
+            f = open(filename, "ab")
+            savemat = np.concatenate((position,s8),axis=1)
+            np.savetxt(f,savemat)
+            f.close()
+        if (it+1) % args.flush_every == 0:
+            elapsed = time.time() - start
+            print("Step ", it+1, ": ", old_div(nwalkers*(it+1),elapsed), " walker evaluations / s")
+    if args.chain_format=="npz": writer.close()
+
+if pool is not None: pool.close()
+
+print (time.time() - start)
+print ("CAMB power spectrum cache: ", pkcache.default_cache.stats())  
@@ -14,7 +14,6 @@ from szar.counts import ClusterCosmology,Halo_MF
 from nemo import simsTools
 from astropy.io import fits
 
-import emcee
 import time, sys, os
 # from emcee.utils import MPIPool
 import argparse
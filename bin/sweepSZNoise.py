@@ -0,0 +1,99 @@
+from __future__ import print_function
+from __future__ import division
+from builtins import str
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+from configparser import SafeConfigParser
+import pickle as pickle
+import argparse
+import itertools
+import time
+from orphics.io import dict_from_section, list_from_config
+from szar.counts import ClusterCosmology
+from szar.szproperties import SZ_Cluster_Model
+from szar.varkernel import var_kernel_from_config
+
+# Writes the SZ variance grids of makeGrid.py --skip-lensing for a list of
+# lknee and alpha overrides in one serial job. The experiment independent
+# variance kernel is computed (or read) once and every noise curve only
+# costs one matrix product.
+
+parser = argparse.ArgumentParser(description='Make SZ variance grids for a sweep over lknee_T and alpha_T.')
+parser.add_argument('expName', type=str,help='The name of the experiment in input/pipeline.ini')
+parser.add_argument('gridName', type=str,help='The name of the grid in input/pipeline.ini')
+parser.add_argument("-l", "--lknee",type=str,help='Comma separated lknee_T overrides.',default=None)
+parser.add_argument("-a", "--alpha",type=str,help='Comma separated alpha_T overrides.',default=None)
+args = parser.parse_args()
+
+expName = args.expName
+gridName = args.gridName
+
+iniFile = "input/pipeline.ini"
+Config = SafeConfigParser()
+Config.optionxform=str
+Config.read(iniFile)
+version = Config.get('general','version')
+bigDataDir = Config.get('general','bigDataDirectory')
+clttfile = Config.get('general','clttfile')
+
+fparams = {}
+for (key, val) in Config.items('params'):
+    if ',' in val:
+        param, step = val.split(',')
+        fparams[key] = float(param)
+    else:
+        fparams[key] = float(val)
+constDict = dict_from_section(Config,'constants')
+clusterDict = dict_from_section(Config,'cluster_params')
+
+ms = list_from_config(Config,gridName,'mexprange')
+Mexp_edges = np.arange(ms[0],ms[1]+ms[2],ms[2])
+zs = list_from_config(Config,gridName,'zrange')
+z_edges = np.arange(zs[0],zs[1]+zs[2],zs[2])
+
+beam = list_from_config(Config,expName,'beams')
+noise = list_from_config(Config,expName,'noises')
+freq = list_from_config(Config,expName,'freqs')
+fsky = Config.getfloat(expName,'fsky')
+try:
+    v3mode = Config.getint(expName,'V3mode')
+except:
+    v3mode = -1
+lkneeT,lkneeP = list_from_config(Config,expName,'lknee')
+alphaT,alphaP = list_from_config(Config,expName,'alpha')
+try:
+    doFg = Config.getboolean(expName,'do_foregrounds')
+except:
+    print("NO FG OPTION FOUND IN INI. ASSUMING TRUE.")
+    doFg = True
+try:
+    dotsz_cib = Config.getboolean(expName,'do_tsz_cib')
+except:
+    print("NO tSZ_CIB OPTION FOUND IN INI. ASSUMING TRUE.")
+    dotsz_cib = True
+
+lkneeList = [None] if args.lknee is None else [float(x) for x in args.lknee.split(',')]
+alphaList = [None] if args.alpha is None else [float(x) for x in args.alpha.split(',')]
+
+cc = ClusterCosmology(fparams,constDict,clTTFixFile=clttfile)
+
+varKernel = None
+for lkneeTOverride,alphaTOverride in itertools.product(lkneeList,alphaList):
+    t0 = time.time()
+    suffix = ""
+    if lkneeTOverride is not None:
+        suffix += "_"+str(lkneeTOverride)
+    if alphaTOverride is not None:
+        suffix += "_"+str(alphaTOverride)
+    lknee = lkneeT if lkneeTOverride is None else lkneeTOverride
+    alpha = alphaT if alphaTOverride is None else alphaTOverride
+
+    SZCluster = SZ_Cluster_Model(cc,clusterDict,rms_noises = noise,fwhms=beam,freqs=freq,lknee=lknee,alpha=alpha,fg=doFg,tsz_cib=dotsz_cib,v3mode=v3mode,fsky=fsky)
+    if varKernel is None:
+        varKernel = var_kernel_from_config(Config,bigDataDir,gridName,SZCluster,Mexp_edges,z_edges)
+    siggrid = varKernel.sigN(SZCluster.varNoise(),SZCluster.evalells)
+
+    filename = bigDataDir+"szgrid_"+expName+"_"+gridName+ "_v" + version+suffix+".pkl"
+    pickle.dump((Mexp_edges,z_edges,siggrid),open(filename,'wb'))
+    print("lknee ",lknee,", alpha ",alpha,": wrote ",filename," in ",time.time()-t0," s")
@@ -10,6 +10,7 @@ from orphics.io import Plotter
 import matplotlib.pyplot as plt
 from szar.fisher import getFisher
 from szar.counts import rebinN
+import szar.fisher as sfisher
 
 
 expName = sys.argv[1]
@@ -57,7 +58,8 @@ paramLatexList = Config.get(fishSection,'paramLatexList').split(',')
 saveName = Config.get(fishSection,'saveSuffix')
 
 # Fiducial number counts
-new_z_edges, N_fid = rebinN(np.load(bigDataDir+"N_mzq_"+saveId+"_fid"+".npy"),pzcutoff,z_edges)
+derivRoot = sfisher.deriv_sources(bigDataDir,saveId)
+new_z_edges, N_fid = rebinN(sfisher.fid_counts(bigDataDir,saveId),pzcutoff,z_edges)
 
 N_fid = N_fid[:,:,:]*fsky
 print("Total number of clusters: ", N_fid.sum()) #getTotN(N_fid,mgrid,zgrid,qbins)
@@ -142,7 +144,7 @@ for prior in list(priorList.keys()):
 
         ##########################
         # Populate Fisher
-        Fisher = getFisher(N_fid,paramList,priorNameList,priorValueList,bigDataDir,saveId,pzcutoff,z_edges,fsky)
+        Fisher = getFisher(N_fid,paramList,priorNameList,priorValueList,derivRoot,pzcutoff,z_edges,fsky)
         ##########################
 
 
@@ -37,9 +37,9 @@ zs = listFromConfig(Config,gridName,'zrange')
 z_edges = np.arange(zs[0],zs[1]+zs[2],zs[2])
 
 saveId = sfisher.save_id(expName,gridName,calName,version)
-derivRoot = sfisher.deriv_root(bigDataDir,saveId)
+derivRoot = sfisher.deriv_sources(bigDataDir,saveId)
 # Fiducial number counts
-new_z_edges, N_fid = sfisher.rebinN(np.load(sfisher.fid_file(bigDataDir,saveId)),pzcutoff,z_edges)
+new_z_edges, N_fid = sfisher.rebinN(sfisher.fid_counts(bigDataDir,saveId),pzcutoff,z_edges)
 N_fid = N_fid*fsky
 print "Effective number of clusters: ", N_fid.sum()
 
@@ -47,18 +47,33 @@ def con_M_rel_duffy(Mvir, z):
     return ans
 
 
-# @nb.jit("f8[:](f8[:],f8,f8,f8,f8,f8)",nopython=True)
-def Mass_con_del_2_del_mean200(Mdel,delta,z,rhocz,rhoc0om,ERRTOL):
+def m_x_arr(x):
+    #NFW cumulative mass distribution, array version of m_x
+    return np.log(1. + x) - x/(1. + x)
+
+def Mass_con_del_2_del_mean200(Mdel,delta,z,rhocz,rhoc0om,ERRTOL,maxiter=10000):
     #Mass conversion critical to mean overdensity, needed because the Tinker Mass function uses mean matter
+    #Mdel, z and rhocz can be scalars or arrays that broadcast against each other, e.g. Mdel (nM,1) and
+    #z, rhocz (1,nz) to convert a whole (M,z) grid at once. Every element follows the same fixed-point
+    #iteration as the original per-element loop; only elements that have not met ERRTOL are updated.
+    Mdel, z, rhocz = np.broadcast_arrays(np.asarray(Mdel,dtype=np.float64),np.asarray(z,dtype=np.float64),
+                                         np.asarray(rhocz,dtype=np.float64))
+    shape = Mdel.shape
+    Mdel = Mdel.ravel()
+    z = z.ravel()
     Mass = 2.*Mdel
-    rdels = rdel_c(Mdel,z,delta,rhocz)
+    rdels = rdel_c(Mdel,z,delta,rhocz.ravel())
     ans = Mass*0.0
-    for i in range(len(Mdel)):
-        while abs(old_div(ans[i],Mass[i]) - 1) > ERRTOL : 
-            ans[i] = Mass[i]
-            conz = con_M_rel_duffy200(Mass[i],z) #DUFFY
-            rs = old_div(rdel_m(Mass[i],z,200,rhoc0om),conz)
-            xx = old_div(rdels[i], rs)
-            Mass[i] = Mdel[i] * m_x(conz) / m_x(xx)
+    active = np.arange(Mdel.size)
+    for it in range(maxiter):
+        active = active[np.abs(ans[active]/Mass[active] - 1) > ERRTOL]
+        if active.size==0: break
+        Ma = Mass[active]
+        za = z[active]
+        ans[active] = Ma
+        conz = con_M_rel_duffy200(Ma,za) #DUFFY
+        rs = rdel_m(Ma,za,200,rhoc0om)/conz
+        xx = rdels[active]/rs
+        Mass[active] = Mdel[active] * m_x_arr(conz) / m_x_arr(xx)
     ## Finish when they Converge
-    return ans
+    return ans.reshape(shape)
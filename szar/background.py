@@ -0,0 +1,59 @@
+"""
+Spline tables of the background distances of a CAMB results object.
+
+CAMB's distance functions are cheap per call but are called one redshift at
+a time in many places (per cluster, per grid cell, per fine z sample).
+BackgroundTable evaluates the comoving distance, the angular diameter
+distance and H(z) once on a dense grid uniform in ln(1+z) and serves any
+array of redshifts by spline lookup. ClusterCosmology keeps one per CAMB
+results object (see ClusterCosmology.background_table) and exposes the
+lookups as chi_z, DA_z, H_z, E_z and dVdz.
+"""
+from __future__ import print_function
+from __future__ import division
+from builtins import object
+import numpy as np
+from scipy.interpolate import CubicSpline
+
+C_KM_S = 2.99792458e5
+
+class BackgroundTable(object):
+    def __init__(self,results,zmax=10.,dlnz=2.e-3):
+        """
+        results  CAMB results (or anything with comoving_radial_distance,
+                 angular_diameter_distance and hubble_parameter)
+        zmax     largest redshift tabulated
+        dlnz     spacing of the ln(1+z) grid
+        """
+        self.results = results
+        self.zmax = zmax
+        x = np.linspace(0.,np.log1p(zmax),int(np.ceil(np.log1p(zmax)/dlnz))+1)
+        z = np.expm1(x)
+        self.chi = CubicSpline(x,results.comoving_radial_distance(z))
+        self.DA = CubicSpline(x,results.angular_diameter_distance(z))
+        self.lnH = CubicSpline(x,np.log(results.hubble_parameter(z)))
+
+    def _x(self,z):
+        z = np.asarray(z,dtype=np.float64)
+        if np.any(z<0.) or np.any(z>self.zmax):
+            raise ValueError("Redshift outside of the tabulated background range.")
+        return np.log1p(z)
+
+    def comoving_radial_distance(self,z):
+        # Mpc
+        return self.chi(self._x(z))
+
+    def angular_diameter_distance(self,z):
+        # Mpc
+        return self.DA(self._x(z))
+
+    def hubble_parameter(self,z):
+        # km/s/Mpc
+        return np.exp(self.lnH(self._x(z)))
+
+    def dVdz(self,z):
+        """
+        Comoving volume element dV/dz/dOmega = D_A^2 (1+z)^2 c/H(z) in Mpc^3.
+        """
+        x = self._x(z)
+        return self.DA(x)**2.*np.exp(2.*x)*C_KM_S/np.exp(self.lnH(x))
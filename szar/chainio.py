@@ -0,0 +1,117 @@
+"""
+Buffered, resumable MCMC chain storage for bin/run_like.py.
+
+A chain is a directory of chunked .npz files. Each chunk holds a block of
+steps of walker positions, ln probabilities and the s8 blob. state.npz holds
+the last walker positions, ln probabilities, blobs and sampler RNG state, so
+that an interrupted chain can be continued from the last flush. Files are
+written to a temporary name and renamed, so a killed job never leaves a
+partial chunk behind. Chunks are always written before the state, and on
+resume any chunk past the state is discarded.
+"""
+from __future__ import print_function
+from __future__ import division
+from builtins import object
+import numpy as np
+import glob
+import os
+
+def _atomic_savez(filename,**arrays):
+    tmp = filename+".tmp"+str(os.getpid())+".npz"
+    np.savez(tmp,**arrays)
+    os.replace(tmp,filename)
+
+def _chunk_files(chain_dir):
+    return sorted(glob.glob(os.path.join(chain_dir,"chunk_*.npz")))
+
+class ChainWriter(object):
+    def __init__(self,chain_dir,nwalkers,ndim,flush_every=10,resume=False):
+        """
+        chain_dir    directory the chain is written to
+        flush_every  number of steps buffered in memory between writes
+        resume       keep an existing chain in chain_dir and append to it
+                     (see last_state); otherwise any existing chain is removed
+        """
+        self.chain_dir = chain_dir
+        self.nwalkers = nwalkers
+        self.ndim = ndim
+        self.flush_every = flush_every
+        if not os.path.exists(chain_dir): os.makedirs(chain_dir)
+        if not(resume):
+            for f in _chunk_files(chain_dir)+glob.glob(os.path.join(chain_dir,"state.npz")):
+                os.remove(f)
+        state = self.last_state()
+        self.nsteps = 0 if state is None else state['nsteps']
+        # a chunk written after the last state (job killed in between) is
+        # dropped, since the chain resumes from that state
+        for f in _chunk_files(chain_dir):
+            with np.load(f) as data:
+                step0 = int(data['step0'])
+            if step0 >= self.nsteps: os.remove(f)
+        self.nchunks = len(_chunk_files(chain_dir))
+        self._clear_buffer()
+
+    def _clear_buffer(self):
+        self._pos = []
+        self._lnprob = []
+        self._s8 = []
+        self._state = None
+
+    def add(self,position,lnprob,blobs,random_state):
+        """
+        Buffer one step of the sampler (the tuple emcee's sample() yields)
+        and flush if flush_every steps are buffered.
+        """
+        self._pos.append(np.asarray(position,dtype=np.float64))
+        self._lnprob.append(np.asarray(lnprob,dtype=np.float64))
+        self._s8.append(np.asarray(blobs,dtype=np.float64).reshape((self.nwalkers,)))
+        self._state = (position,lnprob,blobs,random_state)
+        self.nsteps += 1
+        if len(self._pos) >= self.flush_every: self.flush()
+
+    def flush(self):
+        if len(self._pos)==0: return
+        _atomic_savez(os.path.join(self.chain_dir,"chunk_%06d.npz" % self.nchunks),
+                      position=np.array(self._pos),lnprob=np.array(self._lnprob),s8=np.array(self._s8),
+                      step0=self.nsteps-len(self._pos))
+        self.nchunks += 1
+        position,lnprob,blobs,random_state = self._state
+        name,keys,pos,has_gauss,cached_gaussian = random_state
+        _atomic_savez(os.path.join(self.chain_dir,"state.npz"),
+                      position=np.asarray(position),lnprob=np.asarray(lnprob),
+                      blobs=np.asarray(blobs,dtype=np.float64),nsteps=self.nsteps,
+                      rng_name=name,rng_keys=keys,rng_pos=pos,rng_has_gauss=has_gauss,
+                      rng_cached_gaussian=cached_gaussian)
+        self._clear_buffer()
+
+    def close(self):
+        self.flush()
+
+    def last_state(self):
+        """
+        The state at the last flush as a dict with position, lnprob,
+        blobs, random_state and nsteps, or None for a new chain.
+        """
+        filename = os.path.join(self.chain_dir,"state.npz")
+        if not os.path.exists(filename): return None
+        with np.load(filename) as data:
+            random_state = (str(data['rng_name']),data['rng_keys'],int(data['rng_pos']),
+                            int(data['rng_has_gauss']),float(data['rng_cached_gaussian']))
+            return {'position':data['position'],'lnprob':data['lnprob'],
+                    'blobs':list(data['blobs']),'random_state':random_state,
+                    'nsteps':int(data['nsteps'])}
+
+def load_chain(chain_dir):
+    """
+    Returns position (nsteps,nwalkers,ndim), lnprob (nsteps,nwalkers)
+    and s8 (nsteps,nwalkers) of a chain written by ChainWriter.
+    """
+    position = []
+    lnprob = []
+    s8 = []
+    for f in _chunk_files(chain_dir):
+        with np.load(f) as data:
+            position.append(data['position'])
+            lnprob.append(data['lnprob'])
+            s8.append(data['s8'])
+    return np.concatenate(position),np.concatenate(lnprob),np.concatenate(s8)
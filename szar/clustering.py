@@ -46,13 +46,8 @@ class Clustering(object):
         #self.dndm_SZ = self.HMF.dn_dmz_SZ(self.SZProp)
 
     def dVdz_fine(self,zarr):
-        DA_z = self.HMF.cc.results.angular_diameter_distance(zarr)
-        dV_dz = DA_z**2 * (1.+zarr)**2
-        #NOT SURE we need this for loop
-        for i in range (zarr.size):
-            dV_dz[i] /= (self.HMF.cc.results.h_of_z(zarr[i]))
-        dV_dz *= (old_div(self.HMF.cc.H0,100.))**3. # was h0
-        return dV_dz
+        # dV/dzdOmega at any array of redshifts
+        return self.HMF.cc.dVdz(zarr)
 
     def ntilde(self):
         dndm_SZ = self.HMF.dn_dmz_SZ(self.SZProp)
@@ -84,7 +79,7 @@ class Clustering(object):
         dndm_SZ = self.HMF.dn_dmz_SZ(self.SZProp)
         
         R = tinker.radius_from_mass(self.HMF.M200,self.cc.rhoc0om)
-        sig = np.sqrt(tinker.sigma_sq_integral(R, self.HMF.pk, self.HMF.kh))
+        sig = np.sqrt(tinker.sigma_sq_batched(R, self.HMF.pk, self.HMF.kh, table_step=0.002))
 
         blin = tinker.tinker_bias(sig,200.)
         beff = old_div(np.trapz(dndm_SZ*blin,dx=np.diff(self.HMF.M200,axis=0),axis=0), nbar)
@@ -104,7 +99,7 @@ class Clustering(object):
 
         R = tinker.radius_from_mass(M200,self.cc.rhoc0om)
         
-        sig = np.sqrt(tinker.sigma_sq_integral(R, self.HMF.pk[use_z,:], self.HMF.kh))
+        sig = np.sqrt(tinker.sigma_sq_batched(R, self.HMF.pk[use_z,:], self.HMF.kh))
 
         #print sig[:,0],sig[0,:]
         print(sig.shape)
@@ -138,7 +133,7 @@ class Clustering(object):
         fine_zgrid = fine_zgrid[1:-1]
 
         ntils = self.ntilde_interpol(fine_zgrid)
-        dvdz = np.array([self.dVdz_fine(zs) for zs in fine_zgrid])
+        dvdz = self.dVdz_fine(fine_zgrid)
 
         dz = fine_zgrid[0,1] - fine_zgrid[0,0]
 
@@ -156,7 +151,7 @@ class Clustering(object):
             fine_zgrid[i,:] = np.linspace(zgridedges[i], zgridedges[i+1], nsubsamples)
 
         fine_zgrid = fine_zgrid[1:-1]
-        dvdz = np.array([self.dVdz_fine(zs) for zs in fine_zgrid])
+        dvdz = self.dVdz_fine(fine_zgrid)
         dz = fine_zgrid[0,1] - fine_zgrid[0,0]
 
         assert np.allclose(dz * np.ones(tuple(np.subtract(fine_zgrid.shape, (0,1)))),  np.diff(fine_zgrid,axis=1), rtol=1e-3)
@@ -215,7 +210,7 @@ class Clustering(object):
 
         fine_zgrid = fine_zgrid[1:-1]
         ntils = self.ntilde_interpol(fine_zgrid)
-        dvdz = np.array([self.dVdz_fine(zs) for zs in fine_zgrid])
+        dvdz = self.dVdz_fine(fine_zgrid)
         prefac = dvdz * ntils**2
         prefac = prefac[..., np.newaxis]
         ps_tils = self.ps_tilde_interpol(fine_zgrid, mu)
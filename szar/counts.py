@@ -20,11 +20,16 @@ from orphics.io import Plotter
 from orphics.cosmology import Cosmology
 import orphics.cosmology as cosmo
 from orphics.stats import timeit
-from scipy.interpolate import interp1d, interp2d, griddata
+from scipy.interpolate import interp1d, griddata
 from scipy.integrate import simps
-from scipy.interpolate import UnivariateSpline
+from scipy.interpolate import UnivariateSpline, RectBivariateSpline
 
 import szar._fast as fast
+from szar import pkcache
+from szar import samplevariance
+from szar import sampling
+from szar.growth import GrowthTable
+from szar.background import BackgroundTable, C_KM_S
 
 def bin_ndarray(ndarray, new_shape, operation='sum'):
     """
@@ -154,54 +159,21 @@ def haloBias(Mexp_edges,z_edges,rhoc0om,kh,pk):
 
     M = np.outer(Masses,np.ones([len(z_arr)]))
     R = tinker.radius_from_mass(M, rhoc0om)
-    sigsq = tinker.sigma_sq_integral(R, pk[:,:], kh)
+    sigsq = tinker.sigma_sq_batched(R, pk[:,:], kh)
 
     return z_arr,1. + (old_div(((ac*(dc**2.)/sigsq)-1.),dc)) + 2.*pc/(dc*(1.+(ac*dc*dc/sigsq)**pc))
 
 
 
-def sampleVarianceOverNsquareOverBsquare(cc,kh,pk,z_edges,fsky,lmax=1000):
-    zs = old_div((z_edges[1:]+z_edges[:-1]),2.)
-    chis = cc.results.comoving_radial_distance(zs)
-
-    chi_edges = cc.results.comoving_radial_distance(z_edges)
-    dchis = np.diff(chi_edges)
-    
-    assert len(dchis)==len(chis)
-
-
-    PofElls = []
-    for i,chi in enumerate(chis):
-        pfunc = interp1d(kh,pk[i,:])
-        PofElls.append(lambda ell,chi: pfunc(ell*cc.h/chi))
-    
-    import healpy as hp
-    frac = 1.-fsky
-    nsides_allowed = 2**np.arange(5,13,1)
-    nside_min = int(old_div((lmax+1.),3.))
-    nside = nsides_allowed[nsides_allowed>nside_min][0]
-    npix = 12*(nside**2)
-
-    hpmap = old_div(np.ones(npix),(1.-frac))
-    hpmap[:int(npix*frac)] = 0
-    alms_original = hp.map2alm(hpmap)
-
-
-    ellrange  = np.arange(2,lmax,1)
-
-    powers = []
-    for i,(chi,dchi) in enumerate(zip(chis,dchis)):
-        Pl = PofElls[i](ellrange,chi)
-        Pl = np.insert(Pl,0,0)
-        Pl = np.insert(Pl,0,0)
-        alms = hp.almxfl(alms_original.copy(),np.sqrt(Pl))
-        power = (alms*alms.conjugate()).real/chi/chi/dchi
-        powers.append(power.sum())
-        # print i,powers[-1]
-
-    powers = np.array(powers)
-
-    return powers
+def sampleVarianceOverNsquareOverBsquare(cc,kh,pk,z_edges,fsky,lmax=1000,lmax_exact=30):
+    """
+    Variance sigma^2(z) of the mean overdensity in each redshift shell of a
+    spherical cap covering fsky (see szar.samplevariance), with the
+    multipoles below lmax_exact projected exactly and Limber up to lmax.
+    """
+    Kl = samplevariance.cap_mask_weights(fsky,lmax)
+    S = samplevariance.shell_covariance(cc,kh,pk,z_edges,Kl,lmax_exact=lmax_exact)
+    return np.diagonal(S).copy()
 
 #def f_nu(constDict,nu):
 #    c = constDict
@@ -217,46 +189,60 @@ class ClusterCosmology(Cosmology):
         Cosmology.__init__(self,paramDict,constDict,lmax,clTTFixFile,skipCls,pickling,fill_zero,dimensionless=dimensionless,verbose=verbose,skipPower=skipPower,skip_growth=skip_growth,low_acc=low_acc,nonlinear=False)
         self.om = (self.omch2+self.ombh2)/self.h**2.
         self.rhoc0om = self.rho_crit0H100*self.om
+        self._growth = None
+        self._background = None
         
+    def background_table(self,zmax=0.):
+        """
+        The BackgroundTable of the current CAMB results, made on first use
+        and again only if the results change or a redshift above zmax
+        is needed.
+        """
+        bg = self._background
+        if bg is None or bg.results is not self.results or bg.zmax<zmax:
+            self._background = BackgroundTable(self.results,zmax=max(10.,1.5*zmax))
+        return self._background
+
+    def chi_z(self,z):
+        #comoving radial distance in Mpc
+        return self.background_table(np.max(z)).comoving_radial_distance(z)
+
+    def DA_z(self,z):
+        #angular diameter distance in Mpc
+        return self.background_table(np.max(z)).angular_diameter_distance(z)
+
+    def H_z(self,z):
+        #hubble parameter in km/s/Mpc
+        return self.background_table(np.max(z)).hubble_parameter(z)
+
+    def dVdz(self,z):
+        #comoving volume element dV/dz/dOmega in (Mpc/h)^3
+        return self.background_table(np.max(z)).dVdz(z) * self.h**3.
+
     def E_z(self,z):
         #hubble function
-        ans = old_div(self.results.hubble_parameter(z),self.paramDict['H0']) # 0.1% different from sqrt(om*(1+z)^3+ol)
+        ans = old_div(self.H_z(z),self.paramDict['H0']) # 0.1% different from sqrt(om*(1+z)^3+ol)
         return ans
 
+    def growth_table(self,zmin=0.):
+        """
+        The GrowthTable of this cosmology, made on first use (and again
+        only if a redshift below zmin is needed).
+        """
+        amax = max(1.,old_div(1.,(1.+zmin)))
+        if self._growth is None or self._growth.amax<amax:
+            # the growth integral runs to a=1e-6, far past the background table
+            E_z = lambda z: old_div(self.results.hubble_parameter(z),self.paramDict['H0'])
+            self._growth = GrowthTable(E_z,self.om,amax=amax)
+        return self._growth
+
     def growthfunc(self,z):
         #numerical growth function
-        a = old_div(1.,(1.+z))
-        dela = 0.000001
-        Om = old_div((self.paramDict['omch2'] + self.paramDict['ombh2']), (old_div(self.paramDict['H0'],100.))**2)
-        integ = np.zeros(len(z))
-
-        for i in range(len(a)):
-            aa = np.arange(dela,a[i],dela)
-            integrand = 1./( (aa * self.E_z(1./aa - 1.))**3 )
-            integ[i] = simps(integrand, aa)
-        #test timing for trapz vs simps
-
-        ans = 5.* Om / 2. *self.E_z(z) * integ
-        return ans
+        return self.growth_table(np.min(z)).D(z)
 
     def fgrowth(self,z):
-        a = old_div(1.,(1. + z))
-        a = a[::-1] #np.flip(a)
-        
-        dgrowth = self.growthfunc(z)#cc.results.get_redshift_evolution(self.HMF.kh, zarr, ['growth'])
-        dgrowth = dgrowth[::-1] #np.flip(dgrowth)
-
-        n = len(z)
-        k = 5 # 5th degree spline
-        s = n - np.sqrt(2*n) # smoothing factor
-
-        dgrowth_spline = UnivariateSpline(a, dgrowth, k=k, s=s)
-        dgrowth_spline_deriv = UnivariateSpline(a, dgrowth, k=k, s=s).derivative(n=1)
-
-        dlogd_dloga = a*(dgrowth_spline_deriv(a)/dgrowth_spline(a))
-        dlogd_dloga = dlogd_dloga[::-1] #np.flip(dlogd_dloga)
-        #dlog = np.gradient(np.log(dgrowth), np.log(a), edge_order=2)
-        return dlogd_dloga
+        # growth rate dlnD/dlna
+        return self.growth_table(np.min(z)).f(z)
 
     def rhoc(self,z):
         #critical density as a function of z
@@ -265,7 +251,7 @@ class ClusterCosmology(Cosmology):
     
     def rdel_c(self,M,z,delta):
         #spherical overdensity radius w.r.t. the critical density
-        rhocz = self.rhoc(z)
+        rhocz = self.rhoc(np.ravel(z)).reshape(np.shape(z))
         M = np.atleast_1d(M)
         return fast.rdel_c(M,z,delta,rhocz)
 
@@ -273,12 +259,19 @@ class ClusterCosmology(Cosmology):
         #spherical overdensity radius w.r.t. the mean matter density
         return fast.rdel_m(M,z,delta,self.rhoc0om)
 
-    def Mass_con_del_2_del_mean200(self,Mdel,delta,z):
+    def Mass_con_del_2_del_mean200(self,Mdel,delta,z,table=None):
         #Mass conversion critical to mean overdensity, needed because the Tinker Mass function uses mean matter
-        rhocz = self.rhoc(z)
+        #Mdel and z broadcast against each other, so Mdel[:,None] and z[None,:] convert a whole (M,z) grid.
+        #table is an optional MassConversionTable for repeated calls at this cosmology.
+        if table is not None:
+            return table(Mdel,z)
+        rhocz = self.rhoc(np.ravel(z)).reshape(np.shape(z))
         ERRTOL = self.c['ERRTOL']        
         return fast.Mass_con_del_2_del_mean200(Mdel,delta,z,rhocz,self.rhoc0om,ERRTOL)
 
+    def mass_conversion_table(self,delta,logm_min,logm_max,zmin,zmax,dlogm=0.01,dz=0.01):
+        return MassConversionTable(self,delta,logm_min,logm_max,zmin,zmax,dlogm,dz)
+
     def Mdel_to_cdel(self,M,z,delta):
         # Converts M to c where M is defined wrt delta overdensity relative to *critical* density at redshift of cluster.
         M200 = self.Mass_con_del_2_del_mean200(np.array(M).reshape((1,)),delta,z)[0]
@@ -296,7 +289,7 @@ class ClusterCosmology(Cosmology):
         else:
             r500 = self.rdel_m(M,zdensity,overdensity) # R500 in Mpc/h
 
-        dAz = self.results.angular_diameter_distance(z) * self.h  # dAz in Mpc/h
+        dAz = self.DA_z(z) * self.h  # dAz in Mpc/h
         return old_div(r500,dAz)
 
     def theta200_from_richness(self,richness,z):
@@ -308,6 +301,74 @@ class ClusterCosmology(Cosmology):
         m200 = mass_from_richness_melchior(richness,z)
         return self.theta(m200,z,overdensity=200.,critical=False,at_cluster_z=True)
         
+class MassConversionTable(object):
+    """
+    log(M200mean/Mdelta_crit) tabulated on a regular (log10 M, z) grid for one
+    cosmology and overdensity, interpolated with a bicubic spline. Points
+    outside the tabulated range fall back to the direct conversion.
+    """
+    def __init__(self,clusterCosmology,delta,logm_min,logm_max,zmin,zmax,dlogm=0.01,dz=0.01):
+        self.cc = clusterCosmology
+        self.delta = delta
+        self.logm = np.arange(logm_min,logm_max+dlogm,dlogm)
+        self.z = np.arange(zmin,zmax+dz,dz)
+        Mgrid = 10**self.logm[:,None]
+        M200 = self.cc.Mass_con_del_2_del_mean200(Mgrid,delta,self.z[None,:])
+        self.spline = RectBivariateSpline(self.logm,self.z,np.log(old_div(M200,Mgrid)))
+
+    def __call__(self,Mdel,z):
+        Mdel, z = np.broadcast_arrays(np.asarray(Mdel,dtype=np.float64),np.asarray(z,dtype=np.float64))
+        logm = np.log10(Mdel)
+        ans = Mdel*np.exp(self.spline.ev(logm,z))
+        outside = (logm<self.logm[0]) | (logm>self.logm[-1]) | (z<self.z[0]) | (z>self.z[-1])
+        if np.any(outside):
+            ans[outside] = self.cc.Mass_con_del_2_del_mean200(Mdel[outside],self.delta,z[outside])
+        return ans
+
+class MassFunctionGrid(object):
+    """
+    Spline interpolation of a quantity tabulated on the regular (z, log10 M)
+    grid of a Halo_MF, with the same interpolating spline as interp2d
+    (kind 'cubic' or 'linear', zero smoothing). Points outside the grid
+    return fill_value.
+
+    Calling it with arrays z and logM evaluates the (logM, z) outer grid and
+    returns the same shapes interp2d did; ev evaluates scattered points.
+    """
+    def __init__(self,z,logM,values,kind='cubic',fill_value=0.):
+        # values is indexed (logM, z) like the Halo_MF arrays
+        k = {'linear':1,'cubic':3}[kind]
+        self.z = np.asarray(z)
+        self.logM = np.asarray(logM)
+        self.fill_value = fill_value
+        self.spline = RectBivariateSpline(self.z,self.logM,np.asarray(values).T,kx=k,ky=k,s=0)
+
+    def _outside(self,z,logM):
+        return (z<self.z[0]) | (z>self.z[-1]) | (logM<self.logM[0]) | (logM>self.logM[-1])
+
+    def __call__(self,z,logM):
+        z = np.atleast_1d(np.asarray(z,dtype=np.float64))
+        logM = np.atleast_1d(np.asarray(logM,dtype=np.float64))
+        zsort = np.argsort(z,kind='mergesort')
+        msort = np.argsort(logM,kind='mergesort')
+        ans = np.empty((logM.size,z.size))
+        ans[np.ix_(msort,zsort)] = self.spline(z[zsort],logM[msort]).T
+        if self.fill_value is not None:
+            ans[self._outside(z[None,:],logM[:,None])] = self.fill_value
+        if ans.shape[0]==1: ans = ans[0]
+        return ans
+
+    def ev(self,z,logM):
+        """
+        Values at the points (z[i], logM[i]); z and logM broadcast
+        against each other and the result has their broadcast shape.
+        """
+        z, logM = np.broadcast_arrays(np.asarray(z,dtype=np.float64),np.asarray(logM,dtype=np.float64))
+        ans = self.spline.ev(z,logM)
+        if self.fill_value is not None:
+            ans[self._outside(z,logM)] = self.fill_value
+        return ans
+
 def mass_from_richness_melchior(richness,z):
     # Melchior et. al. richness,z to M200meanAtZ
 
@@ -324,11 +385,12 @@ def mass_from_richness_melchior(richness,z):
 
 class Halo_MF(object):
     #@timeit
-    def __init__(self,clusterCosmology,Mexp_edges,z_edges,kh=None,powerZK=None,kmin=1e-4,kmax=5.,knum=200):
+    def __init__(self,clusterCosmology,Mexp_edges,z_edges,kh=None,powerZK=None,kmin=1e-4,kmax=5.,knum=200,pk_cache=None):
         #def __init__(self,clusterCosmology,Mexp_edges,z_edges,kh=None,powerZK=None,kmin=1e-4,kmax=11.,knum=200):
         # update self.sigN (20 mins) and self.Pfunc if changing experiment
         # update self.cc or self.pk if changing cosmology
         # update self.Pfunc if changing scaling relation parameters
+        # pk_cache is a pkcache.PowerSpectrumCache; None uses pkcache.default_cache, False disables caching
 
         self.cc = clusterCosmology
 
@@ -336,14 +398,20 @@ class Halo_MF(object):
         self.zarr_edges = z_edges
         self.zarr = zcenters
 
+        self.Hz = None
         if powerZK is None:
-            self.kh, self.pk = self._pk(self.zarr,kmin,kmax,knum)
+            if pk_cache is None: pk_cache = pkcache.default_cache
+            if pk_cache is False:
+                self.kh, self.pk = self._pk(self.zarr,kmin,kmax,knum)
+                self.DAz = self.cc.DA_z(self.zarr)
+            else:
+                self._cached_pk(pk_cache,kmin,kmax,knum)
         else:
             assert kh is not None
             self.kh = kh
             self.pk = powerZK
+            self.DAz = self.cc.DA_z(self.zarr)
 
-        self.DAz = self.cc.results.angular_diameter_distance(self.zarr)        
         self._initdVdz(self.zarr)
 
         self.sigN = None
@@ -363,11 +431,8 @@ class Halo_MF(object):
         self.M200_edges = np.zeros((M_edges.size,self.zarr.size))
         self.zeroTemplate = self.M200.copy()
 
-        for i in range(self.zarr.size):
-            self.M200[:,i] = self.cc.Mass_con_del_2_del_mean200(M,500,self.zarr[i])
-
-        for i in range(self.zarr.size):
-            self.M200_edges[:,i] = self.cc.Mass_con_del_2_del_mean200(M_edges,500,self.zarr[i])
+        self.M200[:,:] = self.cc.Mass_con_del_2_del_mean200(M[:,None],500,self.zarr[None,:])
+        self.M200_edges[:,:] = self.cc.Mass_con_del_2_del_mean200(M_edges[:,None],500,self.zarr[None,:])
 
     def _pk(self,zarr,kmin,kmax,knum):
         self.cc.pars.set_matter_power(redshifts=np.append(zarr,0), kmax=kmax,silent=True)
@@ -381,6 +446,25 @@ class Halo_MF(object):
 
         kh, z, powerZK = self.cc.results.get_matter_power_spectrum(minkh=kmin, maxkh=kmax, npoints = knum)
         return kh, powerZK[1:,:] #remove z = 0 from output
+
+    def _cached_pk(self,pk_cache,kmin,kmax,knum):
+        key = pkcache.cosmology_key(self.cc.paramDict,self.zarr,kmin,kmax,knum)
+        entry = pk_cache.get(key)
+        if entry is None:
+            t0 = time.time()
+            kh, pk = self._pk(self.zarr,kmin,kmax,knum)
+            DAz = self.cc.DA_z(self.zarr)
+            Hz = self.cc.H_z(self.zarr)/C_KM_S # h_of_z, in 1/Mpc
+            entry = {'kh':kh,'pk':pk,'s8':self.cc.s8,'DAz':DAz,'Hz':Hz}
+            pk_cache.put(key,entry,elapsed=time.time()-t0)
+        # on a hit _pk is not called, so self.cc.results is left as the
+        # background-only results of ClusterCosmology.__init__
+        # copies, so that nothing downstream can modify the cached arrays
+        self.kh = entry['kh'].copy()
+        self.pk = entry['pk'].copy()
+        self.cc.s8 = entry['s8']
+        self.DAz = entry['DAz'].copy()
+        self.Hz = entry['Hz'].copy()
     """
     def _pk2(self,zarr,kmin,kmax,knum):x
         #self.cc.pars.set_matter_power(redshifts=zarr, kmax=kmax)
@@ -403,13 +487,7 @@ class Halo_MF(object):
     
     def _initdVdz(self,z_arr):
         #dV/dzdOmega
-        DA_z = self.DAz 
-        dV_dz = DA_z**2 * (1.+z_arr)**2
-        for i in range (z_arr.size):
-            dV_dz[i] /= (self.cc.results.h_of_z(z_arr[i]))
-        dV_dz *= (self.cc.H0/100.)**3. # was h0
-        self.dVdz = dV_dz
-        #return dV_dz
+        self.dVdz = self.cc.dVdz(z_arr)
 
     def dn_dM(self,M,delta):
         # dN/dmdV
@@ -437,25 +515,25 @@ class Halo_MF(object):
     def inter_dndm(self,delta):
         #interpolating over M500c becasue that's a constant at every redshift 
         dndM = self.dn_dM(self.M200,delta)
-        ans = interp2d(self.zarr,self.M,dndM,kind='cubic',fill_value=0)
+        ans = MassFunctionGrid(self.zarr,self.M,dndM,kind='cubic',fill_value=0)
         return ans
 
     def inter_dndmLogm(self,delta):
         #interpolating over M500c becasue that's a constant vector at every redshift, log10 M500c 
         dndM = self.dn_dM(self.M200,delta)
-        ans = interp2d(self.zarr,np.log10(self.M),dndM,kind='cubic',fill_value=0)
+        ans = MassFunctionGrid(self.zarr,np.log10(self.M),dndM,kind='cubic',fill_value=0)
         return ans
 
     def inter_mf(self,delta):
         #interpolating over M500c becasue that's a constant vector at every redshift 
         N_Mz = self.N_of_Mz(self.M200,delta)
-        ans = interp2d(self.zarr,self.M,N_Mz,kind='linear',fill_value=0) 
+        ans = MassFunctionGrid(self.zarr,self.M,N_Mz,kind='linear',fill_value=0)
         return ans
 
     def inter_mf_logM(self,delta):
         #interpolating over M500c becasue that's a constant vector at every redshift
         N_Mz = self.N_of_Mz(self.M200,delta)
-        ans = interp2d(self.zarr,np.log10(self.M),N_Mz,kind='cubic',fill_value=0)
+        ans = MassFunctionGrid(self.zarr,np.log10(self.M),N_Mz,kind='cubic',fill_value=0)
         return ans
 
     def inter_Nz_logM(self,delta):
@@ -464,108 +542,64 @@ class Halo_MF(object):
         for i in range(self.zarr.size):
             N_z[:,i] *= np.diff(self.M200_edges[:,i])
         #N_z = self.N_of_Mz(self.M200,delta)*np.diff(self.M200_edges)
-        ans = interp2d(self.zarr,np.log10(self.M),N_z,kind='cubic',fill_value=0)
+        ans = MassFunctionGrid(self.zarr,np.log10(self.M),N_z,kind='cubic',fill_value=0)
         return ans
 
     def inter_mf_logMgtr(self,delta):
         #interpolating over M500c becasue that's a constant vector at every redshift
         N_Mz = np.cumsum(self.N_of_Mz(self.M200,delta),axis = 0)
-        ans = interp2d(self.zarr,np.log10(self.M),N_Mz,kind='linear',fill_value=0)
+        ans = MassFunctionGrid(self.zarr,np.log10(self.M),N_Mz,kind='linear',fill_value=0)
         return ans
 
 
-    def inter_mf_bound(self,theta,mthresh,zthresh):
-        a1,a2temp = theta
-        a2 = 10**a2temp
-        mlim = [10**mthresh[0],10**mthresh[1]]  
-        if  zthresh[0] < a1 < zthresh[1] and  mlim[0] < a2 < mlim[1]:
-            return 0
-        return -np.inf
-
-    def inter_mf_func(self,theta,inter):
-        a1,a2temp = theta
-        a2 = a2temp#10**a2temp
-        #mlim = 10**mthresh[0]
-        
-        return np.log(inter(a1,a2))#/inter(0.15,mlim))
-    
-    def mf_inter_eval(self,theta, inter, mthresh, zthresh):
-        lp = self.inter_mf_bound(theta, mthresh, zthresh)
-        if not np.isfinite(lp):
-            return -np.inf
-        return lp + self.inter_mf_func(theta,inter)
-
-    def cpsample_mf(self,delta,nsamps):
+    def cpsample_mf(self,delta,nsamps,rng=None):
+        """
+        nsamps (z, log10 M500) draws from the mass function: log10 M from
+        the cumulative counts over the mass grid, then z from the cumulative
+        counts over the z grid conditional on that mass, both inverted by
+        linear interpolation. rng is a seed or a np.random.Generator.
+        """
+        rng = sampling.get_rng(rng)
         N_z_inter = self.inter_Nz_logM(delta)
-                                                      
-        N_z = self.N_of_Mz(self.M200,delta)
-        for i in range(self.zarr.size):
-            N_z[:,i] *= np.diff(self.M200_edges[:,i])
+        N_z = self.N_of_Mz(self.M200,delta)*np.diff(self.M200_edges,axis=0)
 
-        #N_z = self.N_of_Mz(self.M200,delta)*np.diff(self.M200_edges)
-
-#        conprobx = np.cumsum(np.sum(N_Mz,axis=0)/np.sum(N_Mz))
-#        print (N_Mz.shape)
-#        print (conprobx.shape)
-#        print (self.zarr.shape)
-
-#        rand1 = np.random.uniform(np.min(conprobx),1,size=nsamps)
-#        xcond = np.interp(rand1,conprobx,self.zarr)
-
-#        ycond = []
-#        for i in xrange(len(rand1)):
-#            conproby = np.cumsum(N_mz_inter(xcond[i],np.log10(self.M))/np.sum(N_mz_inter(xcond[i],np.log10(self.M))))
-#            rand2 = np.random.uniform(np.min(conproby),1,1)
-#            ycond = np.append(ycond,np.interp(rand2,conproby,np.log10(self.M)))
-
-#        return xcond,ycond
-        
-        
-        #conprobx = ((np.sum(N_z,axis=1))) [::-1]
         conprobx = np.cumsum(np.sum(N_z,axis=1)/ np.sum(N_z))
-        #print ((np.trapz(N_Mz,axis=1,x=self.M)).shape)
-        #print ((np.sum(np.trapz(N_Mz,axis=1,x=self.M))).shape)
-
-        #conprobx = np.trapz(N_Mz,axis=1,x=self.M) / np.sum(np.trapz(N_Mz,axis=1,x=self.M))
-
-        #print (np.cumsum(np.sum(N_Mz,axis=1)))
-        #print (np.sum(N_Mz))
-
-        #print (conprobx.shape,N_z.shape)
-
-        rand1 = np.random.uniform(np.min(conprobx),1,size=nsamps)
-        #print (rand1)
-        #rand1 = np.random.uniform(np.min(conprobx),np.max(conprobx),size=nsamps)
-        #xcond = np.interp(rand1,conprobx,np.log10(self.M)[::-1])
+        rand1 = rng.uniform(np.min(conprobx),1,size=nsamps)
         xcond = np.interp(rand1,conprobx,np.log10(self.M))
 
-        #print (conprobx)
-        #print (xcond)
-
-        ycond = []
-        for i in xrange(len(rand1)):
-            conproby = np.cumsum(N_z_inter(self.zarr,xcond[i])/np.sum(N_z_inter(self.zarr,xcond[i])))
-            #print (conproby)
-            rand2 = np.random.uniform(np.min(conproby),1,1)
-            ycond = np.append(ycond,np.interp(rand2,conproby,self.zarr))
-        #print (ycond)
+        # conditional CDFs in z at all the drawn masses in one spline evaluation
+        conproby = np.cumsum(N_z_inter.ev(self.zarr[None,:],xcond[:,None]),axis=1)
+        conproby /= conproby[:,-1:]
+        rand2 = rng.uniform(conproby[:,0],1.)
+        ycond = sampling.interp_rows(rand2,conproby,self.zarr)
 
         return ycond,xcond
     
-    def mcsample_mf(self,delta,nsamp100,nwalkers=100,nburnin=50,Ndim=2,mthresh=[14.6,15.6],zthresh=[0.2,1.95]):
-        import emcee
-
-        N_mz_inter = self.inter_mf_logM(delta)
-        P0 = np.array([1.,15.5])
-        pos = [P0 + P0*2e-2*np.random.randn(Ndim) for i in range(nwalkers)]
-
-        corrlength = 50 # Roughly corresponds to number from sampler.acor
-        
-        sampler = emcee.EnsembleSampler(nwalkers,Ndim,self.mf_inter_eval, args =[N_mz_inter,mthresh,zthresh] )
-        sampler.run_mcmc(pos,corrlength*nsamp100+nburnin)
-        #print "acor", sampler.acor
-
-        return sampler.chain[:,nburnin:corrlength*nsamp100+nburnin:corrlength,:].reshape((-1,Ndim))
+    def sample_mf(self,delta,nsamps,mthresh=None,zthresh=None,rng=None):
+        """
+        (nsamps,2) array of independent (z, log10 M500) draws from the mass
+        function, restricted to the log10 M range mthresh and the z range
+        zthresh if given. The cells of the (M, z) grid are drawn with their
+        exact expected counts; within a cell log10 M follows the local power
+        law of the mass function and z is uniform. rng is a seed or a
+        np.random.Generator.
+        """
+        N = self.N_of_Mz(self.M200,delta)*np.diff(self.M200_edges,axis=0)*np.diff(self.zarr_edges)
+        logM_edges = np.log10(self.M_edges)
+        dlogM = np.diff(logM_edges)
+        # dln(dN/dlog10M)/dlog10M in every cell
+        with np.errstate(divide='ignore',invalid='ignore'):
+            slopes = np.gradient(np.log(N/dlogM[:,None]),logM_edges[:-1]+dlogM/2.,axis=0)
+        slopes[~np.isfinite(slopes)] = 0.
+        sampler = sampling.GridSampler(N,logM_edges,self.zarr_edges,x_slopes=slopes)
+        return sampler.draw(nsamps,rng,x_range=mthresh,y_range=zthresh)[:,::-1].copy()
+
+    def mcsample_mf(self,delta,nsamp100,nwalkers=100,nburnin=50,Ndim=2,mthresh=[14.6,15.6],zthresh=[0.2,1.95],rng=None):
+        # the nwalkers*nsamp100 (z, log10 M) samples of the former emcee
+        # sampler, now exact and independent (see sample_mf)
+        # nburnin and Ndim are accepted and ignored: there is no burn-in,
+        # and the samples are always (z, log10 M)
+        return self.sample_mf(delta,nwalkers*nsamp100,mthresh=mthresh,zthresh=zthresh,rng=rng)
 
     def N_of_z(self):
         # dN/dz(z) = 4pi fsky \int dm dN/dzdmdOmega
@@ -607,14 +641,9 @@ class Halo_MF(object):
         zs = self.zarr
         M = self.M
 
-        print("Calculating variance grid. This is slow...")
+        print("Calculating variance grid...")
 
-        sigN = self.zeroTemplate.copy()
-
-        for i in range(zs.size):
-            for j in range(M.size):
-                var = SZCluster.quickVar(M[j],zs[i],tmaxN,numts)
-                sigN[j,i] = np.sqrt(var)
+        sigN = np.sqrt(SZCluster.quickVarGrid(M,zs,tmaxN,numts))
              
         self.sigN = sigN.copy()
 
@@ -711,18 +740,20 @@ class Halo_MF(object):
 
         return np.sqrt(old_div(1.,err_WL_mass))*100.,Ntot
 
+    def Mwl_kernel(self,mass_err,SZCluster):
+        # K[jj,M,z] = P(Mwl_jj | M,z) dM200, the weak-lensing mass response
+        # integrated against the true mass bins
+        M_wl = 10**self.Mexp
+        dM = np.diff(self.M200_edges,axis=0)
+        K = SZCluster.Mwl_prob(M_wl[:,None,None],self.M[None,:,None],mass_err[None,:,:]) * dM[None,:,:]
+        return K
+
     def N_of_mqz_SZ (self,mass_err,q_edges,SZCluster):
         # this is 3D grid for fisher matrix
         # Index MZQ
 
         q_arr = old_div((q_edges[1:]+q_edges[:-1]),2.)
 
-        z_arr = self.zarr
-        M_arr =  np.outer(self.M,np.ones([len(z_arr)]))
-        dNdzmq = np.zeros([len(self.M),len(z_arr),len(q_arr)])
-
-        m_wl = self.Mexp
-        
         if self.sigN is None: self.updateSigN(SZCluster)
         if self.Pfunc_qarr is None: self.updatePfunc_qarr(SZCluster,q_arr)
         P_func = self.Pfunc_qarr
@@ -730,13 +761,10 @@ class Halo_MF(object):
         dn_dVdm = self.dn_dM(self.M200,200.) 
         dV_dz = self.dVdz
 
-        
-        # \int dm  dn/dzdm
-        for kk in range(q_arr.size):
-            for jj in range(m_wl.size):
-                for i in range (z_arr.size):
-                    dM = np.diff(self.M200_edges[:,i])
-                    dNdzmq[jj,i,kk] = np.dot(dn_dVdm[:,i]*P_func[:,i,kk]*SZCluster.Mwl_prob(10**(m_wl[jj]),M_arr[:,i],mass_err[:,i]),dM) * dV_dz[i]*4.*np.pi
+        # \int dm  dn/dzdm, as one batched product over z: (Mwl,M) x (M,q)
+        K = self.Mwl_kernel(mass_err,SZCluster)
+        dNdzmq = np.matmul(K.transpose(2,0,1),(dn_dVdm[:,:,None]*P_func).transpose(1,0,2)).transpose(1,0,2)
+        dNdzmq *= dV_dz[None,:,None]*4.*np.pi
         
         return dNdzmq
 
@@ -746,12 +774,6 @@ class Halo_MF(object):
 
         q_arr = old_div((q_edges[1:]+q_edges[:-1]),2.)
 
-        z_arr = self.zarr
-        M_arr =  np.outer(self.M,np.ones([len(z_arr)]))
-        dNdzmq = np.zeros([len(self.M),len(z_arr),len(q_arr)])
-
-        m_wl = self.Mexp
-        
         if self.sigN is None: self.updateSigN(SZCluster)
         if self.Pfunc_qarr_corr is None: self.updatePfunc_qarr_corr(SZCluster,q_arr)
         P_func = self.Pfunc_qarr_corr
@@ -759,56 +781,37 @@ class Halo_MF(object):
         dn_dVdm = self.dn_dM(self.M200,200.)
         dV_dz = self.dVdz
 
-        
-        # \int dm  dn/dzdm
-        for kk in range(q_arr.size):
-            for jj in range(m_wl.size):
-                for i in range (z_arr.size):
-                    dM = np.diff(self.M200_edges[:,i])
-                    dNdzmq[jj,i,kk] = np.dot(dn_dVdm[:,i]*P_func[:,i,kk,jj]*SZCluster.Mwl_prob(10**(m_wl[jj]),M_arr[:,i],mass_err[:,i]),dM) * dV_dz[i]*4.*np.pi
+        # \int dm  dn/dzdm, one contraction per z so each slice of the
+        # (M,z,q,Mwl) cube is read once in memory order
+        K = self.Mwl_kernel(mass_err,SZCluster)*dn_dVdm[None,:,:]
+        dNdzmq = np.zeros([len(self.M),len(self.zarr),P_func.shape[2]])
+        for i in range(self.zarr.size):
+            dNdzmq[:,i,:] = np.einsum('jm,mkj->jk',K[:,:,i],P_func[:,i])
+        dNdzmq *= dV_dz[None,:,None]*4.*np.pi
         
         return dNdzmq
 
     
     def Cl_ell(self,ell,SZCluster):
-        #fix the mass and redshift ranges 
-        M = self.M#10**np.arange(11.0, 16, .1)
-        #dM = np.gradient(M)
-        
-        #zmax = 6.0
-        #zmin = 0.01
+        """
+        One-halo tSZ power spectrum C_ell^yy at the multipoles ell, integrated
+        over the mass and redshift grid of this Halo_MF (z=0 is skipped).
+        """
+        ell = np.atleast_1d(ell)
+        M = self.M
         z_arr = self.zarr
         dz = np.gradient(z_arr)
-        #delz = (zmax-zmin)/100. # 140 redshift restriction
-        #zbin_temp = np.arange(zmin,zmax,delz)
-        #z_arr = np.insert(zbin_temp,0,0.0)
-        #dz = np.diff(z_arr)
-        #ell = np.arange(1000,3000,1000)
-        
-        M200 = np.outer(M,np.zeros([len(z_arr)]))
-        dM200 = np.outer(M,np.zeros([len(z_arr)]))
+        Mnoh = old_div(M,(old_div(self.cc.H0,100.)))
+
+        M200 = self.cc.Mass_con_del_2_del_mean200(Mnoh[:,None],500,z_arr[None,:])
+        # y profile form factors on the (ell,M,z) grid
         formfac = np.zeros((len(ell),len(M),len(z_arr)))
-        
-#        np.outer(ell,np.outer(M,np.zeros([len(z_arr)])))
-        #print formfac.shape
-        
-        for i in range (z_arr.size):
-            M200[:,i] = self.cc.Mass_con_del_2_del_mean200(old_div(M,(old_div(self.cc.H0,100.))),500,z_arr[i])
-            dM200[:,i] = np.gradient(M200[:,i])
-            if (i > 0): 
-                for j in range (len(M)):
-                    for k in range (len(ell)):
-                        formfac[k,j,i] = SZCluster.Prof_tilde(ell[k],old_div(M[j],(old_div(self.cc.H0,100.))),z_arr[i])
-        
+        formfac[:,:,1:] = SZCluster.Prof_tilde(ell[:,None,None],Mnoh[:,None],z_arr[None,1:])
+
         dn_dm = self.dn_dM(M200,200.)
         dV_dz = self.dVdz
-        
-        ans = np.zeros(len(ell))
-        for k in range (len(ell)):
-            for i in range (z_arr.size):
-                ans[k] += 4*np.pi *dV_dz[i] * dz[i] * np.trapz( dn_dm[:,i] * formfac[k,:,i]**2,M200[:,i])
-        #print dn_dm.shape, formfac.shape
-        #ans  =1.    
+        integrand = np.trapz(dn_dm * formfac**2,M200[None,:,:],axis=1)
+        ans = 4*np.pi*np.dot(integrand,dV_dz*dz)
         return ans
 
     def linBias(self,Masses):
@@ -825,7 +828,7 @@ class Halo_MF(object):
         
         M = np.outer(Masses,np.ones([len(z_arr)]))
         R = tinker.radius_from_mass(M,self.cc.rhoc0om)
-        sigsq = tinker.sigma_sq_integral(R, self.pk, self.kh)
+        sigsq = tinker.sigma_sq_batched(R, self.pk, self.kh)
         
         return 1. + (old_div(((ac*(dc**2.)/sigsq)-1.),dc)) + 2.*pc/(dc*(1.+(ac*dc*dc/sigsq)**pc))
 
@@ -0,0 +1,173 @@
+"""
+Archive of the cluster count cubes N(M,z,q) used for Fisher forecasts.
+
+One archive per saveId replaces the loose N_mzq_*_fid, Nup_mzq_*, Ndn_mzq_*
+and dNdp_mzq_* .npy files. An archive is a directory with one group
+subdirectory per kind of cube
+
+    grid.npz          mass, redshift and q bin edges and the config hash
+    fid/<tag>.npy     fiducial counts ("fid" for the main fiducial, or e.g.
+                      "fid_sigma8", "wa_fid" for the ones made alongside
+                      special derivatives)
+    up/<param>.npy    counts with param stepped up by half a step
+    dn/<param>.npy    counts with param stepped down by half a step
+    deriv/<param>.npy dN/dparam
+    step/<param>.npy  step size used for param
+
+so every parameter is a separate chunk. Uncompressed cubes are read as
+memory maps and only the slice asked for is loaded. Cubes can be stored as
+float32 and/or compressed (.npz, read in full) to cut disk use for large
+grids. Every file is written under a temporary name and renamed, so ranks
+writing different parameters into the same archive never see partial files.
+"""
+from __future__ import print_function
+from __future__ import division
+from builtins import object
+from past.utils import old_div
+import numpy as np
+import hashlib
+import os
+
+def archive_path(bigDataDir,saveId):
+    return bigDataDir+"derivs_"+saveId
+
+def config_hash(Config,sections=None):
+    """
+    Hash of the contents of the given sections of a ConfigParser
+    (all sections if None).
+    """
+    if sections is None: sections = Config.sections()
+    hinval = ""
+    for section in sorted(sections):
+        hinval += "["+section+"]"
+        for key,val in sorted(Config.items(section)):
+            hinval += key+"="+val+";"
+    return hashlib.md5(hinval.encode('utf-8')).hexdigest()
+
+class DerivArchive(object):
+    def __init__(self,path,dtype=np.float64,compress=False):
+        """
+        path      archive directory (see archive_path)
+        dtype     storage dtype of cubes written (np.float64 or np.float32);
+                  reads always return float64
+        compress  write cubes as compressed .npz instead of .npy
+        """
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.compress = compress
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.path,"grid.npz"))
+
+    def _file(self,group,name,compressed):
+        return os.path.join(self.path,group,name+(".npz" if compressed else ".npy"))
+
+    def _write(self,group,name,arr,dtype=None,compress=None):
+        if compress is None: compress = self.compress
+        if dtype is None: dtype = self.dtype
+        gdir = os.path.join(self.path,group)
+        if not os.path.exists(gdir): os.makedirs(gdir)
+        arr = np.asarray(arr).astype(dtype)
+        filename = self._file(group,name,compress)
+        tmp = filename+".tmp"+str(os.getpid())+(".npz" if compress else ".npy")
+        if compress:
+            np.savez_compressed(tmp,arr=arr)
+        else:
+            np.save(tmp,arr)
+        os.replace(tmp,filename)
+        # drop a stale copy in the other format
+        other = self._file(group,name,not(compress))
+        if os.path.exists(other): os.remove(other)
+
+    def _read(self,group,name,sl=None,mmap=True):
+        filename = self._file(group,name,False)
+        if os.path.exists(filename):
+            arr = np.load(filename,mmap_mode='r' if mmap else None)
+        elif os.path.exists(self._file(group,name,True)):
+            with np.load(self._file(group,name,True)) as data:
+                arr = data['arr']
+        else:
+            raise KeyError(group+"/"+name+" not found in "+self.path)
+        if sl is not None: arr = arr[sl]
+        return np.array(arr,dtype=np.float64)
+
+    def _names(self,group):
+        gdir = os.path.join(self.path,group)
+        if not os.path.exists(gdir): return []
+        return sorted(set(os.path.splitext(f)[0] for f in os.listdir(gdir) if ".tmp" not in f))
+
+    def save_grid(self,mexp_edges,z_edges,qbin_edges,confighash=""):
+        """
+        Grid edges and config hash. Raises ValueError if the archive
+        already holds a different grid or config.
+        """
+        if self.exists():
+            old_m,old_z,old_q,old_hash = self.grid(return_hash=True)
+            same = (old_m.shape==np.shape(mexp_edges) and old_z.shape==np.shape(z_edges) and old_q.shape==np.shape(qbin_edges)
+                    and np.allclose(old_m,mexp_edges) and np.allclose(old_z,z_edges) and np.allclose(old_q,qbin_edges))
+            if not(same) or (old_hash!=confighash):
+                raise ValueError(self.path+" was written for a different grid or config. Remove it first.")
+            return
+        if not os.path.exists(self.path): os.makedirs(self.path)
+        filename = os.path.join(self.path,"grid.npz")
+        tmp = filename+".tmp"+str(os.getpid())+".npz"
+        np.savez(tmp,mexp_edges=mexp_edges,z_edges=z_edges,qbin_edges=qbin_edges,config_hash=confighash)
+        os.replace(tmp,filename)
+
+    def grid(self,return_hash=False):
+        """
+        Returns mexp_edges, z_edges, qbin_edges (and the config hash).
+        """
+        with np.load(os.path.join(self.path,"grid.npz")) as data:
+            ret = (data['mexp_edges'],data['z_edges'],data['qbin_edges'])
+            if return_hash: ret = ret + (str(data['config_hash']),)
+        return ret
+
+    def save_fid(self,Nmzq,tag="fid"):
+        self._write("fid",tag,Nmzq)
+
+    def save_param(self,param,Nup,Ndn,step):
+        """
+        Stores the up and down cubes of param and its derivative
+        (Nup-Ndn)/step, computed in double precision.
+        """
+        self._write("up",param,Nup)
+        self._write("dn",param,Ndn)
+        self._write("deriv",param,old_div((np.asarray(Nup,dtype=np.float64)-Ndn),step))
+        self._write("step",param,step,dtype=np.float64,compress=False)
+
+    def fid(self,tag="fid",sl=None,mmap=True):
+        return self._read("fid",tag,sl,mmap)
+
+    def up(self,param,sl=None,mmap=True):
+        return self._read("up",param,sl,mmap)
+
+    def dn(self,param,sl=None,mmap=True):
+        return self._read("dn",param,sl,mmap)
+
+    def deriv(self,param,sl=None,mmap=True):
+        """
+        dN/dparam as float64. sl is an index or tuple of slices into the
+        (M,z,q) cube; only that part is read for uncompressed archives.
+        """
+        return self._read("deriv",param,sl,mmap)
+
+    def step(self,param):
+        return float(self._read("step",param,mmap=False))
+
+    def params(self):
+        return self._names("deriv")
+
+    def fid_tags(self):
+        return self._names("fid")
+
+    def export_npy(self,bigDataDir,saveId):
+        """
+        Writes the archive out as the legacy per-parameter .npy files.
+        """
+        for tag in self.fid_tags():
+            np.save(bigDataDir+"N_mzq_"+saveId+"_"+tag+".npy",self.fid(tag,mmap=False))
+        for param in self.params():
+            np.save(bigDataDir+"Nup_mzq_"+saveId+"_"+param+".npy",self.up(param,mmap=False))
+            np.save(bigDataDir+"Ndn_mzq_"+saveId+"_"+param+".npy",self.dn(param,mmap=False))
+            np.save(bigDataDir+"dNdp_mzq_"+saveId+"_"+param+".npy",self.deriv(param,mmap=False))
@@ -0,0 +1,361 @@
+"""
+Cluster count derivatives as a farm of independent tasks.
+
+Every (parameter, up/down, redshift block) is one task that computes the
+counts N(M,z,q) in that block of redshifts, so the derivatives for any
+number of parameters can be spread over any number of MPI ranks or local
+processes with taskfarm.run_tasks. Finished tasks are checkpointed in the
+derivative archive, so an interrupted run picks up where it stopped, and
+assembled derivatives go into the archive (see derivarchive). Each parameter
+list has its own checkpoint directory, so jobs for different parameters of
+the same saveId can run at the same time.
+
+Besides the parameters with step sizes in the [params] section of the ini
+file, these special derivatives are supported
+
+    S8All   overall amplitude of the linear power spectrum
+    S8Z     amplitude of the power spectrum in each redshift bin
+            (S8Z0, S8Z1, ... may also be asked for individually)
+    w0_ppf  w0 with PPF power spectra read from waDerivRoot
+    wa      wa with PPF power spectra read from waDerivRoot
+    sigR    CMB lensing mass calibration with the up/down Ray grids
+
+The S8Z derivative in bin i only changes the counts in that bin, so its
+tasks only compute that one redshift and take the rest from the fiducial.
+Every task, the S8 ones included, uses N_of_mqz_SZ_corr when ywl_corr_flag
+is 1 in [general]. (The old makeS8Derivs always used N_of_mqz_SZ, which
+made its S8 derivatives inconsistent with the fiducial and the other
+derivatives in that case.)
+The fiducial power spectrum is shared between tasks through the CAMB
+power spectrum cache (see pkcache), which is kept on disk in the archive
+so that all workers reuse it.
+"""
+from __future__ import print_function
+from __future__ import division
+from builtins import str
+from builtins import range
+from past.utils import old_div
+import numpy as np
+import pickle as pickle
+import argparse
+import hashlib
+import os
+from szar.counts import ClusterCosmology,Halo_MF,getNmzq
+from szar.szproperties import SZ_Cluster_Model
+from szar import pkcache
+from szar import taskfarm
+import szar.fisher as sfisher
+
+# step in the power spectrum amplitude used for S8All and S8Z
+s8_step = 0.05
+ppf_params = ['w0_ppf','wa']
+
+def deriv_setup(iniFile,expName,gridName,calName,calFile=None,need_sigR=False):
+    """
+    Everything a task needs from the ini file and grids, as a picklable dict.
+    """
+    from configparser import SafeConfigParser
+    from orphics.io import dict_from_section, list_from_config
+
+    Config = SafeConfigParser()
+    Config.optionxform=str
+    Config.read(iniFile)
+    bigDataDir = Config.get('general','bigDataDirectory')
+    version = Config.get('general','version')
+
+    fparams = {}
+    stepSizes = {}
+    for (key, val) in Config.items('params'):
+        if ',' in val:
+            param, step = val.split(',')
+            fparams[key] = float(param)
+            stepSizes[key] = float(step)
+        else:
+            fparams[key] = float(val)
+
+    mgrid,zgrid,siggrid = pickle.load(open(bigDataDir+"szgrid_"+expName+"_"+gridName+ "_v" + version+".pkl",'rb'))
+    if calFile is not None:
+        mexp_edges, z_edges, lndM = pickle.load(open(calFile,"rb"))
+    else:
+        mexp_edges, z_edges, lndM = mgrid, zgrid, None
+    assert np.all(np.isclose(mgrid,mexp_edges))
+    assert np.all(np.isclose(z_edges,zgrid))
+
+    if need_sigR:
+        mexp_up, z_up, lndMUp = pickle.load(open(sfisher.mass_grid_name_cmb_up(bigDataDir,expName,gridName,calName,version),"rb"))
+        mexp_dn, z_dn, lndMDn = pickle.load(open(sfisher.mass_grid_name_cmb_dn(bigDataDir,expName,gridName,calName,version),"rb"))
+        for edges in [mexp_up,mexp_dn]: assert np.all(np.isclose(edges,mexp_edges))
+        for edges in [z_up,z_dn]: assert np.all(np.isclose(edges,z_edges))
+    else:
+        lndMUp = None
+        lndMDn = None
+
+    try:
+        waDerivRoot = bigDataDir+Config.get('general','waDerivRoot')
+    except:
+        waDerivRoot = None
+    try:
+        v3mode = Config.getint(expName,'V3mode')
+    except:
+        v3mode = -1
+
+    # get s/n q-bins
+    qs = list_from_config(Config,'general','qbins')
+    qspacing = Config.get('general','qbins_spacing')
+    if qspacing=="log":
+        qbin_edges = np.logspace(np.log10(qs[0]),np.log10(qs[1]),int(qs[2])+1)
+    elif qspacing=="linear":
+        qbin_edges = np.linspace(qs[0],qs[1],int(qs[2])+1)
+    else:
+        raise ValueError
+
+    saveId = sfisher.save_id(expName,gridName,calName,version)
+    return {'Config':Config,'bigDataDir':bigDataDir,'saveId':saveId,'expName':expName,'gridName':gridName,
+            'fparams':fparams,'stepSizes':stepSizes,
+            'constDict':dict_from_section(Config,'constants'),
+            'clusterDict':dict_from_section(Config,'cluster_params'),
+            'beam':list_from_config(Config,expName,'beams'),
+            'noise':list_from_config(Config,expName,'noises'),
+            'freq':list_from_config(Config,expName,'freqs'),
+            'lknee':list_from_config(Config,expName,'lknee')[0],
+            'alpha':list_from_config(Config,expName,'alpha')[0],
+            'fsky':Config.getfloat(expName,'fsky'),
+            'v3mode':v3mode,
+            'clttfile':Config.get('general','clttfile'),
+            'massMultiplier':Config.getfloat('general','mass_calib_factor'),
+            'YWLcorrflag':Config.getfloat('general','ywl_corr_flag'),
+            'mexp_edges':mexp_edges,'z_edges':z_edges,'qbin_edges':qbin_edges,
+            'lndM':lndM,'lndMUp':lndMUp,'lndMDn':lndMDn,'siggrid':siggrid,
+            'waDerivRoot':waDerivRoot,'pk_cache_dir':None}
+
+def step_size(setup,param):
+    if param=='S8All' or param.startswith('S8Z'): return s8_step
+    if param=='w0_ppf': return setup['stepSizes']['w0']
+    return setup['stepSizes'][param]
+
+def expand_params(setup,inParamList):
+    """
+    Parameter names to compute derivatives for. allParams is every
+    parameter with a step size (except manualParams), S8Z is one S8Z<i>
+    per redshift bin.
+    """
+    Config = setup['Config']
+    nz = setup['z_edges'].size-1
+    if inParamList[0]=="allParams":
+        assert len(inParamList)==1, "I'm confused why you'd specify more params with allParams."
+        manualParamList = Config.get('general','manualParams').split(',')
+        return [p for p in setup['stepSizes'].keys() if p not in manualParamList]
+    params = []
+    for param in inParamList:
+        if param=='S8Z':
+            params += ["S8Z"+str(i) for i in range(nz)]
+        elif param in ['S8All','sigR']+ppf_params:
+            params.append(param)
+        elif param.startswith('S8Z'):
+            assert int(param[3:]) in range(nz), param + " is not a redshift bin."
+            params.append(param)
+        else:
+            assert param in setup['stepSizes'], param + " not found in ini file with a specified step size."
+            params.append(param)
+    return params
+
+def z_blocks(nz,nblocks):
+    """
+    (i0,i1) index ranges of nblocks nearly equal blocks of nz redshift bins.
+    """
+    bounds = np.linspace(0,nz,min(nblocks,nz)+1).round().astype(int)
+    return [(int(bounds[i]),int(bounds[i+1])) for i in range(bounds.size-1)]
+
+def make_tasks(params,nz,nblocks,need_fid=True):
+    """
+    Tasks are (param, sign, i0, i1): the counts with param stepped by
+    sign*step/2 in redshift bins i0 to i1-1. ("fid", 0, i0, i1) are the
+    fiducial counts.
+    """
+    blocks = z_blocks(nz,nblocks)
+    tasks = []
+    if need_fid: tasks += [("fid",0,i0,i1) for i0,i1 in blocks]
+    for param in params:
+        for sign in [1,-1]:
+            if param.startswith('S8Z'):
+                i = int(param[3:])
+                tasks.append((param,sign,i,i+1))
+            else:
+                tasks += [(param,sign,i0,i1) for i0,i1 in blocks]
+    return tasks
+
+def checkpoint_path(archive_path,params):
+    """
+    Checkpoint directory of a run over params, inside the archive.
+    """
+    key = hashlib.md5(",".join(sorted(params)).encode('utf-8')).hexdigest()
+    return os.path.join(archive_path,"tasks",key)
+
+def remove_task_files(checkpoint_dir,tasks):
+    for task in tasks:
+        filename = task_file(checkpoint_dir,task)
+        if os.path.exists(filename): os.remove(filename)
+
+def task_file(checkpoint_dir,task):
+    param,sign,i0,i1 = task
+    return os.path.join(checkpoint_dir,"%s_%s_z%04d-%04d.npy" % (param,{1:"up",-1:"dn",0:"fid"}[sign],i0,i1))
+
+_setup = None
+_fid_pk = None
+
+def init_worker(setup):
+    # worker initializer: keep the setup and share CAMB results through
+    # the on-disk power spectrum cache
+    global _setup, _fid_pk
+    _setup = setup
+    _fid_pk = None
+    if setup['pk_cache_dir'] is not None: pkcache.set_cache_dir(setup['pk_cache_dir'])
+
+def fiducial_pk(setup):
+    # kh and P(z,k) of the fiducial cosmology on the full redshift grid
+    global _fid_pk
+    if _fid_pk is None:
+        cc = ClusterCosmology(setup['fparams'].copy(),setup['constDict'],clTTFixFile=setup['clttfile'])
+        HMF = Halo_MF(cc,setup['mexp_edges'],setup['z_edges'])
+        _fid_pk = (HMF.kh.copy(),HMF.pk.copy())
+    return _fid_pk
+
+def ppf_pk(setup,param,sign,zcents):
+    step = step_size(setup,param)
+    fileSuff = "Up" if sign>0 else "Dn"
+    if param=='w0_ppf':
+        pFile = lambda z: setup['waDerivRoot']+str(step)+fileSuff+"_w_matterpower_%.2f.dat" % z
+    else:
+        pFile = lambda z: setup['waDerivRoot']+str(step)+fileSuff+"_matterpower_"+str(z)+".dat"
+    for inum,z in enumerate(zcents):
+        kh,p = np.loadtxt(pFile(z),unpack=True)
+        if inum==0:
+            khorig = kh.copy()
+            pk = np.zeros((zcents.size,kh.size))
+        assert np.all(np.isclose(kh,khorig))
+        pk[inum,:] = p.copy()
+    return khorig, pk
+
+def task_counts(setup,task):
+    """
+    N(M,z,q) of task in its redshift block.
+    """
+    param,sign,i0,i1 = task
+    z_edges = setup['z_edges'][i0:i1+1]
+    passParams = setup['fparams'].copy()
+    lndM = setup['lndM']
+    kh = None
+    pk = None
+    if param=='sigR':
+        lndM = setup['lndMUp'] if sign>0 else setup['lndMDn']
+    elif param=='S8All' or param.startswith('S8Z'):
+        kh, pk = fiducial_pk(setup)
+        pk = pk[i0:i1]*(1.+sign*old_div(s8_step,2.))**2.
+    elif param in ppf_params:
+        if param=='w0_ppf': passParams['w0'] += sign*old_div(step_size(setup,param),2.)
+        zcents = old_div((setup['z_edges'][1:]+setup['z_edges'][:-1]),2.)
+        kh, pk = ppf_pk(setup,param,sign,zcents[i0:i1])
+    elif param!='fid':
+        passParams[param] += sign*old_div(step_size(setup,param),2.)
+
+    cc = ClusterCosmology(passParams,setup['constDict'],clTTFixFile=setup['clttfile'])
+    HMF = Halo_MF(cc,setup['mexp_edges'],z_edges,kh=kh,powerZK=pk)
+    HMF.sigN = setup['siggrid'][:,i0:i1].copy()
+    SZProf = SZ_Cluster_Model(cc,setup['clusterDict'],rms_noises=setup['noise'],fwhms=setup['beam'],freqs=setup['freq'],
+                              lknee=setup['lknee'],alpha=setup['alpha'],v3mode=setup['v3mode'],fsky=setup['fsky'])
+    mass_err = lndM[:,i0:i1]*setup['massMultiplier']
+    if (setup['YWLcorrflag'] == 1):
+        dN_dmqz = HMF.N_of_mqz_SZ_corr(mass_err,setup['qbin_edges'],SZProf)
+    else:
+        dN_dmqz = HMF.N_of_mqz_SZ(mass_err,setup['qbin_edges'],SZProf)
+    return getNmzq(dN_dmqz,setup['mexp_edges'],z_edges,setup['qbin_edges'])
+
+def run_task(task):
+    return task_counts(_setup,task)
+
+def assemble(setup,archive,params,checkpoint_dir,tasks):
+    """
+    Puts the checkpointed task results together into the fiducial and
+    up/down cubes, and saves them and the derivatives in the archive.
+    """
+    mexp_edges = setup['mexp_edges']
+    shape = (mexp_edges.size-1,setup['z_edges'].size-1,setup['qbin_edges'].size-1)
+
+    def cube(param,sign,base=None):
+        N = np.zeros(shape) if base is None else base.copy()
+        for task in tasks:
+            if task[0]==param and task[1]==sign:
+                N[:,task[2]:task[3],:] = np.load(task_file(checkpoint_dir,task))
+        return N
+
+    if any(t[0]=="fid" for t in tasks):
+        archive.save_fid(cube("fid",0))
+    fid = archive.fid(mmap=False) if "fid" in archive.fid_tags() else None
+    # fiducials that the special derivative scripts used to save separately
+    if fid is not None:
+        for param,tag in [('S8All',"fid_sigma8"),('w0_ppf',"w0_ppf_fid"),('wa',"wa_fid")]:
+            if param in params or (param=='S8All' and any(p.startswith('S8Z') for p in params)):
+                archive.save_fid(fid,tag)
+    for param in params:
+        base = fid if param.startswith('S8Z') else None
+        archive.save_param(param,cube(param,1,base),cube(param,-1,base),step_size(setup,param))
+        print("Saved derivative for ",param)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Calculate cluster count derivatives as a farm of tasks.')
+    parser.add_argument("paramList", type=str,help='Comma separated params, allParams, or special derivatives S8All, S8Z, w0_ppf, wa, sigR.')
+    parser.add_argument("expName", type=str,help='Experiment section in the ini file.')
+    parser.add_argument("gridName", type=str,help='Grid section in the ini file.')
+    parser.add_argument("calName", type=str,help='Name of the calibration used in saved files.')
+    parser.add_argument("calFile", type=str,nargs='?',default=None,help='Pickle file of the mass calibration error (not needed for sigR alone).')
+    parser.add_argument("--ini", type=str, default="input/pipeline.ini",help="ini file.")
+    parser.add_argument("--pool", type=str, default="mpi", choices=["serial","process","mpi"],help="Run tasks serially, on a local process pool, or over MPI ranks (run under mpirun).")
+    parser.add_argument("--nprocs", type=int, default=None,help="Number of processes for --pool process. Defaults to the number of cores.")
+    parser.add_argument("--zblocks", type=int, default=1,help="Split each up/down calculation into this many redshift blocks.")
+    parser.add_argument("--restart", action='store_true',help='Discard checkpointed tasks and recompute everything.')
+    parser.add_argument("--pk-cache-dir", type=str, default=None,help="Directory for the on-disk CAMB power spectrum cache. Defaults to one inside the archive.")
+    args = parser.parse_args(argv)
+
+    if args.pool=="mpi":
+        from mpi4py import MPI
+        rank = MPI.COMM_WORLD.Get_rank()
+    else:
+        rank = 0
+
+    setup = None
+    tasks = []
+    if rank==0:
+        inParamList = args.paramList.split(',')
+        setup = deriv_setup(args.ini,args.expName,args.gridName,args.calName,args.calFile,need_sigR=('sigR' in inParamList))
+        params = expand_params(setup,inParamList)
+        print(params)
+        archive = sfisher.deriv_archive_from_config(setup['Config'],setup['bigDataDir'],setup['saveId'],args.expName,args.gridName,
+                                                    setup['mexp_edges'],setup['z_edges'],setup['qbin_edges'])
+        checkpoint_dir = checkpoint_path(archive.path,params)
+        if not os.path.exists(checkpoint_dir): os.makedirs(checkpoint_dir)
+        setup['pk_cache_dir'] = args.pk_cache_dir if args.pk_cache_dir is not None else os.path.join(archive.path,"pkcache")
+        # the Config object is only needed here
+        setup.pop('Config')
+        if setup['lndM'] is None:
+            assert all(p=='sigR' for p in params), "calFile is needed for everything but sigR."
+
+        # the fiducial is reused if it is already in the archive
+        need_fid = setup['lndM'] is not None and (args.restart or "fid" not in archive.fid_tags())
+        all_tasks = make_tasks(params,setup['z_edges'].size-1,args.zblocks,need_fid=need_fid)
+        if args.restart: remove_task_files(checkpoint_dir,all_tasks)
+        tasks = [t for t in all_tasks if not os.path.exists(task_file(checkpoint_dir,t))]
+        print(len(all_tasks)-len(tasks)," of ",len(all_tasks)," tasks already done.")
+
+    def on_result(task,result):
+        filename = task_file(checkpoint_dir,task)
+        tmp = filename+".tmp"+str(os.getpid())+".npy"
+        np.save(tmp,result)
+        os.replace(tmp,filename)
+
+    taskfarm.run_tasks(run_task,tasks,on_result,pool=args.pool,nprocs=args.nprocs,
+                       initializer=init_worker,initargs=(setup,),name="derivative task")
+
+    if rank==0:
+        assemble(setup,archive,params,checkpoint_dir,all_tasks)
+        remove_task_files(checkpoint_dir,all_tasks)
+        if not os.listdir(checkpoint_dir): os.rmdir(checkpoint_dir)
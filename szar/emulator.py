@@ -1,5 +1,7 @@
+from __future__ import print_function
 import numpy as np
 from szar import counts
+from szar.sampling import GridSampler, get_rng
 from orphics import cosmology as cosmo,io
 from scipy.interpolate import interp2d
 from enlib import bench
@@ -22,20 +24,15 @@ class NmzEmulator(object):
         self.zcents = (self.z_edges[1:]+self.z_edges[:-1])/2.
         self.ntot = self.Nmz.sum()
         self.cc = cc
+        self.sampler = GridSampler(self.Nmz,self.Mexp_edges,self.z_edges)
 
     def get_catalog(self,poisson=False,seed=None):
-        np.random.seed(seed)
-        nclusters = int(np.random.poisson(self.ntot)) if poisson else int(self.ntot)
-        mzs = np.zeros((nclusters,2),dtype=np.float32)
-        print("Generating Nmz catalog...",nclusters)
-        for i in range(nclusters):
-            linear_idx = np.random.choice(self.Nmz.size, p=self.Nmz.ravel()/float(self.Nmz.sum()))
-            x, y = np.unravel_index(linear_idx, self.Nmz.shape)
-            # mzs[i,0] = self.Mexpcents[x]
-            # mzs[i,1] = self.zcents[y]
-            mzs[i,0] = np.random.uniform(self.Mexpcents[x].min(),self.Mexpcents[x].max())
-            mzs[i,1] = np.random.uniform(self.zcents[y].min(),self.zcents[y].max())
-        return mzs
+        # seed is a seed or a np.random.Generator; the (log10 M, z) of the
+        # clusters are uniform within their grid cells
+        rng = get_rng(seed)
+        ncells = self.sampler.counts(rng,poisson=poisson)
+        print("Generating Nmz catalog...",ncells.sum())
+        return self.sampler.place(ncells,rng).astype(np.float32)
 
 def lnlike(nobs,ntheory):
     lnfactorial = lambda x : x*np.log(x) - x
@@ -49,7 +46,7 @@ def main():
 
     emu = NmzEmulator(Mexp_edges,z_edges)
     mzs = emu.get_catalog(poisson=True)
-    print mzs
+    print(mzs)
     pdf2d,_,_ = np.histogram2d(mzs[:,0],mzs[:,1],bins=(Mexp_edges,z_edges))
     print (emu.Nmz.sum(),pdf2d.sum(),lnlike(pdf2d,emu.Nmz))
 
@@ -3,14 +3,15 @@ from __future__ import division
 from builtins import str
 from builtins import range
 from past.utils import old_div
-import itertools
 from szar.counts import rebinN
 import numpy as np
 from orphics.io import dict_from_section, list_from_config
 from szar.counts import ClusterCosmology,Halo_MF
 from szar.szproperties import SZ_Cluster_Model
+from szar.derivarchive import DerivArchive, archive_path, config_hash
 import pickle as pickle
 import traceback
+import os
 
 
 def marginalized_errs(Fisher,paramList):
@@ -70,6 +71,37 @@ def get_sovernsquare(expName,gridName,version,qbins):
     sovernsquare =  np.dstack([sovernsquareEach]*len(qbins))
     return sovernsquare
 
+def sample_var_grid_name(bigDataDir,expName,gridName,version):
+    # the (M,z) grid of b^2 sigma^2(z) written by bin/makeSampleVarianceGrid.py
+    return bigDataDir+"sampleVarGrid_"+expName + "_" + gridName  + "_v" + version+".txt"
+def sample_var_cov_name(bigDataDir,expName,gridName,version):
+    # the (z,z) shell covariance written by bin/makeSampleVarianceGrid.py
+    return bigDataDir+"sampleVarCov_"+expName + "_" + gridName  + "_v" + version+".txt"
+def sample_var_bias_name(bigDataDir,expName,gridName,version):
+    # the (M,z) halo bias written by bin/makeSampleVarianceGrid.py
+    return bigDataDir+"sampleVarBias_"+expName + "_" + gridName  + "_v" + version+".txt"
+
+def sample_variance_weights(N_fid,bias,pzcutoff,z_edges,fsky):
+    """
+    Columns W of the super sample covariance W S W^T of the rebinned counts
+    (see fisher_from_stack). Column k holds fsky N b of redshift shell k,
+    rebinned with rebinN like the counts, so the shells merged above
+    pzcutoff keep their own columns.
+
+    N_fid   (M,z,q) fiducial counts on the full grid (before rebinN and fsky)
+    bias    (M,z) halo bias; with sqrt of the makeSampleVarianceGrid.py grid
+            (b sigma(z)) and S the identity this is the Hu & Kravtsov 2003
+            term N_fid*N_fid*sovernsquare within each shell
+    """
+    NB = N_fid*np.asarray(bias)[:,:,None]*fsky
+    cols = []
+    for k in range(NB.shape[1]):
+        shell = np.zeros(NB.shape)
+        shell[:,k,:] = NB[:,k,:]
+        new_z_edges, shell = rebinN(shell,pzcutoff,z_edges)
+        cols.append(shell.ravel())
+    return np.array(cols).T
+
 def save_id(expName,gridName,calName,version):
     saveId = expName + "_" + gridName + "_" + calName + "_v" + version
     return saveId
@@ -77,6 +109,54 @@ def deriv_root(bigDataDir,saveId):
     return bigDataDir+"dNdp_mzq_"+saveId+"_"
 def fid_file(bigDataDir,saveId):
     return bigDataDir+"N_mzq_"+saveId+"_fid"+".npy"
+def deriv_archive(bigDataDir,saveId):
+    return DerivArchive(archive_path(bigDataDir,saveId))
+def deriv_sources(bigDataDir,saveId):
+    # derivatives of saveId, looked up per parameter in the archive and
+    # then in the legacy per-parameter .npy files (see load_deriv)
+    return [deriv_archive(bigDataDir,saveId),deriv_root(bigDataDir,saveId)]
+
+def fid_counts(bigDataDir,saveId,tag="fid"):
+    """
+    The fiducial counts cube tag ("fid", "fid_sigma8", ...) of saveId, from
+    the derivative archive if it has it, else from the legacy
+    N_mzq_<saveId>_<tag>.npy file.
+    """
+    archive = deriv_archive(bigDataDir,saveId)
+    if tag in archive.fid_tags(): return archive.fid(tag,mmap=False)
+    return np.load(bigDataDir+"N_mzq_"+saveId+"_"+tag+".npy")
+
+def load_deriv(derivRoot,param,mmap=False):
+    """
+    dN/dparam from derivRoot: a DerivArchive, the root of the per-parameter
+    .npy files (see deriv_root), or a list of these tried in order.
+    """
+    sources = derivRoot if isinstance(derivRoot,(list,tuple)) else [derivRoot]
+    for source in sources:
+        if isinstance(source,DerivArchive):
+            if param in source.params(): return source.deriv(param,mmap=mmap)
+        elif os.path.exists(source+param+".npy"):
+            return np.load(source+param+".npy",mmap_mode='r' if mmap else None)
+    raise KeyError("No derivative of "+param+" found.")
+
+def deriv_archive_from_config(Config,bigDataDir,saveId,expName,gridName,mexp_edges,z_edges,qbin_edges):
+    """
+    Opens the derivative archive of saveId for writing, with the storage
+    options deriv_archive_dtype (float64/float32) and deriv_archive_compress
+    from the [general] section, and records the grid and config hash.
+    """
+    try:
+        dtype = Config.get('general','deriv_archive_dtype')
+    except:
+        dtype = 'float64'
+    try:
+        compress = Config.getboolean('general','deriv_archive_compress')
+    except:
+        compress = False
+    archive = DerivArchive(archive_path(bigDataDir,saveId),dtype=dtype,compress=compress)
+    archive.save_grid(mexp_edges,z_edges,qbin_edges,
+                      config_hash(Config,['params','constants','cluster_params',expName,gridName]))
+    return archive
 
 def counts_from_config(Config,bigDataDir,version,expName,gridName,mexp_edges,z_edges,lkneeTOverride=None,alphaTOverride=None):
     suffix = ""
@@ -159,7 +239,7 @@ def sel_counts_from_config(Config,bigDataDir,version,expName,gridName,calName,me
         dN_dmqz = hmf.N_of_mqz_SZ(lndM,qbin_edges,SZProf)
         nmzq = counts.getNmzq(dN_dmqz,mexp_edges,z_edges,qbin_edges)
     else:
-        nmzq = np.load(fid_file(bigDataDir,saveId))
+        nmzq = fid_counts(bigDataDir,saveId)
     nmzq = nmzq*fsky
 
     zs = (z_edges[1:]+z_edges[:-1])/2.
@@ -273,9 +353,27 @@ def cluster_fisher_from_config(Config,expName,gridName,calName,fishName,
     
 
     saveId = save_id(expName,gridName,calName,version)
-    derivRoot = deriv_root(bigDataDir,saveId)
+    # Derivatives come from the archive, parameter by parameter, else from
+    # the per-parameter .npy files
+    derivRoot = deriv_sources(bigDataDir,saveId)
+    N_fid = fid_counts(bigDataDir,saveId)
+    try:
+        do_sample_variance = Config.getboolean(fishSection,"sample_variance")
+    except:
+        do_sample_variance = False
+    sv_weights = None
+    sv_cov = None
+    if do_sample_variance:
+        # the full shell covariance if there is one, else the diagonal grid
+        covFile = sample_var_cov_name(bigDataDir,expName,gridName,version)
+        if os.path.exists(covFile):
+            sv_cov = np.loadtxt(covFile)
+            bias = np.loadtxt(sample_var_bias_name(bigDataDir,expName,gridName,version))
+        else:
+            bias = np.sqrt(np.loadtxt(sample_var_grid_name(bigDataDir,expName,gridName,version)))
+        sv_weights = sample_variance_weights(N_fid,bias,pzcutoff,z_edges,fsky)
     # Fiducial number counts
-    new_z_edges, N_fid = rebinN(np.load(fid_file(bigDataDir,saveId)),pzcutoff,z_edges)#,mass_bin=None)
+    new_z_edges, N_fid = rebinN(N_fid,pzcutoff,z_edges)#,mass_bin=None)
     N_fid = N_fid*fsky
 
 
@@ -302,7 +400,7 @@ def cluster_fisher_from_config(Config,expName,gridName,calName,fishName,
         paramList = paramList+zlist
 
     
-    Fisher = getFisher(N_fid,paramList,priorNameList,priorValueList,derivRoot,pzcutoff,z_edges,fsky)
+    Fisher = getFisher(N_fid,paramList,priorNameList,priorValueList,derivRoot,pzcutoff,z_edges,fsky,sv_weights=sv_weights,sv_cov=sv_cov)
 
     # Number of non-SZ params (params that will be in Planck/BAO)
     numCosmo = Config.getint(fishSection,'numCosmo')
@@ -427,45 +525,85 @@ def cluster_fisher_from_config(Config,expName,gridName,calName,fishName,
 
 
 
-def getFisher(N_fid,paramList,priorNameList,priorValueList,derivRoot,pzcutoff,z_edges,fsky):
-    numParams = len(paramList)
-    Fisher = np.zeros((numParams,numParams))
-    paramCombs = itertools.combinations_with_replacement(paramList,2)
-    for param1,param2 in paramCombs:
-        i = paramList.index(param1)
-        j = paramList.index(param2)
-        if not(param1=='tau' or param2=='tau'):
-            ppfstr1 = ""
-            ppfstr2 = ""
-            
-            new_z_edges, dN1 = rebinN(np.load(derivRoot+param1+ppfstr1+".npy"),pzcutoff,z_edges)#,mass_bin=None)
-            new_z_edges, dN2 = rebinN(np.load(derivRoot+param2+ppfstr2+".npy"),pzcutoff,z_edges)#,mass_bin=None)
-            dN1 = dN1*fsky
-            dN2 = dN2*fsky
+def stack_derivs(paramList,derivRoot,pzcutoff,z_edges,fsky,mmap=False,stack_file=None):
+    """
+    Loads and rebins each derivative dN/dp_mzq once and returns them
+    stacked as a (P, M, z, q) array in the order of paramList. tau has no
+    cluster count derivative and gets a row of zeros. derivRoot is the
+    root of the per-parameter .npy files (see deriv_root), a DerivArchive,
+    or a list of these tried in order for every parameter (see
+    deriv_sources).
+
+    mmap        memory-map the .npy files instead of reading them in full
+    stack_file  if given, the stack is an on-disk .npy memmap at this path,
+                so that only one derivative is resident at a time
+    """
+    stack = None
+    for i,param in enumerate(paramList):
+        if param=='tau': continue
+        dN = load_deriv(derivRoot,param,mmap=mmap)
+        new_z_edges, dN = rebinN(dN,pzcutoff,z_edges)#,mass_bin=None)
+        assert not(np.any(np.isnan(dN)))
+        if stack is None:
+            shape = (len(paramList),)+dN.shape
+            if stack_file is None:
+                stack = np.zeros(shape)
+            else:
+                stack = np.lib.format.open_memmap(stack_file,mode='w+',dtype=np.float64,shape=shape)
+                stack[:] = 0.
+        stack[i] = dN*fsky
+    if stack is None: raise ValueError("No derivatives to load in paramList.")
+    return stack
+
+
+def fisher_from_stack(dNs,N_fid,chunk_size=2**20,sv_weights=None,sv_cov=None):
+    """
+    Fisher matrix sum_mzq dN_a dN_b / N_fid from a (P, M, z, q) stack of
+    derivatives, contracted over chunk_size bins at a time.
 
+    With sv_weights W (bins, K) (see sample_variance_weights) the count
+    covariance is diag(N_fid) + W S W^T, i.e. Poisson plus super sample
+    variance with the (K, K) shell covariance S (sv_cov, the identity if
+    None). Its inverse is applied with the Woodbury identity,
 
-            assert not(np.any(np.isnan(dN1)))
-            assert not(np.any(np.isnan(dN2)))
-            assert not(np.any(np.isnan(N_fid)))
+        F = D N^-1 D^T - G^T S (1 + A S)^-1 G
+        G = W^T N^-1 D^T,  A = W^T N^-1 W
 
+    so G and A are accumulated in the same pass over the stack and the
+    only solve is K x K.
+    """
+    assert not(np.any(np.isnan(N_fid)))
+    numParams = dNs.shape[0]
+    with np.errstate(divide='ignore'):
+        invN = np.nan_to_num(old_div(1.,N_fid)).ravel()
+    dNs = dNs.reshape((numParams,invN.size))
+    Fisher = np.zeros((numParams,numParams))
+    if sv_weights is not None:
+        W = np.asarray(sv_weights).reshape((invN.size,-1))
+        G = np.zeros((W.shape[1],numParams))
+        A = np.zeros((W.shape[1],W.shape[1]))
+    for k in range(0,invN.size,chunk_size):
+        block = np.asarray(dNs[:,k:k+chunk_size])
+        Fisher += np.dot(block*invN[k:k+chunk_size],block.T)
+        if sv_weights is not None:
+            WinvN = W[k:k+chunk_size].T*invN[k:k+chunk_size]
+            G += np.dot(WinvN,block.T)
+            A += np.dot(WinvN,W[k:k+chunk_size])
+    if sv_weights is not None:
+        S = np.eye(A.shape[0]) if sv_cov is None else np.atleast_2d(sv_cov)
+        Fisher -= np.dot(G.T,np.dot(S,np.linalg.solve(np.eye(A.shape[0])+np.dot(A,S),G)))
+    return Fisher
 
-            with np.errstate(divide='ignore'):
-                FellBlock = dN1*dN2*np.nan_to_num(old_div(1.,(N_fid)))#+(N_fid*N_fid*sovernsquare)))
-            #Ncollapsed = N_fid.sum(axis=0).sum(axis=-1)
-            #print N_fid[np.where(Ncollapsed<1.)].sum() ," clusters fall in bins where N<1"
-            #FellBlock[np.where(Ncollapsed<1.)] = 0.
-            Fell = FellBlock.sum()
-        else:
-            Fell = 0.
 
-        if i==j and (param1 in priorNameList):
-            priorIndex = priorNameList.index(param1)
-            priorVal = old_div(1.,priorValueList[priorIndex]**2.)
-        else:
-            priorVal = 0.
+def getFisher(N_fid,paramList,priorNameList,priorValueList,derivRoot,pzcutoff,z_edges,fsky,mmap=False,stack_file=None,
+              sv_weights=None,sv_cov=None):
+    # sv_weights and sv_cov add super sample variance (see fisher_from_stack)
+    dNs = stack_derivs(paramList,derivRoot,pzcutoff,z_edges,fsky,mmap=mmap,stack_file=stack_file)
+    Fisher = fisher_from_stack(dNs,N_fid,sv_weights=sv_weights,sv_cov=sv_cov)
 
-        Fisher[i,j] = Fell+priorVal
-        if j!=i: Fisher[j,i] = Fell
+    for i,param in enumerate(paramList):
+        if param in priorNameList:
+            priorIndex = priorNameList.index(param)
+            Fisher[i,i] += old_div(1.,priorValueList[priorIndex]**2.)
 
-    
     return Fisher
@@ -0,0 +1,63 @@
+"""
+Linear growth factor and growth rate from the background expansion.
+
+For a background with E(a) = H(a)/H0 the growing mode is (Heath 1977)
+
+    D(a) = 5 Om/2 E(a) I(a),    I(a) = int_0^a da'/(a' E(a'))^3
+
+and the growth rate follows from the same integral,
+
+    f(a) = dlnD/dlna = dlnE/dlna + 1/(a^2 E^3 I(a)).
+
+GrowthTable tabulates I on a grid in ln a once per cosmology (a cumulative
+spline quadrature over a few thousand E evaluations) so that D and f at any
+array of redshifts are spline lookups. ClusterCosmology.growthfunc and
+fgrowth use the table it keeps in ClusterCosmology.growth_table.
+"""
+from __future__ import print_function
+from __future__ import division
+from builtins import object
+import numpy as np
+from scipy.interpolate import CubicSpline
+
+class GrowthTable(object):
+    def __init__(self,E_z,Om,amin=1.e-6,amax=1.,dlna=5.e-3):
+        """
+        E_z    function returning H(z)/H0 for an array of redshifts
+        Om     matter density today
+        amin   lower limit of the I(a) integral
+        amax   largest scale factor tabulated
+        dlna   spacing of the ln a grid
+        """
+        self.Om = Om
+        self.amin = amin
+        self.amax = amax
+        lna = np.linspace(np.log(amin),np.log(amax),int(np.ceil(np.log(amax/amin)/dlna))+1)
+        a = np.exp(lna)
+        E = np.asarray(E_z(1./a-1.))
+        # dI/dlna = 1/(a^2 E^3)
+        I = CubicSpline(lna,1./(a**2.*E**3.)).antiderivative()(lna)
+        self.lnE = CubicSpline(lna,np.log(E))
+        self.dlnE = self.lnE.derivative()
+        self.lnI = CubicSpline(lna[1:],np.log(I[1:]))
+        self.E_z = E_z
+
+    def _lna(self,z):
+        lna = -np.log1p(np.asarray(z,dtype=np.float64))
+        if np.any(lna>np.log(self.amax)+1.e-12) or np.any(lna<self.lnI.x[0]):
+            raise ValueError("Redshift outside of the tabulated growth range.")
+        return lna
+
+    def D(self,z):
+        """
+        Growth factor D(z), normalized to a in matter domination.
+        """
+        lna = self._lna(z)
+        return 5.*self.Om/2.*np.asarray(self.E_z(z))*np.exp(self.lnI(lna))
+
+    def f(self,z):
+        """
+        Growth rate dlnD/dlna at z.
+        """
+        lna = self._lna(z)
+        return self.dlnE(lna) + np.exp(-2.*lna-3.*self.lnE(lna)-self.lnI(lna))
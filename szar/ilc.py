@@ -26,8 +26,41 @@ def constweightcalculator(f_1,f_2,N):
     W=M/C
     return W
 
+def _solve_stack(N,fs):
+    # N^-1 f for every covariance in a (nl,nf,nf) stack and every f in fs,
+    # as a (nl,nf,len(fs)) array
+    F = np.broadcast_to(np.array(fs).T,(N.shape[0],N.shape[1],len(fs)))
+    return np.linalg.solve(N,F)
+
+def weightcalculator_batched(f,N):
+    """
+    weightcalculator for a (nl,nf,nf) stack of covariances N.
+    Returns the (nl,nf) weights.
+    """
+    Ninv_f = _solve_stack(N,[f])[:,:,0]
+    return Ninv_f/np.dot(Ninv_f,f)[:,None]
+
+def constweightcalculator_batched(f_1,f_2,N):
+    """
+    constweightcalculator for a (nl,nf,nf) stack of covariances N (not
+    their inverses). Returns the (nl,nf) weights.
+    """
+    X = _solve_stack(N,[f_1,f_2])
+    Ninv_f1 = X[:,:,0]
+    Ninv_f2 = X[:,:,1]
+    f2Nf1 = np.dot(Ninv_f1,f_2)
+    f2Nf2 = np.dot(Ninv_f2,f_2)
+    f1Nf1 = np.dot(Ninv_f1,f_1)
+    C = f2Nf1*f2Nf2 - f2Nf1**2
+    M = f1Nf1[:,None]*Ninv_f2 - f2Nf2[:,None]*Ninv_f1
+    return M/C[:,None]
+
+def ilc_noise_batched(W,N):
+    # W^T N W for every ell
+    return np.einsum('li,lij,lj->l',W,N,W)
+
 class ILC_simple(object):
-    def __init__(self,clusterCosmology, fgs,fwhms=[1.5],rms_noises =[1.], freqs = [150.],lmax=8000,lknee=0.,alpha=1.,dell=1.,v3mode=-1):
+    def __init__(self,clusterCosmology, fgs,fwhms=[1.5],rms_noises =[1.], freqs = [150.],lmax=8000,lknee=0.,alpha=1.,dell=1.,v3mode=-1,fsky=None):
         
         #Inputs
         #clusterCosmology is a class that contains cosmological parameters and power spectra.
@@ -38,27 +71,12 @@ class ILC_simple(object):
         #initial set up for ILC
         self.cc = clusterCosmology
 
-        #initializing the frequency matrices
-        if (len(freqs) > 1):
-            fq_mat   = np.matlib.repmat(freqs,len(freqs),1) 
-            fq_mat_t = np.transpose(np.matlib.repmat(freqs,len(freqs),1))
-        else:
-            fq_mat   = freqs
-            fq_mat_t = freqs
-
         self.fgs = fgs
 
     
         self.dell = dell
         #set-up ells to evaluate up to lmax
         self.evalells = np.arange(2,lmax,self.dell)
-        self.N_ll_noILC = self.evalells*0.0
-        self.N_ll_tsz = self.evalells*0.0
-        self.N_ll_cmb = self.evalells*0.0
-        self.N_ll_rsx = self.evalells*0.0
-        self.N_ll_cmb_c_tsz = self.evalells*0.0
-        self.N_ll_tsz_c_cmb = self.evalells*0.0
-        self.N_ll_tsz_c_cib = self.evalells*0.0
 
         #Only for SO forecasts, including the SO atmosphere modeling
         if v3mode>-1:
@@ -86,152 +104,68 @@ class ILC_simple(object):
                 v3ell, N_ell_T_LA, N_ell_P_LA, Map_white_noise_levels = v3.AdvACT_noise(f_sky=fsky,ell_max=v3lmax+v3dell,delta_ell=\
 v3dell)
 
-        #initializing the weighting functions for the ilc
-        #thermal SZ weights
-        self.W_ll_tsz = np.zeros([len(self.evalells),len(np.array(freqs))])
-        #CMB weights
-        self.W_ll_cmb = np.zeros([len(self.evalells),len(np.array(freqs))])
-        #rayleigh scattering cross correlation weights
-        self.W_ll_rsx = np.zeros([len(self.evalells),len(np.array(freqs))])
-        #thermal SZ constraining the CIB weights 
-        self.W_ll_tsz_c_cib = np.zeros([len(self.evalells),len(np.array(freqs))])
-        #thermal SZ constraining the CMB weights 
-        self.W_ll_tsz_c_cmb = np.zeros([len(self.evalells),len(np.array(freqs))])
-        #CMB constraining the thermal SZ weights 
-        self.W_ll_cmb_c_tsz = np.zeros([len(self.evalells),len(np.array(freqs))])
         self.freq = freqs
+        freqs = np.array(freqs)
+        nfreqs = freqs.size
 
         #frequency functions for
-        f_nu_tsz = f_nu(self.cc.c,np.array(freqs)) #tSZ
+        f_nu_tsz = f_nu(self.cc.c,freqs) #tSZ
         f_nu_cmb = f_nu_tsz*0.0 + 1. #CMB
-        f_nu_cib = self.fgs.f_nu_cib(np.array(freqs)) #CIB
-        f_nu_rsx = self.fgs.rs_nu(np.array(freqs)) #Rayleigh Cross
-
-        for ii in range(len(self.evalells)):
-
-            cmb_els = fq_mat*0.0 + self.cc.clttfunc(self.evalells[ii])
-            
-            if v3mode < 0:
-                inst_noise = ( old_div(noise_func(self.evalells[ii],np.array(fwhms),np.array(rms_noises),lknee,alpha,dimensionless=False), self.cc.c['TCMBmuK']**2.))
-                nells = np.diag(inst_noise)
-            elif v3mode<=2:
-                ndiags = []
-                for ff in range(len(freqs)):
-                    inst_noise = old_div(N_ell_T_LA[ff,ii], self.cc.c['TCMBmuK']**2.)
-                    ndiags.append(inst_noise)
-                nells = np.diag(np.array(ndiags))
-                # Adding in atmo. freq-freq correlations 
-                #nells[0,1] = N_ell_T_LA[6,ii]/ self.cc.c['TCMBmuK']**2.
-                #nells[1,0] = N_ell_T_LA[6,ii]/ self.cc.c['TCMBmuK']**2.
-                #nells[2,3] = N_ell_T_LA[7,ii]/ self.cc.c['TCMBmuK']**2.
-                #nells[3,2] = N_ell_T_LA[7,ii]/ self.cc.c['TCMBmuK']**2.
-                #nells[4,5] = N_ell_T_LA[8,ii]/ self.cc.c['TCMBmuK']**2.
-                #nells[5,4] = N_ell_T_LA[8,ii]/ self.cc.c['TCMBmuK']**2.
-
-            elif v3mode==3:
-                ndiags = []
-                for ff in range(len(freqs)):
-                    inst_noise = old_div(N_ell_T_LA[ff,ii], self.cc.c['TCMBmuK']**2.)
-                    ndiags.append(inst_noise)
-                nells = np.diag(np.array(ndiags))
-                # Adding in atmo. freq-freq correlations
-                #nells[0,1] = N_ell_T_LA[5,ii]/ self.cc.c['TCMBmuK']**2.
-                #nells[1,0] = N_ell_T_LA[5,ii]/ self.cc.c['TCMBmuK']**2.
-                #nells[2,3] = N_ell_T_LA[6,ii]/ self.cc.c['TCMBmuK']**2.
-                #nells[3,2] = N_ell_T_LA[6,ii]/ self.cc.c['TCMBmuK']**2.
-                #nells[3,4] = N_ell_T_LA[7,ii]/ self.cc.c['TCMBmuK']**2.
-                #nells[4,3] = N_ell_T_LA[7,ii]/ self.cc.c['TCMBmuK']**2.
-
-            self.N_ll_noILC[ii] = nells[3,3]
-
-            totfg = (self.fgs.rad_pst(self.evalells[ii],fq_mat,fq_mat_t) + self.fgs.cib_p(self.evalells[ii],fq_mat,fq_mat_t) +
-                      self.fgs.cib_c(self.evalells[ii],fq_mat,fq_mat_t) + self.fgs.tSZ_CIB(self.evalells[ii],fq_mat,fq_mat_t)) \
-                      / self.cc.c['TCMBmuK']**2. / ((self.evalells[ii]+1.)*self.evalells[ii]) * 2.* np.pi 
-
-            totfgrs = (self.fgs.rad_ps(self.evalells[ii],fq_mat,fq_mat_t) + self.fgs.cib_p(self.evalells[ii],fq_mat,fq_mat_t) +
-                       self.fgs.cib_c(self.evalells[ii],fq_mat,fq_mat_t) + self.fgs.rs_auto(self.evalells[ii],fq_mat,fq_mat_t) + \
-                       self.fgs.tSZ_CIB(self.evalells[ii],fq_mat,fq_mat_t)) \
-                      / self.cc.c['TCMBmuK']**2. / ((self.evalells[ii]+1.)*self.evalells[ii] ) * 2.* np.pi 
-
-            totfg_cib = (self.fgs.rad_ps(self.evalells[ii],fq_mat,fq_mat_t) + self.fgs.tSZ_CIB(self.evalells[ii],fq_mat,fq_mat_t)) \
-                      / self.cc.c['TCMBmuK']**2. / ((self.evalells[ii]+1.)*self.evalells[ii]) * 2.* np.pi
-
-
-            ksz = fq_mat*0.0 + self.fgs.ksz_temp(self.evalells[ii]) / self.cc.c['TCMBmuK']**2. / ((self.evalells[ii]+1.)*self.evalells[ii]) * 2.* np.pi
-
-            tsz = self.fgs.tSZ(self.evalells[ii],fq_mat,fq_mat_t) / self.cc.c['TCMBmuK']**2. / ((self.evalells[ii]+1.)*self.evalells[ii]) * 2.* np.pi            
-
-            cib = (self.fgs.cib_p(self.evalells[ii],fq_mat,fq_mat_t) + self.fgs.cib_c(self.evalells[ii],fq_mat,fq_mat_t)) \
-                     / self.cc.c['TCMBmuK']**2. / ((self.evalells[ii]+1.)*self.evalells[ii]) * 2.* np.pi
-
-            N_ll_for_tsz = nells + totfg + cmb_els + ksz 
-            N_ll_for_cmb = nells + totfg + tsz + ksz 
-            N_ll_for_rsx = nells + totfg + tsz + ksz + cmb_els
-
-            N_ll_for_tsz_c_cmb = nells + totfg 
-            N_ll_for_cmb_c_tsz = N_ll_for_tsz_c_cmb + ksz
-            N_ll_for_tsz_c_cib = nells + totfg_cib + cmb_els + ksz
-
-            N_ll_for_tsz_inv = np.linalg.inv(N_ll_for_tsz)
-            N_ll_for_cmb_inv = np.linalg.inv(N_ll_for_cmb)
-            N_ll_for_rsx_inv = np.linalg.inv(N_ll_for_rsx)
-            N_ll_for_tsz_c_cmb_inv = np.linalg.inv(N_ll_for_tsz_c_cmb)
-            N_ll_for_cmb_c_tsz_inv = N_ll_for_tsz_c_cmb_inv
-            N_ll_for_tsz_c_cib_inv = np.linalg.inv(N_ll_for_tsz_c_cib)
-
-            self.W_ll_tsz[ii,:]=weightcalculator(f_nu_tsz,N_ll_for_tsz)
-            self.W_ll_rsx[ii,:]=weightcalculator(f_nu_rsx,N_ll_for_rsx)
-            self.W_ll_cmb[ii,:]=weightcalculator(f_nu_cmb,N_ll_for_cmb)
-            self.N_ll_tsz[ii] = np.dot(np.transpose(self.W_ll_tsz[ii,:]),np.dot(N_ll_for_tsz,self.W_ll_tsz[ii,:]))
-            self.N_ll_cmb[ii] = np.dot(np.transpose(self.W_ll_cmb[ii,:]),np.dot(N_ll_for_cmb,self.W_ll_cmb[ii,:]))
-            self.N_ll_rsx[ii] = np.dot(np.transpose(self.W_ll_rsx[ii,:]),np.dot(N_ll_for_rsx,self.W_ll_rsx[ii,:]))
-            self.W_ll_tsz_c_cmb[ii,:]=constweightcalculator(f_nu_cmb,f_nu_tsz,N_ll_for_tsz_c_cmb_inv)
-            self.W_ll_tsz_c_cib[ii,:]=constweightcalculator(f_nu_cib,f_nu_tsz,N_ll_for_tsz_c_cib_inv)
-            self.W_ll_cmb_c_tsz[ii,:]=constweightcalculator(f_nu_tsz,f_nu_cmb,N_ll_for_cmb_c_tsz_inv)
-            self.N_ll_tsz_c_cmb[ii] = np.dot(np.transpose(self.W_ll_tsz_c_cmb[ii,:]),np.dot(N_ll_for_tsz_c_cmb,self.W_ll_tsz_c_cmb[ii,:]))
-            self.N_ll_cmb_c_tsz[ii] = np.dot(np.transpose(self.W_ll_cmb_c_tsz[ii,:]),np.dot(N_ll_for_cmb_c_tsz,self.W_ll_cmb_c_tsz[ii,:]))
-            self.N_ll_tsz_c_cib[ii] = np.dot(np.transpose(self.W_ll_tsz_c_cib[ii,:]),np.dot(N_ll_for_tsz_c_cib,self.W_ll_tsz_c_cib[ii,:]))
-
-            '''
-            self.W_ll_tsz[ii,:] = 1./np.dot(np.transpose(f_nu_tsz),np.dot(N_ll_for_tsz_inv,f_nu_tsz)) \
-                                  * np.dot(np.transpose(f_nu_tsz),N_ll_for_tsz_inv)
-            self.W_ll_cmb[ii,:] = 1./np.dot(np.transpose(f_nu_cmb),np.dot(N_ll_for_cmb_inv,f_nu_cmb)) \
-                                  * np.dot(np.transpose(f_nu_cmb),N_ll_for_cmb_inv)
-            self.W_ll_rsx[ii,:] = 1./np.dot(np.transpose(f_nu_rsx),np.dot(N_ll_for_rsx_inv,f_nu_rsx)) \
-                                  * np.dot(np.transpose(f_nu_rsx),N_ll_for_rsx_inv)
-
-            self.N_ll_tsz[ii] = np.dot(np.transpose(self.W_ll_tsz[ii,:]),np.dot(N_ll_for_tsz,self.W_ll_tsz[ii,:]))
-            self.N_ll_cmb[ii] = np.dot(np.transpose(self.W_ll_cmb[ii,:]),np.dot(N_ll_for_cmb,self.W_ll_cmb[ii,:]))
-            self.N_ll_rsx[ii] = np.dot(np.transpose(self.W_ll_rsx[ii,:]),np.dot(N_ll_for_rsx,self.W_ll_rsx[ii,:]))
-
-            self.W_ll_tsz_c_cmb[ii,:] = old_div((np.dot(np.transpose(f_nu_cmb),np.dot(N_ll_for_tsz_c_cmb_inv,f_nu_cmb)) \
-                                             * np.dot(np.transpose(f_nu_tsz),N_ll_for_tsz_c_cmb_inv) \
-                                             - np.dot(np.transpose(f_nu_tsz),np.dot(N_ll_for_tsz_c_cmb_inv,f_nu_cmb)) \
-                                             * np.dot(np.transpose(f_nu_cmb),N_ll_for_tsz_c_cmb_inv)), \
-                                        (np.dot(np.transpose(f_nu_cmb),np.dot(N_ll_for_tsz_c_cmb_inv,f_nu_cmb)) \
-                                             * np.dot(np.transpose(f_nu_tsz),np.dot(N_ll_for_tsz_c_cmb_inv,f_nu_tsz)) \
-                                             - (np.dot(np.transpose(f_nu_tsz),np.dot(N_ll_for_tsz_c_cmb_inv,f_nu_cmb)))**2))
-
-            self.W_ll_tsz_c_cib[ii,:] = old_div((np.dot(np.transpose(f_nu_cib),np.dot(N_ll_for_tsz_c_cib_inv,f_nu_cib)) \
-                                             * np.dot(np.transpose(f_nu_tsz),N_ll_for_tsz_c_cib_inv) \
-                                             - np.dot(np.transpose(f_nu_tsz),np.dot(N_ll_for_tsz_c_cib_inv,f_nu_cib)) \
-                                             * np.dot(np.transpose(f_nu_cib),N_ll_for_tsz_c_cib_inv)), \
-                                        (np.dot(np.transpose(f_nu_cib),np.dot(N_ll_for_tsz_c_cib_inv,f_nu_cib)) \
-                                             * np.dot(np.transpose(f_nu_tsz),np.dot(N_ll_for_tsz_c_cib_inv,f_nu_tsz)) \
-                                             - (np.dot(np.transpose(f_nu_tsz),np.dot(N_ll_for_tsz_c_cib_inv,f_nu_cib)))**2))
-
-            self.W_ll_cmb_c_tsz[ii,:] = old_div((np.dot(np.transpose(f_nu_tsz),np.dot(N_ll_for_cmb_c_tsz_inv,f_nu_tsz)) \
-                                             * np.dot(np.transpose(f_nu_cmb),N_ll_for_cmb_c_tsz_inv) \
-                                             - np.dot(np.transpose(f_nu_cmb),np.dot(N_ll_for_cmb_c_tsz_inv,f_nu_tsz)) \
-                                             * np.dot(np.transpose(f_nu_tsz),N_ll_for_cmb_c_tsz_inv)), \
-                                        (np.dot(np.transpose(f_nu_cmb),np.dot(N_ll_for_cmb_c_tsz_inv,f_nu_cmb)) \
-                                             * np.dot(np.transpose(f_nu_tsz),np.dot(N_ll_for_cmb_c_tsz_inv,f_nu_tsz)) \
-                                             - (np.dot(np.transpose(f_nu_cmb),np.dot(N_ll_for_cmb_c_tsz_inv,f_nu_tsz)))**2))
-
-            self.N_ll_tsz_c_cmb[ii] = np.dot(np.transpose(self.W_ll_tsz_c_cmb[ii,:]),np.dot(N_ll_for_tsz_c_cmb,self.W_ll_tsz_c_cmb[ii,:]))
-            self.N_ll_cmb_c_tsz[ii] = np.dot(np.transpose(self.W_ll_cmb_c_tsz[ii,:]),np.dot(N_ll_for_cmb_c_tsz,self.W_ll_cmb_c_tsz[ii,:]))
-            self.N_ll_tsz_c_cib[ii] = np.dot(np.transpose(self.W_ll_tsz_c_cib[ii,:]),np.dot(N_ll_for_tsz_c_cib,self.W_ll_tsz_c_cib[ii,:]))
-            '''
+        f_nu_cib = self.fgs.f_nu_cib(freqs) #CIB
+        f_nu_rsx = self.fgs.rs_nu(freqs) #Rayleigh Cross
+
+        #All ells at once: foregrounds and covariances are (nell,nfreq,nfreq) stacks
+        ells = self.evalells
+        ells3 = ells[:,None,None]
+        fq_mat   = freqs[None,:]
+        fq_mat_t = freqs[:,None]
+        #converts l(l+1)C_l/2pi in muK^2 to dimensionless C_l
+        ellfac = (2.* np.pi / self.cc.c['TCMBmuK']**2. / ((ells+1.)*ells))[:,None,None]
+
+        cmb_els = self.cc.clttfunc(ells)[:,None,None]
+
+        if v3mode < 0:
+            inst_noise = np.array([noise_func(ells,fwhm,rms_noise,lknee,alpha,dimensionless=False) for fwhm,rms_noise in zip(fwhms,rms_noises)]).T
+        else:
+            inst_noise = N_ell_T_LA[:nfreqs,:ells.size].T
+            # Adding in atmo. freq-freq correlations would go here, e.g. for v3mode<=2
+            #nells[:,0,1] = nells[:,1,0] = N_ell_T_LA[6,:]/ self.cc.c['TCMBmuK']**2.
+        nells = old_div(inst_noise, self.cc.c['TCMBmuK']**2.)[:,:,None]*np.eye(nfreqs)
+
+        self.N_ll_noILC = nells[:,3,3]
+
+        totfg = (self.fgs.rad_ps(ells3,fq_mat,fq_mat_t) + self.fgs.cib_p(ells3,fq_mat,fq_mat_t) +
+                 self.fgs.cib_c(ells3,fq_mat,fq_mat_t) + self.fgs.tSZ_CIB(ells3,fq_mat,fq_mat_t)) * ellfac
+
+        totfg_cib = (self.fgs.rad_ps(ells3,fq_mat,fq_mat_t) + self.fgs.tSZ_CIB(ells3,fq_mat,fq_mat_t)) * ellfac
+
+        ksz = self.fgs.ksz_temp(ells)[:,None,None] * ellfac
+
+        tsz = self.fgs.tSZ(ells3,fq_mat,fq_mat_t) * ellfac
+
+        N_ll_for_tsz = nells + totfg + cmb_els + ksz 
+        N_ll_for_cmb = nells + totfg + tsz + ksz 
+        N_ll_for_rsx = nells + totfg + tsz + ksz + cmb_els
+
+        N_ll_for_tsz_c_cmb = nells + totfg 
+        N_ll_for_cmb_c_tsz = N_ll_for_tsz_c_cmb + ksz
+        N_ll_for_tsz_c_cib = nells + totfg_cib + cmb_els + ksz
+
+        #ILC weights, solved for all ells in one batch
+        self.W_ll_tsz = weightcalculator_batched(f_nu_tsz,N_ll_for_tsz)
+        self.W_ll_rsx = weightcalculator_batched(f_nu_rsx,N_ll_for_rsx)
+        self.W_ll_cmb = weightcalculator_batched(f_nu_cmb,N_ll_for_cmb)
+        self.N_ll_tsz = ilc_noise_batched(self.W_ll_tsz,N_ll_for_tsz)
+        self.N_ll_cmb = ilc_noise_batched(self.W_ll_cmb,N_ll_for_cmb)
+        self.N_ll_rsx = ilc_noise_batched(self.W_ll_rsx,N_ll_for_rsx)
+        #constrained ILC weights. The CMB constrained tSZ weights use the
+        #tSZ constrained CMB covariance (without kSZ)
+        self.W_ll_tsz_c_cmb = constweightcalculator_batched(f_nu_cmb,f_nu_tsz,N_ll_for_tsz_c_cmb)
+        self.W_ll_tsz_c_cib = constweightcalculator_batched(f_nu_cib,f_nu_tsz,N_ll_for_tsz_c_cib)
+        self.W_ll_cmb_c_tsz = constweightcalculator_batched(f_nu_tsz,f_nu_cmb,N_ll_for_tsz_c_cmb)
+        self.N_ll_tsz_c_cmb = ilc_noise_batched(self.W_ll_tsz_c_cmb,N_ll_for_tsz_c_cmb)
+        self.N_ll_cmb_c_tsz = ilc_noise_batched(self.W_ll_cmb_c_tsz,N_ll_for_cmb_c_tsz)
+        self.N_ll_tsz_c_cib = ilc_noise_batched(self.W_ll_tsz_c_cib,N_ll_for_tsz_c_cib)
 
     def Noise_ellyy(self,constraint='None'):
         if (constraint=='None'):
@@ -403,43 +337,35 @@ class ILC_simple_pol(object):
 
         self.cc = clusterCosmology
 
-        if (len(freqs) > 1):
-            fq_mat   = np.matlib.repmat(freqs,len(freqs),1) 
-            fq_mat_t = np.transpose(np.matlib.repmat(freqs,len(freqs),1))
-        else:
-            fq_mat   = freqs
-            fq_mat_t = freqs
-
         self.fgs = fgNoises(self.cc.c,ksz_file=ksz_file,ksz_p_file=ksz_p_file,tsz_cib_file=tsz_cib_file,tsz_battaglia_template_csv="data/sz_template_battaglia.csv")
         
         self.dell = dell
         self.evalells = np.arange(2,lmax,self.dell)
-        self.N_ll_cmb = self.evalells*0.0
 
-        self.W_ll_cmb = np.zeros([len(self.evalells),len(np.array(freqs))])
         self.freq = freqs
+        freqs = np.array(freqs)
+        nfreqs = freqs.size
 
-        f_nu_cmb = f_nu_tsz*0.0 + 1.
+        f_nu_cmb = np.ones(nfreqs)
 
-        for ii in range(len(self.evalells)):
-            cmb_els = fq_mat*0.0 + self.cc.cleefunc(self.evalells[ii])
-            ## MAKE POL NOISE
-            inst_noise = ( old_div(noise_func(self.evalells[ii],np.array(fwhms),np.array(rms_noises),lknee,alpha,dimensionless=False), self.cc.c['TCMBmuK']**2.))
-        
-            nells = np.diag(inst_noise)
-            
-            totfg = (self.fgs.rad_pol_ps(self.evalells[ii],fq_mat,fq_mat_t) + \
-                         self.fgs.gal_dust_pol(self.evalells[ii],fq_mat,fq_mat_t) + \
-                         self.fgs.gal_sync_pol(self.evalells[ii],fq_mat,fq_mat_t))
+        #All ells at once: covariances are (nell,nfreq,nfreq) stacks
+        ells = self.evalells
+        ells3 = ells[:,None,None]
+        fq_mat   = freqs[None,:]
+        fq_mat_t = freqs[:,None]
 
-            N_ll_for_cmb = nells + totfg
+        ## MAKE POL NOISE
+        inst_noise = np.array([noise_func(ells,fwhm,rms_noise,lknee,alpha,dimensionless=False) for fwhm,rms_noise in zip(fwhms,rms_noises)]).T
+        nells = old_div(inst_noise, self.cc.c['TCMBmuK']**2.)[:,:,None]*np.eye(nfreqs)
 
-            N_ll_for_cmb_inv = np.linalg.inv(N_ll_for_cmb)
+        totfg = (self.fgs.rad_pol_ps(ells3,fq_mat,fq_mat_t) + \
+                     self.fgs.gal_dust_pol(ells3,fq_mat,fq_mat_t) + \
+                     self.fgs.gal_sync_pol(ells3,fq_mat,fq_mat_t))
 
-            self.W_ll_cmb[ii,:] = 1./np.dot(np.transpose(f_nu_cmb),np.dot(N_ll_for_cmb_inv,f_nu_cmb)) \
-                                  * np.dot(np.transpose(f_nu_cmb),N_ll_for_cmb_inv)
+        N_ll_for_cmb = nells + totfg
 
-            self.N_ll_cmb[ii] = np.dot(np.transpose(self.W_ll_cmb[ii,:]),np.dot(N_ll_for_cmb,self.W_ll_cmb[ii,:]))
+        self.W_ll_cmb = weightcalculator_batched(f_nu_cmb,N_ll_for_cmb)
+        self.N_ll_cmb = ilc_noise_batched(self.W_ll_cmb,N_ll_for_cmb)
 
 
 
@@ -0,0 +1,181 @@
+"""
+CMB lensing mass calibration grids from tabulated NFW convergence profiles.
+
+The matched filter S/N of a cluster convergence profile is
+
+    (S/N)^2 = int d^2ell/(2pi)^2 |kappa(ell)|^2 / N_ell
+
+and Rayleigh miscentering by sigma multiplies kappa(ell) by
+exp(-ell^2 sigma^2/2). Writing the convergence of an NFW halo truncated at
+tmaxN theta500 in units of x = theta/theta500,
+
+    kappa(ell) = 2 pi theta500^2 kappa_s H(ell theta500; c)
+    H(s; c) = int_0^tmaxN f(c x) J0(s x) x dx
+
+with f the projected NFW shape and kappa_s the convergence scale, all the
+profile work is a single 2D table of H in (c, s). LensMassKernel builds
+K[M,z,ell] = ell dell/2pi |kappa(ell)|^2 once for a grid, after which the
+S/N for any lensing noise curve and any miscentering is one contraction
+K . exp(-ell^2 sigma^2)/N_ell. This replaces the per cell, per miscentering
+stamp matched filter in bin/makeGrid.py (see --lens-kernel there), which
+writes the same mass_grid_name_cmb* pickles either way.
+"""
+from __future__ import print_function
+from __future__ import division
+from builtins import range
+from builtins import object
+from past.utils import old_div
+import numpy as np
+from scipy.special import j0
+from scipy.interpolate import RectBivariateSpline
+import szar._fast as fast
+
+def nfw_sigma_shape(x):
+    """
+    Projected NFW profile Sigma(R) = 2 rho_s r_s f(x), x = R/r_s.
+    """
+    x = np.asarray(x,dtype=np.float64)
+    f = np.zeros(x.shape)
+    near = np.abs(x-1.)<1.e-4
+    lo = (x<1.) & ~near & (x>0.)
+    hi = (x>1.) & ~near
+    xl = x[lo]
+    f[lo] = old_div(1.-2./np.sqrt(1.-xl**2.)*np.arctanh(np.sqrt(old_div(1.-xl,1.+xl))),xl**2.-1.)
+    xh = x[hi]
+    f[hi] = old_div(1.-2./np.sqrt(xh**2.-1.)*np.arctan(np.sqrt(old_div(xh-1.,xh+1.))),xh**2.-1.)
+    # series about x=1
+    f[near] = 1./3.-0.4*(x[near]-1.)
+    f[x==0.] = np.inf
+    return f
+
+class NFWKappaTable(object):
+    def __init__(self,cmin,cmax,smin,smax,tmaxN=5.,numts=1000,numcs=64,dlns=2.e-3):
+        """
+        Spline of H(s; c) = int_0^tmaxN f(c x) J0(s x) x dx for c in
+        [cmin,cmax] and s in [smin,smax]. The x integral is a trapezoid
+        sum over (at least) numts points.
+        """
+        # quadratic spacing resolves the log cusp of f at x=0, with
+        # at least 40 points per period of J0 at smax
+        numts = max(numts,int(80.*smax*tmaxN/2./np.pi)+1)
+        xs = tmaxN*np.linspace(0.,1.,numts)**2.
+        wx = np.zeros(numts)
+        wx[1:] += np.diff(xs)/2.
+        wx[:-1] += np.diff(xs)/2.
+        wx *= xs
+        cs = np.linspace(cmin,cmax,numcs) if cmax>cmin else np.array([cmin-0.5,cmin,cmin+0.5])
+        lns = np.arange(np.log(smin),np.log(smax)+2.*dlns,dlns)
+        # J0 does not depend on c, so the table is one matrix product
+        prof = nfw_sigma_shape(cs[:,None]*xs[1:])*wx[1:]
+        H = np.zeros((cs.size,lns.size))
+        step = max(1,2**22//numts)
+        for i in range(0,lns.size,step):
+            H[:,i:i+step] = np.dot(prof,j0(np.exp(lns[i:i+step,None])*xs[1:]).T)
+        self.cs = cs
+        self.lns = lns
+        self.spline = RectBivariateSpline(cs,lns,H)
+
+    def __call__(self,c,s):
+        """
+        H at every (c,s) pair; c and s broadcast against each other.
+        """
+        c,s = np.broadcast_arrays(c,s)
+        return self.spline.ev(c.ravel(),np.log(s).ravel()).reshape(c.shape)
+
+class LensMassKernel(object):
+    def __init__(self,clusterCosmology,mexp,zs,ells,overdensity=500.,critical=True,atClusterZ=True,
+                 tmaxN=5.,source_z=1100.,concentration=None,numts=1000,chunk_size=2**22):
+        """
+        clusterCosmology  a ClusterCosmology
+        mexp, zs          log10 mass (Msun/h) and redshift grid points
+        ells              ells the S/N integral is evaluated on; the noise
+                          curve is interpolated onto these
+        overdensity, critical, atClusterZ
+                          mass definition, as for ClusterCosmology.theta
+        tmaxN             the profile is truncated at tmaxN theta500
+        source_z          redshift of the lensed source (the CMB)
+        concentration     optional (M,z) grid of concentrations for the mass
+                          definition; Duffy et al. 2008 (Mdel_to_cdel) if None
+        """
+        cc = clusterCosmology
+        self.mexp = np.atleast_1d(mexp)
+        self.zs = np.atleast_1d(zs)
+        self.ells = np.asarray(ells,dtype=np.float64)
+        M = 10.**self.mexp[:,None]
+        z = self.zs[None,:]
+        zdensity = z if atClusterZ else 0.*z
+
+        # halo radius, concentration and convergence scale on the (M,z) grid
+        if critical:
+            rdel = cc.rdel_c(M,zdensity,overdensity) # Mpc/h
+        else:
+            rdel = cc.rdel_m(M,zdensity,overdensity) # Mpc/h
+        if concentration is None:
+            M200 = cc.Mass_con_del_2_del_mean200(M,overdensity,z)
+            c200 = fast.con_M_rel_duffy200(M200,z)
+            R200m = cc.rdel_m(M200,z,200.)
+            concentration = c200*(old_div(cc.rdel_c(M,z,overdensity),R200m))**(old_div(1.,3.))
+        self.concentration = np.broadcast_to(concentration,rdel.shape).copy()
+        c = self.concentration
+
+        dAz = cc.DA_z(self.zs) * cc.h # Mpc/h
+        chiL = cc.chi_z(self.zs) * cc.h
+        chiS = cc.results.comoving_radial_distance(source_z) * cc.h
+        winAtLens = old_div(chiS-chiL,chiS)
+        self.th500 = old_div(rdel,dAz)
+
+        rs = old_div(rdel,c)
+        mc = np.log(1.+c)-old_div(c,1.+c)
+        rhos_rs = old_div(M,4.*np.pi*rs**2.*mc) # (Msun/h)/(Mpc/h)^2
+        # 4 pi G/c^2 in Mpc/Msun
+        fourpiGc2 = 4.*np.pi*cc.c['G_CGS']*cc.c['MSUN_CGS']/cc.c['C']**2./cc.c['MPC2CM']
+        self.kappa_s = 2.*rhos_rs*fourpiGc2*dAz*winAtLens
+
+        # K = dell ell/2pi |kappa(ell)|^2 with trapezoid weights in ell
+        ells = self.ells
+        wl = np.zeros(ells.size)
+        wl[1:] += np.diff(ells)/2.
+        wl[:-1] += np.diff(ells)/2.
+        wl *= old_div(ells,2.*np.pi)
+        th500 = self.th500.ravel()
+        table = NFWKappaTable(c.min(),c.max(),th500.min()*ells.min(),th500.max()*ells.max(),tmaxN=tmaxN,numts=numts)
+        amp = (2.*np.pi*th500**2.*self.kappa_s.ravel())**2.
+        cflat = c.ravel()
+        K = np.zeros((th500.size,ells.size))
+        step = max(1,chunk_size//ells.size)
+        for i in range(0,th500.size,step):
+            K[i:i+step] = table(cflat[i:i+step,None],th500[i:i+step,None]*ells)**2.*amp[i:i+step,None]*wl
+        self.K = K.reshape(self.th500.shape+(ells.size,))
+
+    def sn(self,Nls,noise_ells=None,rayleighSigmaArcmin=None):
+        """
+        Matched filter S/N on the (M,z) grid for the lensing noise Nls
+        (on noise_ells, or on the kernel ells if None), optionally for
+        clusters miscentered with Rayleigh width rayleighSigmaArcmin. The
+        filter is matched to the (miscentered) profile. Modes outside
+        the range of noise_ells get no weight.
+        """
+        ells = self.ells
+        if noise_ells is not None:
+            ninv = 1./np.interp(ells,noise_ells,Nls,left=np.inf,right=np.inf)
+        else:
+            ninv = 1./np.asarray(Nls)
+        if rayleighSigmaArcmin is not None:
+            sig = rayleighSigmaArcmin*np.pi/180./60.
+            ninv = ninv*np.exp(-ells**2.*sig**2.)
+        return np.sqrt(np.dot(self.K,ninv))
+
+    def merr_grids(self,Nls,noise_ells=None,rayFid=None,rayStep=None,miscentered=None):
+        """
+        The (3,M,z) array of 1/(S/N) makeGrid.py stores as MerrGrid,
+        MerrGridUp and MerrGridDn. Redshifts where miscentered (a bool
+        array over zs) is True use the Rayleigh width rayFid and rayFid
+        +- rayStep/2; the others are not miscentered and the three grids agree.
+        """
+        MerrGrids = np.zeros((3,)+self.th500.shape)
+        MerrGrids[:] = 1./self.sn(Nls,noise_ells)
+        if miscentered is not None and rayFid is not None:
+            sel = np.asarray(miscentered,dtype=bool)
+            for i,ray in enumerate([rayFid,rayFid+old_div(rayStep,2.),rayFid-old_div(rayStep,2.)]):
+                MerrGrids[i][:,sel] = 1./self.sn(Nls,noise_ells,ray)[:,sel]
+        return MerrGrids
@@ -9,6 +9,7 @@ from past.utils import old_div
 import numpy as np
 from szar.counts import ClusterCosmology,Halo_MF
 from szar.szproperties import gaussian
+from szar.sampling import GridSampler, get_rng
 import emcee
 import simsTools
 from scipy import special,stats
@@ -230,15 +231,14 @@ class clusterLike(object):
         ans = np.trapz(P_Y*P_Y_sig,LgY,np.diff(LgY),axis=1)
         return ans
 
-    def Pfunc_per_zarr(self,MM,z_arr,Y_c,Y_err,int_HMF,param_vals):
+    def Pfunc_per_zarr(self,MM,z_arr,Y_c,Y_err,int_HMF,param_vals,m200_table=None):
         LgY = self.LgY
 
         P_func = np.outer(MM,np.zeros([len(z_arr)]))
         M_arr =  np.outer(MM,np.ones([len(z_arr)]))
-        M200 = np.outer(MM,np.zeros([len(z_arr)]))
         for i in range(z_arr.size):
             P_func[:,i] = self.P_of_Y_per(LgY,M_arr[:,i],z_arr[i],Y_c,Y_err,param_vals)
-            M200[:,i] = int_HMF.cc.Mass_con_del_2_del_mean200(self.HMF.M.copy(),500,z_arr[i])
+        M200 = int_HMF.cc.Mass_con_del_2_del_mean200(self.HMF.M.copy()[:,None],500,z_arr[None,:],table=m200_table)
         return P_func,M200
 
     def Ntot_survey(self,int_HMF,fsky,Ythresh,param_vals):
@@ -251,11 +251,11 @@ class clusterLike(object):
         Ntot = np.trapz(N_z*int_HMF.dVdz,dx=np.diff(z_arr))*4.*np.pi*fsky
         return Ntot
 
-    def Prob_per_cluster(self,int_HMF,cluster_props,dn_dzdm_int,param_vals):
+    def Prob_per_cluster(self,int_HMF,cluster_props,dn_dzdm_int,param_vals,m200_table=None):
         c_z, c_zerr, c_y, c_yerr = cluster_props
         if (c_zerr > 0):
             z_arr = np.arange(-3.*c_zerr,(3.+0.1)*c_zerr,c_zerr) + c_z
-            Pfunc_ind,M200 = self.Pfunc_per_zarr(int_HMF.M.copy(),z_arr,c_y,c_yerr,int_HMF,param_vals)
+            Pfunc_ind,M200 = self.Pfunc_per_zarr(int_HMF.M.copy(),z_arr,c_y,c_yerr,int_HMF,param_vals,m200_table)
             dn_dzdm = dn_dzdm_int(z_arr,np.log10(int_HMF.M.copy()))
             N_z_ind = np.trapz(dn_dzdm*Pfunc_ind,dx=np.diff(M200,axis=0),axis=0)
             N_per = np.trapz(N_z_ind*gaussian(z_arr,c_z,c_zerr),dx=np.diff(z_arr))
@@ -263,7 +263,7 @@ class clusterLike(object):
         else:
             Pfunc_ind = self.Pfunc_per(int_HMF.M.copy(),c_z, c_y, c_yerr,param_vals)
             #print "PFunc",Pfunc_ind
-            M200 = int_HMF.cc.Mass_con_del_2_del_mean200(int_HMF.M.copy(),500,c_z)
+            M200 = int_HMF.cc.Mass_con_del_2_del_mean200(int_HMF.M.copy(),500,c_z,table=m200_table)
             dn_dzdm = dn_dzdm_int(c_z,np.log10(int_HMF.M.copy()))[:,0]
             #print "dndm", dn_dzdm,dn_dzdm_int(c_z,np.log10(int_HMF.M.copy()))
             #print "M200", M200
@@ -271,6 +271,81 @@ class clusterLike(object):
             ans = N_z_ind
         return ans
 
+    def Ytilde_zarr(self,M,z_arr,param_vals):
+        # Ytilde on (M,z), the z-dependent part of P_Yo. y0FromLogM500 takes a
+        # scalar redshift, but Ytilde does not depend on LgY, so it is only
+        # evaluated on the mass vector
+        Om = old_div((param_vals['omch2'] + param_vals['ombh2']), (old_div(param_vals['H0'],100.))**2)
+        OL = 1. - Om
+        logM = np.log10(param_vals['massbias']*M/(old_div(param_vals['H0'],100.)))
+        Ytilde = np.zeros((M.size,z_arr.size))
+        for i in range(z_arr.size):
+            Ytilde[:,i], theta0, Qfilt = simsTools.y0FromLogM500(logM, z_arr[i], self.tckQFit,sigma_int=param_vals['scat'],B0=param_vals['yslope'], H0 = param_vals['H0'], OmegaM0 = Om, OmegaL0 = OL)
+        return Ytilde
+
+    def Prob_clusters(self,int_HMF,cluster_props,dn_dzdm_int,param_vals,m200_table=None,max_bytes=2**28):
+        """
+        Prob_per_cluster for the whole catalog. Clusters are grouped by the
+        number of photo-z samples, and each group's (cluster, M, z-sample, LgY)
+        integrand is built as one padded array, in chunks of clusters that keep
+        it under max_bytes. Returns N_per for every cluster.
+        """
+        c_z, c_zerr, c_y, c_yerr = cluster_props
+        MM = int_HMF.M.copy()
+        LgY = self.LgY
+        lnY = LgY*np.log(10.)
+        dLgY = np.diff(LgY)
+        wts = np.zeros(LgY.size)
+        wts[1:] += dLgY/2.
+        wts[:-1] += dLgY/2.
+        scat = param_vals['scat']
+
+        has_zerr = c_zerr > 0
+        zsamps = [np.arange(-3.*zerr,(3.+0.1)*zerr,zerr) + z if zerr > 0 else np.array([z]) for z,zerr in zip(c_z,c_zerr)]
+        nzs = np.array([zs.size for zs in zsamps])
+        offsets = np.append(0,np.cumsum(nzs))
+
+        # redshift-only pieces, evaluated once per unique z-sample
+        z_unique, z_inv = np.unique(np.concatenate(zsamps),return_inverse=True)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            lnYtilde = np.log(self.Ytilde_zarr(MM,z_unique,param_vals))
+        # a NaN Ytilde has zero probability, as nan_to_num(P_Yo) gives in
+        # Prob_per_cluster; +-inf already give exp(-inf) = 0 below
+        lnYtilde[np.isnan(lnYtilde)] = np.inf
+        M200 = int_HMF.cc.Mass_con_del_2_del_mean200(MM[:,None],500,z_unique[None,:],table=m200_table)
+        dn_dzdm = dn_dzdm_int(z_unique,np.log10(MM))
+
+        N_per = np.zeros(c_z.size)
+        for nz in np.unique(nzs):
+            for zerr_group in [True,False]:
+                inds = np.where((nzs==nz) & (has_zerr==zerr_group))[0]
+                step = int(max(1,max_bytes//(8*MM.size*nz*LgY.size)))
+                for k in range(0,inds.size,step):
+                    ci = inds[k:k+step]
+                    zi = z_inv[offsets[ci][:,None] + np.arange(nz)] # (cluster, z-sample) into z_unique
+
+                    # trapz over LgY of P_Yo (cluster, M, z-sample, LgY) times P_Y_sig (cluster, LgY),
+                    # with the trapezoid weights folded into P_Y_sig
+                    P_Y_sig = gaussian(10**LgY,c_y[ci][:,None],c_yerr[ci][:,None])*wts
+                    P_Y = lnY - lnYtilde[:,zi].transpose(1,0,2)[...,None]
+                    P_Y *= P_Y
+                    P_Y *= old_div(-1.,(2.*scat**2))
+                    np.exp(P_Y,out=P_Y)
+                    Pfunc_ind = np.matmul(P_Y.reshape((ci.size,-1,LgY.size)),P_Y_sig[:,:,None]).reshape((ci.size,MM.size,nz))
+                    Pfunc_ind *= 1./(scat * np.sqrt(2*np.pi))
+
+                    # trapz over M with the M200 spacing of each z-sample
+                    dM = np.diff(M200[:,zi],axis=0).transpose(1,0,2)
+                    y = dn_dzdm[:,zi].transpose(1,0,2)*Pfunc_ind
+                    N_z_ind = 0.5*np.sum(dM*(y[:,1:,:]+y[:,:-1,:]),axis=1)
+                    if zerr_group:
+                        z_arr = z_unique[zi]
+                        y = N_z_ind*gaussian(z_arr,c_z[ci][:,None],c_zerr[ci][:,None])
+                        N_per[ci] = 0.5*np.sum(np.diff(z_arr,axis=1)*(y[:,1:]+y[:,:-1]),axis=1)
+                    else:
+                        N_per[ci] = N_z_ind[:,0]
+        return N_per
+
     def lnprior(self,theta,parlist,priorval,priorlist):
         param_vals = alter_fparams(self.fparams,parlist,theta)
         prioravg = priorval[0,:]
@@ -319,6 +394,11 @@ class clusterLike(object):
         dndm_int = int_HMF.inter_dndmLogm(200.) # delta = 200
         cluster_prop = np.array([self.clst_z,self.clst_zerr,self.clst_y0*1e-4,self.clst_y0err*1e-4])
 
+        # M500c -> M200m is tabulated once per cosmology and shared by all clusters
+        zlo = max(np.min(self.clst_z - 3.2*self.clst_zerr),1e-3)
+        zhi = np.max(self.clst_z + 3.2*self.clst_zerr)
+        m200_table = int_cc.mass_conversion_table(500,self.mgrid[0],self.mgrid[-1],zlo,zhi)
+
         if self.test:
             Ntot = 60.
         else:
@@ -326,16 +406,9 @@ class clusterLike(object):
             for i in range(len(self.frac_of_survey)):
                 Ntot += self.Ntot_survey(int_HMF,self.area_rads*self.frac_of_survey[i],self.thresh_bin[i],param_vals)
         #print 'NTOT', Ntot
-        Nind = 0
-        #Nind2 = 1.
-        for i in range(len(self.clst_z)):
-            
-            N_per = self.Prob_per_cluster(int_HMF,cluster_prop[:,i],dndm_int,param_vals)
-            #if (i < 3):
-                #print np.log(N_per)
-            Nind = Nind + np.log(N_per)
-            #Nind2 *= N_per
-            #print N_per
+        # all clusters at once; Prob_per_cluster is the per-cluster equivalent
+        N_per = self.Prob_clusters(int_HMF,cluster_prop,dndm_int,param_vals,m200_table)
+        Nind = np.sum(np.log(N_per))
         print(-Ntot, Nind, -Ntot + Nind, theta)#, np.log(np.exp(-Ntot)*Nind2)
         return -Ntot + Nind
 
@@ -349,6 +422,22 @@ class clusterLike(object):
         lnlike = self.lnlike(theta, parlist)
         return lp + lnlike,np.nan_to_num(self.s8)
 
+# clusterLike holds CAMB results that cannot be pickled, so for process and MPI
+# pools every worker keeps its own instance here and the sampler is handed
+# pool_lnprob, which pickles by name.
+_pool_like = None
+
+def init_pool_like(*args,**kwargs):
+    # Pool initializer: build this worker's clusterLike from the clusterLike arguments
+    set_pool_like(clusterLike(*args,**kwargs))
+
+def set_pool_like(like):
+    global _pool_like
+    _pool_like = like
+
+def pool_lnprob(theta, parlist, priorval, priorlist):
+    return _pool_like.lnprob(theta, parlist, priorval, priorlist)
+
 class MockCatalog(object):
     def __init__(self,iniFile,parDict,nemoOutputDir,noiseFile,params,parlist,mass_grid_log=None,z_grid=None,randoms=False):
 
@@ -452,51 +541,26 @@ class MockCatalog(object):
         '''
         Create simple mock catalog of Mass and Redshift by sampling the mass function
         '''
-        #if (self.rand):
-        #    Ntot100 = np.int32(np.ceil(self.Total_clusters(fsky))*4.) ## Note for randoms increasing the number density by factor of 100
-        #else:
-        #    Ntot100 = np.int32(np.ceil(old_div(self.Total_clusters(fsky), 100.))) ## Note the default number of walkers in mcsample_mf is 100 
-
-        #mlim = [np.min(self.mgrid),np.max(self.mgrid)]
-        #zlim = [np.min(self.zgrid),np.max(self.zgrid)]
-
-        #old MCMC
-        #samples = self.HMF.mcsample_mf(200.,Ntot100,mthresh = mlim,zthresh = zlim)
-        #return samples[:,0],samples[:,1]
-
         Ntot100 = self.Total_clusters(fsky) # np.int32(np.ceil(self.Total_clusters(fsky))) 
         Ntot = np.int32(np.random.poisson(Ntot100))
         print ("Mock cat gen internal counts and Poisson draw",Ntot100,Ntot)
 
-        zsamps, msamps = self.HMF.cpsample_mf(200.,Ntot) 
-        #print (zsamps, msamps) 
-        return zsamps, msamps
-
-    def create_basic_sample_Mat(self,fsky):
-        '''                                                                                                                                                               Create simple mock catalog of Mass and Redshift by sampling the mass function                                                                                     '''
-        nmzdensity = HMF.N_of_Mz(self.HMF.M200,200.)
-        Ndz = np.multiply(nmzdensity,np.diff(self.zgrid).reshape((1,self.zgrid.size-1)))
-        Nmz = np.multiply(Ndz,np.diff(10**self.mgrid).reshape((self.mgrid.size-1,1))) * 4.* np.pi
-        Ntot = Nmz.sum() * fsky
+        samples = self.HMF.sample_mf(200.,Ntot)
+        return samples[:,0], samples[:,1]
 
-        print ("fsky test",Ntot, np.int32(np.ceil(self.Total_clusters(fsky))))
+    def create_basic_sample_Mat(self,fsky,rng=None):
+        '''
+        Create simple mock catalog of Mass and Redshift by Poisson sampling the binned mass function
+        '''
+        HMF = self.HMF
+        Nmz = HMF.N_of_Mz(HMF.M200,200.)*np.diff(HMF.M200_edges,axis=0)*np.diff(self.zgrid)*4.*np.pi*fsky
+        sampler = GridSampler(Nmz,self.mgrid,self.zgrid)
 
-        np.random.seed(self.seedval)
-        nclusters = int(np.random.poisson(Ntot)) #if poisson else int(self.ntot)
-        mzs = np.zeros((nclusters,2),dtype=np.float32)
+        print ("fsky test",sampler.ntot, np.int32(np.ceil(self.Total_clusters(fsky))))
 
-        msamps = np.zeros((nclusters),dtype=np.float32)
-        zsamps = np.zeros((nclusters),dtype=np.float32)
         print("Generating Nmz catalog...")
-        for i in range(nclusters):
-            linear_idx = np.random.choice(self.Nmz.size, p=self.Nmz.ravel()/float(self.Nmz.sum()))
-            x, y = np.unravel_index(linear_idx, self.Nmz.shape)
-            # mzs[i,0] = self.Mexpcents[x]                                                                                         
-            # mzs[i,1] = self.zcents[y]                                                                                            
-            msamps = np.random.uniform(self.Mexpcents[x].min(),self.Mexpcents[x].max())
-            zsamps = np.random.uniform(self.zcents[y].min(),self.zcents[y].max())
-
-        return zsamps, msamps
+        mzs = sampler.sample(get_rng(self.seedval if rng is None else rng))
+        return mzs[:,1], mzs[:,0]
 
     def plot_basic_sample(self,fname='default_mockcat.png',):
         fsky = self.fsky
@@ -804,6 +868,26 @@ class clustLikeTest(object):
             #print blahs 
         return ans
 
+    def Prob_clusters(self,int_HMF,cluster_props,dn_dzdm_int):
+        # Prob_per_cluster for the whole catalog: the photo-z samples of all
+        # clusters with the same number of samples go through one MassFunctionGrid.ev call
+        c_z, c_zerr, c_m, c_merr = cluster_props
+        zsamps = [np.arange(-3.*zerr,(3.+0.1)*zerr,zerr) + z if zerr > 0 else np.array([z]) for z,zerr in zip(c_z,c_zerr)]
+        nzs = np.array([zs.size for zs in zsamps])
+        N_per = np.zeros(c_z.size)
+        for nz in np.unique(nzs):
+            for zerr_group in [True,False]:
+                ci = np.where((nzs==nz) & ((c_zerr>0)==zerr_group))[0]
+                if ci.size==0: continue
+                z_arr = np.array([zsamps[i] for i in ci])
+                dn_dzdm = dn_dzdm_int.ev(z_arr,np.log10(c_m[ci])[:,None])
+                if zerr_group:
+                    y = dn_dzdm*gaussian(z_arr,c_z[ci][:,None],c_zerr[ci][:,None])
+                    N_per[ci] = 0.5*np.sum(np.diff(z_arr,axis=1)*(y[:,1:]+y[:,:-1]),axis=1)
+                else:
+                    N_per[ci] = dn_dzdm[:,0]
+        return N_per
+
     def lnlike(self,theta,parlist):
 
         param_vals = alter_fparams(self.fparams,parlist,theta)
@@ -824,10 +908,8 @@ class clustLikeTest(object):
         print("Ntot comparion, and catalog")
         print(self.Ntot_survey_TEST(int_HMF,self.fsky), Ntot, len(self.clst_z))
 
-        Nind = 0
-        for i in range(len(self.clst_z)):
-            N_per = self.Prob_per_cluster(int_HMF,cluster_prop[:,i],dndm_int)
-            Nind = Nind + np.log(N_per)
+        N_per = self.Prob_clusters(int_HMF,cluster_prop,dndm_int)
+        Nind = np.sum(np.log(N_per))
 
         print("-NTOT, Nind, Total, As")
         print(-Ntot, Nind, -Ntot + Nind, theta)
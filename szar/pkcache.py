@@ -0,0 +1,134 @@
+"""
+Content-addressed cache of the CAMB products that Halo_MF needs
+(kh, P(z,k), sigma8 and background tables at the grid redshifts).
+
+Entries are keyed on a hash of the cosmology dictionary, the redshift array
+and the k settings. There is an in-memory LRU tier and an optional on-disk
+tier of .npz files, so repeated cosmologies in a chain, and re-runs of
+the same fiducial on several MPI ranks, skip the camb.get_results call that
+Halo_MF makes for the matter power spectrum.
+
+A hit does not skip CAMB altogether: ClusterCosmology.__init__ still runs its
+own background calculation, and cc.results stays that background-only object
+(cc.s8 is set from the cache). Code that needs the full CAMB results of a
+cosmology, e.g. get_sigma8 or get_matter_power_spectrum on cc.results, should
+build Halo_MF with pk_cache=False.
+"""
+from __future__ import print_function
+from __future__ import division
+from collections import OrderedDict
+import numpy as np
+import hashlib
+import os
+
+# Entries of paramDict that do not change the CAMB matter power spectrum or
+# background. Varying these (e.g. scaling relation steps in makeDerivs or
+# nuisance parameters in a likelihood chain) still gives a cache hit.
+non_camb_params = ['alpha_ym','b_ym','beta_ym','gamma_ym','Ysig','gammaYsig','betaYsig',
+                   'b_wl','Y_star','sigR','S8All','rho','rho_corr','abias',
+                   'Msig','gammaMsig','betaMsig','gammarho','betarho',
+                   'massbias','yslope','scat']
+
+def cosmology_key(paramDict,zarr,kmin,kmax,knum,exclude=non_camb_params):
+    """
+    Hash of the cosmology dict, redshift array and k settings.
+    """
+    hinval = ""
+    for key in sorted(paramDict.keys()):
+        if key in exclude: continue
+        hinval += key + "=" + repr(float(paramDict[key])) + ";"
+    hinval += "z=" + ",".join(repr(float(z)) for z in np.atleast_1d(zarr)) + ";"
+    hinval += "k=" + ",".join(repr(float(k)) for k in [kmin,kmax,knum])
+    return hashlib.md5(hinval.encode('utf-8')).hexdigest()
+
+class PowerSpectrumCache(object):
+    def __init__(self,maxsize=64,cache_dir=None):
+        """
+        maxsize    number of entries kept in memory
+        cache_dir  directory for the on-disk tier (None keeps it in memory only)
+        """
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self._entries = OrderedDict()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.camb_time = 0.
+        self.time_saved = 0.
+
+    def _path(self,key):
+        return os.path.join(self.cache_dir,"pk_"+key+".npz")
+
+    def get(self,key):
+        """
+        Returns a dict with kh, pk, s8, DAz, Hz, camb_time for this key, or None.
+        """
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            entry = self._entries[key]
+            self.hits += 1
+            self.time_saved += entry['camb_time']
+            return entry
+        if self.cache_dir is not None and os.path.exists(self._path(key)):
+            with np.load(self._path(key)) as data:
+                entry = {name:data[name] for name in data.files}
+            entry['s8'] = float(entry['s8'])
+            entry['camb_time'] = float(entry['camb_time'])
+            self._store(key,entry)
+            self.hits += 1
+            self.disk_hits += 1
+            self.time_saved += entry['camb_time']
+            return entry
+        self.misses += 1
+        return None
+
+    def _store(self,key,entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def put(self,key,entry,elapsed=0.):
+        """
+        Store an entry. elapsed is the CAMB time it cost, which is
+        credited to time_saved every time the entry is hit.
+        """
+        entry = dict(entry,camb_time=float(elapsed))
+        self.camb_time += elapsed
+        self._store(key,entry)
+        if self.cache_dir is not None:
+            if not os.path.exists(self.cache_dir): os.makedirs(self.cache_dir)
+            # write then rename so that concurrent ranks never see a partial file
+            tmp = self._path(key)+".tmp"+str(os.getpid())+".npz"
+            np.savez(tmp,**entry)
+            os.replace(tmp,self._path(key))
+
+    def clear(self,disk=False):
+        self._entries.clear()
+        if disk and self.cache_dir is not None and os.path.exists(self.cache_dir):
+            for f in os.listdir(self.cache_dir):
+                if f.startswith("pk_") and f.endswith(".npz"): os.remove(os.path.join(self.cache_dir,f))
+
+    def stats(self):
+        """
+        Hit/miss counters, CAMB time spent on misses and CAMB time
+        saved by hits.
+        """
+        calls = self.hits + self.misses
+        return {'hits':self.hits,'disk_hits':self.disk_hits,'misses':self.misses,
+                'hit_rate':self.hits/calls if calls>0 else 0.,
+                'camb_time':self.camb_time,'time_saved':self.time_saved}
+
+    def __len__(self):
+        return len(self._entries)
+
+default_cache = PowerSpectrumCache()
+
+def set_cache_dir(cache_dir):
+    """
+    Enable the on-disk tier of the default cache used by Halo_MF.
+    """
+    default_cache.cache_dir = cache_dir
@@ -0,0 +1,145 @@
+"""
+Super sample variance of cluster counts in redshift shells.
+
+The mean overdensity of redshift shell i inside a footprint M (M=1 in the
+survey, area Omega = 4 pi fsky) has covariance
+
+    S_ij = sum_ell K_ell C_ell^ij,    K_ell = sum_m |m_lm|^2 / Omega^2
+
+where m_lm are the harmonic coefficients of M and C_ell^ij the angular
+power of the shell averaged density. K_ell only depends on the footprint,
+so it is computed once: analytically for a spherical cap
+(cap_mask_weights) or with healpy from a mask map, cached on disk
+(mask_weights_from_file). In the Limber approximation C_ell^ij is diagonal,
+
+    C_ell^ii = int_i dchi chi^2 P_i((ell+1/2)/chi) / V_i^2,   V_i = int_i dchi chi^2,
+
+and the variance of all shells is one sum over ell. Below lmax_exact,
+C_ell^ij is instead the exact projection
+
+    C_ell^ij = 2/pi int dk k^2 P_ij(k) jbar_i(k) jbar_j(k),
+    jbar_i(k) = int_i dchi chi^2 j_ell(k chi) / V_i,   P_ij = sqrt(P_i P_j),
+
+which also gives the covariance between shells. Distances are in Mpc, k in
+1/Mpc and P in Mpc^3; the kh, pk of Halo_MF (h/Mpc, (Mpc/h)^3) are
+converted. P is log-log interpolated in k and taken to vanish outside the
+tabulated range.
+"""
+from __future__ import print_function
+from __future__ import division
+from builtins import range
+import numpy as np
+import os
+from scipy.special import eval_legendre, spherical_jn
+from scipy.interpolate import CubicSpline
+
+def cap_mask_weights(fsky,lmax):
+    """
+    K_ell, ell = 0..lmax, of a spherical cap covering fsky of the sky. Only
+    m=0 contributes, with m_l0 = 2 pi sqrt((2l+1)/4pi) (P_l-1(x)-P_l+1(x))/(2l+1),
+    x the cosine of the cap radius and P_-1 = 1.
+    """
+    x = 1.-2.*fsky
+    ells = np.arange(lmax+1)
+    Pl = eval_legendre(np.arange(lmax+2),x)
+    Plm1 = np.append(1.,Pl[:-2])
+    m_l0 = 2.*np.pi*np.sqrt((2.*ells+1.)/4./np.pi)*(Plm1-Pl[1:])/(2.*ells+1.)
+    return m_l0**2./(4.*np.pi*fsky)**2.
+
+def mask_weights_from_map(mask,lmax):
+    """
+    K_ell, ell = 0..lmax, of a healpix mask map.
+    """
+    import healpy as hp
+    mask = np.asarray(mask,dtype=np.float64)
+    omega = 4.*np.pi*mask.mean()
+    cl = hp.anafast(mask,lmax=lmax)
+    return (2.*np.arange(lmax+1)+1.)*cl/omega**2.
+
+def mask_weights_from_file(filename,lmax,cache_file=None):
+    """
+    K_ell of the healpix mask in filename. If cache_file is given the
+    weights are read from it when it holds at least lmax+1 of them, and
+    written to it otherwise.
+    """
+    if cache_file is not None and os.path.exists(cache_file):
+        Kl = np.load(cache_file)
+        if Kl.size>lmax: return Kl[:lmax+1]
+    import healpy as hp
+    Kl = mask_weights_from_map(hp.read_map(filename),lmax)
+    if cache_file is not None:
+        tmp = cache_file+".tmp"+str(os.getpid())+".npy"
+        np.save(tmp,Kl)
+        os.replace(tmp,cache_file)
+    return Kl
+
+def _shell_nodes(chi_edges,nodes):
+    # Gauss-Legendre nodes and chi^2 dchi / V weights in every shell
+    x,w = np.polynomial.legendre.leggauss(nodes)
+    lo,hi = chi_edges[:-1,None],chi_edges[1:,None]
+    chis = (hi+lo)/2.+(hi-lo)/2.*x
+    wts = (hi-lo)/2.*w*chis**2.
+    return chis,wts/wts.sum(axis=1)[:,None]
+
+def _log_interp_pk(kh,pk,h,k):
+    """
+    P_i(k) in Mpc^3 for k in 1/Mpc of shape (nshells,...), log-log
+    interpolated in the (nshells,nk) table pk on kh, zero outside it.
+    """
+    lnk = np.log(kh)
+    x = np.log(k/h)
+    idx = np.clip(np.searchsorted(lnk,x)-1,0,lnk.size-2)
+    t = (x-lnk[idx])/(lnk[idx+1]-lnk[idx])
+    lnpk = np.log(pk).reshape(pk.shape[:1]+(1,)*(k.ndim-1)+pk.shape[1:])
+    lo = np.take_along_axis(lnpk,idx[...,None],axis=-1)[...,0]
+    hi = np.take_along_axis(lnpk,idx[...,None]+1,axis=-1)[...,0]
+    ans = np.exp(lo+t*(hi-lo))/h**3.
+    ans[(x<lnk[0])|(x>lnk[-1])] = 0.
+    return ans
+
+def shell_covariance(cc,kh,pk,z_edges,mask_weights,lmin=0,lmax_exact=0,kmax_exact=0.2,nodes=8,dx=0.05):
+    """
+    The (nz,nz) covariance S_ij of the mean overdensity in the redshift
+    shells z_edges, for the footprint weights mask_weights (K_ell from
+    ell=0). pk is the (nz,nk) linear power at the shell centres on kh
+    (h/Mpc). Multipoles lmin <= ell < lmax_exact are projected exactly with
+    k up to kmax_exact (1/Mpc) and give cross shell terms; the rest are
+    Limber (with nodes Gauss-Legendre points per shell) and only contribute
+    to the diagonal. dx is the spacing of the tabulated Bessel integral.
+    """
+    Kl = np.asarray(mask_weights)
+    h = cc.h
+    chi_edges = cc.chi_z(np.asarray(z_edges))
+    nz = chi_edges.size-1
+    S = np.zeros((nz,nz))
+
+    # Limber
+    ells = np.arange(max(lmin,lmax_exact),Kl.size)
+    chis,wts = _shell_nodes(chi_edges,nodes)
+    Pk = _log_interp_pk(kh,pk,h,(ells[None,:,None]+0.5)/chis[:,None,:])
+    vols = np.diff(chi_edges**3.)/3.
+    Cl = np.einsum('in,iln->il',wts,Pk)/vols[:,None]
+    S[np.diag_indices(nz)] = np.dot(Cl,Kl[ells])
+
+    # exact projection at low ell, with the shell averages from the
+    # cumulative integral F(x) = int_0^x t^2 j_ell(t) dt,
+    # jbar_i(k) = (F(k chi_i+1) - F(k chi_i))/(k^3 V_i)
+    if lmax_exact>lmin:
+        dk = np.pi/4./chi_edges[-1]
+        ks = np.arange(dk,kmax_exact+dk,dk)
+        sqrtP = np.sqrt(_log_interp_pk(kh,pk,h,np.broadcast_to(ks,(nz,ks.size)).copy()))
+        wk = np.full(ks.size,dk)*ks**2.*2./np.pi
+        xs = np.arange(0.,ks[-1]*chi_edges[-1]+2.*dx,dx)
+        kchi = ks[:,None]*chi_edges
+        for ell in range(lmin,lmax_exact):
+            F = CubicSpline(xs,xs**2.*spherical_jn(ell,xs)).antiderivative()(kchi)
+            A = (np.diff(F,axis=1)/ks[:,None]**3./vols).T*sqrtP
+            S += Kl[ell]*np.dot(A*wk,A.T)
+    return S
+
+def shell_variance(cc,kh,pk,z_edges,mask_weights,lmin=0):
+    """
+    Limber variance sigma^2(z) of the mean overdensity of every shell
+    (the diagonal of shell_covariance with lmax_exact=0).
+    """
+    return np.diagonal(shell_covariance(cc,kh,pk,z_edges,mask_weights,lmin=lmin)).copy()
@@ -0,0 +1,152 @@
+"""
+Mock cluster catalogs drawn from counts tabulated on a grid.
+
+The numbers of clusters in the cells of a (log M, z) grid are independent
+Poisson variables with means N_ij, so a whole catalog is one Poisson draw of
+the grid of counts (a multinomial draw if the total is held fixed) followed
+by placing every cluster inside its cell. GridSampler does both with a few
+vectorized calls instead of one np.random.choice per cluster; positions are
+uniform within a cell in the grid coordinates, or follow a power law
+(exponential in x) with given log slopes. All randomness comes from a numpy
+Generator (get_rng makes one from a seed), so catalogs are reproducible and
+independent realizations are cheap.
+
+GridSampler.draw gives a fixed number of independent draws from the same
+piecewise density, optionally restricted to a box: cells by inverting the
+cumulative table of the cell weights, positions by the inverse CDF within
+the cell. The draws are exact and cost O(n log ncells), with no burn-in.
+"""
+from __future__ import print_function
+from __future__ import division
+from builtins import object
+import numpy as np
+
+def get_rng(seed=None):
+    """
+    A numpy Generator: seed itself if it is one, else default_rng(seed).
+    """
+    if isinstance(seed,np.random.Generator): return seed
+    return np.random.default_rng(seed)
+
+def interp_rows(x,xp,fp):
+    """
+    np.interp(x[i],xp[i],fp) for every row i of the (n,m) array xp of
+    increasing values, with x clipped to the range of each row.
+    """
+    x = np.asarray(x,dtype=np.float64)
+    xp = np.asarray(xp,dtype=np.float64)
+    fp = np.asarray(fp,dtype=np.float64)
+    j = np.clip((xp<=x[:,None]).sum(axis=1)-1,0,xp.shape[1]-2)
+    rows = np.arange(x.size)
+    lo = xp[rows,j]
+    width = xp[rows,j+1]-lo
+    t = np.clip((x-lo)/np.where(width>0.,width,1.),0.,1.)
+    return fp[j]+t*(fp[j+1]-fp[j])
+
+def _exp_cdf(x,lo,width,slope):
+    # CDF on [lo,lo+width] of a density proportional to exp(slope*x)
+    a = slope*width
+    t = np.clip((x-lo)/width,0.,1.)
+    flat = np.abs(a)<1.e-8
+    a = np.where(flat,1.,a)
+    return np.where(flat,t,np.expm1(a*t)/np.expm1(a))
+
+def _exp_inverse_cdf(g,lo,width,slope):
+    # inverse of _exp_cdf
+    a = slope*width
+    flat = np.abs(a)<1.e-8
+    a = np.where(flat,1.,a)
+    t = np.where(flat,g,np.log1p(g*np.expm1(a))/a)
+    return lo+np.clip(t,0.,1.)*width
+
+class GridSampler(object):
+    def __init__(self,N,x_edges,y_edges,x_slopes=None):
+        """
+        N                 (nx,ny) expected numbers of clusters in the cells
+        x_edges, y_edges  cell edges, of sizes nx+1 and ny+1
+        x_slopes          optional (nx,ny) log slopes dln(density)/dx within
+                          the cells; positions are uniform in x if None
+        """
+        self.N = np.asarray(N,dtype=np.float64)
+        self.x_edges = np.asarray(x_edges,dtype=np.float64)
+        self.y_edges = np.asarray(y_edges,dtype=np.float64)
+        if self.N.shape!=(self.x_edges.size-1,self.y_edges.size-1):
+            raise ValueError("Counts grid does not match the cell edges.")
+        if np.any(self.N<0.) or not np.all(np.isfinite(self.N)):
+            raise ValueError("Expected counts must be finite and non-negative.")
+        self.x_slopes = np.zeros(self.N.shape) if x_slopes is None else np.broadcast_to(x_slopes,self.N.shape)
+        self.ntot = self.N.sum()
+
+    def _positions(self,ix,iy,u,x_range=None,y_range=None):
+        # (x,y) in the cells (ix,iy) from the uniform (n,2) u, within the box
+        xlo,xhi = self.x_edges[ix],self.x_edges[ix+1]
+        ylo,yhi = self.y_edges[iy],self.y_edges[iy+1]
+        slope = self.x_slopes[ix,iy]
+        g0,g1 = 0.,1.
+        if x_range is not None:
+            g0 = _exp_cdf(x_range[0],xlo,xhi-xlo,slope)
+            g1 = _exp_cdf(x_range[1],xlo,xhi-xlo,slope)
+        if y_range is not None:
+            ylo,yhi = np.maximum(ylo,y_range[0]),np.minimum(yhi,y_range[1])
+        xy = np.empty((ix.size,2))
+        xy[:,0] = _exp_inverse_cdf(g0+u[:,0]*(g1-g0),xlo,xhi-xlo,slope)
+        xy[:,1] = ylo+u[:,1]*(yhi-ylo)
+        return xy
+
+    def counts(self,rng=None,poisson=True,nclusters=None,size=None):
+        """
+        Numbers of clusters in the cells, (nx,ny), or (size,nx,ny) for size
+        independent realizations. Poisson with mean N if poisson, else
+        multinomial with nclusters (int(ntot) if None) in total.
+        """
+        rng = get_rng(rng)
+        shape = self.N.shape if size is None else (size,)+self.N.shape
+        if poisson:
+            return rng.poisson(self.N,size=shape)
+        n = int(self.ntot) if nclusters is None else int(nclusters)
+        return rng.multinomial(n,self.N.ravel()/self.ntot,size=size).reshape(shape)
+
+    def place(self,counts,rng=None):
+        """
+        (n,2) array of (x,y) for the clusters in the (nx,ny) counts, in
+        random order and distributed within their cells as set by x_slopes.
+        """
+        rng = get_rng(rng)
+        counts = np.asarray(counts)
+        cells = rng.permutation(np.repeat(np.arange(counts.size),counts.ravel()))
+        ix,iy = np.unravel_index(cells,self.N.shape)
+        return self._positions(ix,iy,rng.random((cells.size,2)))
+
+    def sample(self,rng=None,poisson=True,nclusters=None):
+        """
+        One catalog, see counts and place.
+        """
+        rng = get_rng(rng)
+        return self.place(self.counts(rng,poisson,nclusters),rng)
+
+    def realizations(self,nreal,rng=None,poisson=True,nclusters=None):
+        """
+        List of nreal independent catalogs.
+        """
+        rng = get_rng(rng)
+        return [self.place(c,rng) for c in self.counts(rng,poisson,nclusters,size=nreal)]
+
+    def draw(self,n,rng=None,x_range=None,y_range=None):
+        """
+        (n,2) array of n independent (x,y) from the density of the grid,
+        restricted to x_range and y_range ((min,max) pairs) if given.
+        """
+        rng = get_rng(rng)
+        w = self.N
+        if x_range is not None:
+            lo,width = self.x_edges[:-1,None],np.diff(self.x_edges)[:,None]
+            w = w*(_exp_cdf(x_range[1],lo,width,self.x_slopes)-_exp_cdf(x_range[0],lo,width,self.x_slopes))
+        if y_range is not None:
+            frac = (np.minimum(self.y_edges[1:],y_range[1])-np.maximum(self.y_edges[:-1],y_range[0]))/np.diff(self.y_edges)
+            w = w*np.clip(frac,0.,1.)
+        cdf = np.cumsum(w.ravel())
+        if not cdf[-1]>0.:
+            raise ValueError("No counts in the requested range.")
+        cells = np.searchsorted(cdf,rng.random(n)*cdf[-1],side='right')
+        ix,iy = np.unravel_index(cells,self.N.shape)
+        return self._positions(ix,iy,rng.random((n,2)),x_range,y_range)
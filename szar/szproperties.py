@@ -12,7 +12,7 @@ from szar.counts import ClusterCosmology
 from scipy.special import j0
 from orphics.stats import timeit
 from orphics import io
-from scipy.interpolate import interp1d
+from scipy.interpolate import interp1d, CubicSpline
 import os
 
 default_profile_params = {
@@ -28,7 +28,7 @@ def gnfw(xx, P0 = 8.403, xc = 1.156, gm = 0.3292, al = 1.062, bt = 5.4807):
 
 def bbps(cc,M,z):
     R500 = old_div(cc.rdel_c(M,z,500.).flatten()[0], (old_div(cc.H0,100.))) # Mpc No hs
-    DA_z = cc.results.angular_diameter_distance(z) # No hs
+    DA_z = cc.DA_z(z) # No hs
     M_fac = M / (3e14) * (old_div(100.,cc.H0))
     P500 = 1.65e-3 * (old_div(100.,cc.H0))**2 * M_fac**(old_div(2.,3.)) * self.cc.E_z(z) #keV cm^3
     intgrl = P500*np.sum(self.GNFW(old_div(rr,R500))*rr**2*np.sin(ell*rr/DA_z) / (ell*rr/DA_z) ) * dr
@@ -57,6 +57,14 @@ def gaussian2D(xx, mu_x, sig_x,yy,mu_y, sig_y, rho):
     exp3 = 2*rho *(xx - mu_x)/sig_x *(yy - mu_y)/sig_y
     return 1./(sig_x*sig_y*2.0*np.pi*np.sqrt(1. - rho**2)) * np.exp(exp0*(exp1+exp2-exp3))
 
+def var_ell_weights(ells):
+    # trapezoid weights of the quickVar ell integral, times 2 pi ell
+    dells = np.diff(ells)
+    wts = np.zeros(ells.size)
+    wts[1:] += dells/2.
+    wts[:-1] += dells/2.
+    return wts*ells*2.*np.pi
+
 root_dir = os.path.dirname(os.path.realpath(__file__))+"/../"
 
 class SZ_Cluster_Model(object):
@@ -85,10 +93,6 @@ class SZ_Cluster_Model(object):
         fgs = fgNoises(self.cc.c,ksz_file=ksz_file,ksz_p_file=ksz_p_file,tsz_cib_file=tsz_cib_file,tsz_battaglia_template_csv=tsz_battaglia_template_csv)
 
         self.dell = dell
-        self.nlinv = 0.
-        self.nlinv_cmb = 0.
-        self.nlinv_nofg = 0.
-        self.nlinv_cmb_nofg = 0.
         self.evalells = np.arange(2,lmax,self.dell)
 
 
@@ -147,36 +151,40 @@ class SZ_Cluster_Model(object):
 
             assert np.all(v3ell==self.evalells)
         
-        # pl = io.Plotter(yscale='log',xlabel='l',ylabel='D_l')
-            
-        for ii,(freq,fwhm,noise) in enumerate(zip(freqs,fwhms,rms_noises)):
-            freq_fac = (f_nu(self.cc.c,freq))**2
+        # All noise curves are built for every ell at once. Per frequency
+        # quantities are (nfreq,nell) arrays and frequency covariances are
+        # (nell,nfreq,nfreq) stacks.
+        freqs = np.array(freqs)
+        nfreqs = freqs.size
+        ells = self.evalells
+        ellfac = 2.* np.pi / self.cc.c['TCMBmuK']**2. / ((ells+1.)*ells)
+        cltt = self.cc.clttfunc(ells)
 
+        if v3mode>-1:
+            inst_noise = old_div(np.asarray(N_ell_T_LA)[:nfreqs], self.cc.c['TCMBmuK']**2.)
+        else:
+            inst_noise = old_div(np.array([noise_func(ells,fwhm,noise,lknee,alpha,dimensionless=False) for fwhm,noise in zip(fwhms,rms_noises)]), self.cc.c['TCMBmuK']**2.)
 
-            if v3mode>-1:
-                inst_noise = old_div(N_ell_T_LA[ii], self.cc.c['TCMBmuK']**2.)
-            else:
-                inst_noise = ( old_div(noise_func(self.evalells,fwhm,noise,lknee,alpha,dimensionless=False), self.cc.c['TCMBmuK']**2.))
+        # single frequency combinations, over the frequencies with a beam and noise given
+        nzip = len(list(zip(freqs,fwhms,rms_noises)))
+        fcol = freqs[:nzip,None]
+        freq_fac = (f_nu(self.cc.c,fcol))**2
+        inst = inst_noise[:nzip]
 
-            # pl.add(self.evalells,inst_noise*self.evalells**2.,color="C"+str(ii))
-            # pl.add(self.evalells,N_ell_T_LA[ii]*self.evalells**2./ self.cc.c['TCMBmuK']**2.,color="C"+str(ii),ls="--")
-            
-            nells = self.cc.clttfunc(self.evalells)+inst_noise
-            self.nlinv_nofg += old_div((freq_fac),nells)
-            self.nlinv_cmb_nofg += (old_div(1.,inst_noise))
+        nells = cltt+inst
+        self.nlinv_nofg = (old_div((freq_fac),nells)).sum(axis=0)
+        self.nlinv_cmb_nofg = (old_div(1.,inst)).sum(axis=0)
 
-            totfg = (fgs.rad_ps(self.evalells,freq,freq) + fgs.cib_p(self.evalells,freq,freq) + \
-                      fgs.cib_c(self.evalells,freq,freq) + fgs.ksz_temp(self.evalells)) \
-                      / self.cc.c['TCMBmuK']**2. / ((self.evalells+1.)*self.evalells) * 2.* np.pi
-            nells += totfg
+        totfg = (fgs.rad_ps(ells,fcol,fcol) + fgs.cib_p(ells,fcol,fcol) + \
+                  fgs.cib_c(ells,fcol,fcol) + fgs.ksz_temp(ells)) * ellfac
+        nells = nells + totfg
 
-            if (tsz_cib):
-                tszcib = fgs.tSZ_CIB(self.evalells,freq,freq) \
-                         / self.cc.c['TCMBmuK']**2. / ((self.evalells+1.)*self.evalells) * 2.* np.pi
-                nells += tszcib
+        if (tsz_cib):
+            tszcib = fgs.tSZ_CIB(ells,fcol,fcol) * ellfac
+            nells += tszcib
 
-            self.nlinv += old_div((freq_fac),nells)
-            self.nlinv_cmb += (old_div(1.,(inst_noise+totfg)))
+        self.nlinv = (old_div((freq_fac),nells)).sum(axis=0)
+        self.nlinv_cmb = (old_div(1.,(inst+totfg))).sum(axis=0)
 
         # pl.add(self.evalells,self.cc.clttfunc(self.evalells)*self.evalells**2.,color='k',lw=3)
         # pl.done(io.dout_dir+"v3comp.png")
@@ -186,70 +194,42 @@ class SZ_Cluster_Model(object):
         self.nl_nofg = old_div(1.,self.nlinv_nofg)
         self.nl_cmb_nofg = old_div(1.,self.nlinv_cmb_nofg)
 
-        f_nu_tsz = f_nu(self.cc.c,np.array(freqs))
- 
-        if (len(freqs) > 1):
-            fq_mat   = np.matlib.repmat(freqs,len(freqs),1)
-            fq_mat_t = np.transpose(np.matlib.repmat(freqs,len(freqs),1))
-        else:
-            fq_mat   = np.array(freqs)
-            fq_mat_t = np.array(freqs)
-
-        self.nl = self.evalells*0.0
-
-        for ii in range(len(self.evalells)):
-            cmb_els = fq_mat*0.0 + self.cc.clttfunc(self.evalells[ii])
+        # tSZ ILC over the full frequency covariance
+        f_nu_tsz = f_nu(self.cc.c,freqs)
+        ells3 = ells[:,None,None]
+        ellfac3 = ellfac[:,None,None]
+        fq_mat   = freqs[None,:]
+        fq_mat_t = freqs[:,None]
 
+        if v3mode==4:
+            nells = old_div(np.moveaxis(N_ell_T_LA_full,-1,0), self.cc.c['TCMBmuK']**2.)
+        else:
+            nells = inst_noise.T[:,:,None]*np.eye(nfreqs)
+            # Adding in atmo. freq-freq correlations (freq i, freq j, row of N_ell_T_LA)
             if v3mode<0:
-                inst_noise = ( old_div(noise_func(self.evalells[ii],np.array(fwhms),np.array(rms_noises),lknee,alpha,dimensionless=False), self.cc.c['TCMBmuK']**2.))
-                nells = np.diag(inst_noise)
+                atm_pairs = []
             elif v3mode<=2:
-                ndiags = []
-                for ff in range(len(freqs)):
-                    inst_noise = old_div(N_ell_T_LA[ff,ii], self.cc.c['TCMBmuK']**2.)
-                    ndiags.append(inst_noise)
-                nells = np.diag(np.array(ndiags))
-                # Adding in atmo. freq-freq correlations
-                nells[0,1] = old_div(N_ell_T_LA[6,ii], self.cc.c['TCMBmuK']**2.)
-                nells[1,0] = old_div(N_ell_T_LA[6,ii], self.cc.c['TCMBmuK']**2.)
-                nells[2,3] = old_div(N_ell_T_LA[7,ii], self.cc.c['TCMBmuK']**2.)
-                nells[3,2] = old_div(N_ell_T_LA[7,ii], self.cc.c['TCMBmuK']**2.)
-                nells[4,5] = old_div(N_ell_T_LA[8,ii], self.cc.c['TCMBmuK']**2.)
-                nells[5,4] = old_div(N_ell_T_LA[8,ii], self.cc.c['TCMBmuK']**2.)
+                atm_pairs = [(0,1,6),(2,3,7),(4,5,8)]
             elif v3mode==3:
-                ndiags = []
-                for ff in range(len(freqs)):
-                    inst_noise = old_div(N_ell_T_LA[ff,ii], self.cc.c['TCMBmuK']**2.)
-                    ndiags.append(inst_noise)
-                nells = np.diag(np.array(ndiags))
-                # Adding in atmo. freq-freq correlations
-                nells[0,1] = old_div(N_ell_T_LA[5,ii], self.cc.c['TCMBmuK']**2.)
-                nells[1,0] = old_div(N_ell_T_LA[5,ii], self.cc.c['TCMBmuK']**2.)
-                nells[2,3] = old_div(N_ell_T_LA[6,ii], self.cc.c['TCMBmuK']**2.)
-                nells[3,2] = old_div(N_ell_T_LA[6,ii], self.cc.c['TCMBmuK']**2.)
-                nells[3,4] = old_div(N_ell_T_LA[7,ii], self.cc.c['TCMBmuK']**2.)
-                nells[4,3] = old_div(N_ell_T_LA[7,ii], self.cc.c['TCMBmuK']**2.)
-            elif v3mode==4:
-                nells = old_div(N_ell_T_LA_full[:,:,ii], self.cc.c['TCMBmuK']**2.)
-                # ndiags = []
-                # # Adding in atmo. freq-freq correlations
-                # for ff in range(len(freqs)):
-                #     for gg in range(len(freqs)):
-                #         inst_noise = old_div(N_ell_T_LA_full[ff,gg,ii], self.cc.c['TCMBmuK']**2.)
-                        
-            totfg = (fgs.rad_ps(self.evalells[ii],fq_mat,fq_mat_t) + fgs.cib_p(self.evalells[ii],fq_mat,fq_mat_t) 
-                     + fgs.cib_c(self.evalells[ii],fq_mat,fq_mat_t)) \
-                     / self.cc.c['TCMBmuK']**2. / ((self.evalells[ii]+1.)*self.evalells[ii]) * 2.* np.pi
-
-            if (tsz_cib):
-                totfg += fgs.tSZ_CIB(self.evalells[ii],fq_mat,fq_mat_t) / self.cc.c['TCMBmuK']**2. / ((self.evalells[ii]+1.)*self.evalells[ii]) * 2.* np.pi
-                totfg += fgs.tSZ(self.evalells[ii],fq_mat,fq_mat_t) / self.cc.c['TCMBmuK']**2. / ((self.evalells[ii]+1.)*self.evalells[ii]) * 2.* np.pi / 2. # factor of two accounts for resolved halos
-
-            ksz = fq_mat*0.0 + fgs.ksz_temp(self.evalells[ii]) / self.cc.c['TCMBmuK']**2. / ((self.evalells[ii]+1.)*self.evalells[ii]) * 2.* np.pi
-
-            nells += totfg + cmb_els + ksz
-
-            self.nl[ii] = old_div(1.,(np.dot(np.transpose(f_nu_tsz),np.dot(np.linalg.inv(nells),f_nu_tsz))))
+                atm_pairs = [(0,1,5),(2,3,6),(3,4,7)]
+            for fi,fj,row in atm_pairs:
+                nells[:,fi,fj] = old_div(N_ell_T_LA[row], self.cc.c['TCMBmuK']**2.)
+                nells[:,fj,fi] = old_div(N_ell_T_LA[row], self.cc.c['TCMBmuK']**2.)
+
+        totfg = (fgs.rad_ps(ells3,fq_mat,fq_mat_t) + fgs.cib_p(ells3,fq_mat,fq_mat_t) 
+                 + fgs.cib_c(ells3,fq_mat,fq_mat_t)) * ellfac3
+
+        if (tsz_cib):
+            totfg += fgs.tSZ_CIB(ells3,fq_mat,fq_mat_t) * ellfac3
+            totfg += fgs.tSZ(ells3,fq_mat,fq_mat_t) * ellfac3 / 2. # factor of two accounts for resolved halos
+
+        ksz = fgs.ksz_temp(ells)[:,None,None] * ellfac3
+
+        nells = nells + totfg + cltt[:,None,None] + ksz
+
+        # 1/(f^T N^-1 f) for every ell from one batched solve
+        Ninv_f = np.linalg.solve(nells,np.broadcast_to(f_nu_tsz[:,None],(ells.size,nfreqs,1)))[:,:,0]
+        self.nl = old_div(1.,np.dot(Ninv_f,f_nu_tsz))
 
         # from orphics.io import Plotter
         # pl = Plotter(yscale='log',xlabel='l',ylabel='D_l')
@@ -273,14 +253,98 @@ class SZ_Cluster_Model(object):
         self.g = lambda x: np.trapz(p(np.sqrt(pzrange**2.+x**2.)),pzrange,np.diff(pzrange))
 
         self.gxrange = np.linspace(0.,nMax,numps)
-        self.gint = np.array([self.g(x) for x in self.gxrange])
+        # line of sight projection of p for every x at once
+        self.gint = np.trapz(p(np.sqrt(pzrange[None,:]**2.+self.gxrange[:,None]**2.)),pzrange,axis=1)
 
         self.gnorm_pre = np.trapz(self.gxrange*self.gint,self.gxrange)
+        self._var_kernels = {}
+        self._form_factors = {}
+
+    def varKernel(self,smax,tmaxN=5.,numts=1000,dlns=1.e-3):
+        """
+        Hankel transform F(s) = int_0^tmaxN J0(s x) g(x) x dx of the projected
+        profile shape, as a spline in s = ell*theta500. quickVar's ell integrand
+        is F(ell*theta500)/(2 pi gnorm_pre) for every M and z, so this is
+        tabulated once (with quickVar's theta sampling) and extended only when
+        a larger s is requested.
+        """
+        key = (tmaxN,numts)
+        if key in self._var_kernels and self._var_kernels[key].x[-1]>=smax:
+            return self._var_kernels[key]
+        xs = np.linspace(0.,tmaxN,numts)
+        gx = np.array([self.g(x) for x in xs])
+        svals = np.append(0.,np.exp(np.arange(np.log(1.e-6),np.log(smax)+2.*dlns,dlns)))
+        F = np.zeros(svals.size)
+        for i in range(0,svals.size,1000):
+            F[i:i+1000] = np.trapz(j0(svals[i:i+1000,None]*xs[None,:])*gx*xs,xs,axis=-1)
+        self._var_kernels[key] = CubicSpline(svals,F)
+        return self._var_kernels[key]
+
+    def varTheta500(self,M,zs):
+        # theta500 = R500/D_A on the (M,z) grid, flattened
+        M = np.atleast_1d(M)
+        zs = np.atleast_1d(zs)
+        R500 = self.cc.rdel_c(M[:,None],zs,500.) # R500 in Mpc/h 
+        DAz = self.cc.DA_z(zs) * (self.cc.H0/100.)
+        return (R500/DAz).ravel()
+
+    def varNoise(self):
+        # the noise curve quickVar is evaluated with
+        if self.fg:
+            return self.nl
+        else:
+            return self.nl_nofg
+
+    def varKernelGrid(self,M,zs,tmaxN=5.,numts=1000,out=None,chunk_size=2**22):
+        """
+        Experiment independent part of quickVarGrid. Returns K with shape
+        (M.size,zs.size,evalells.size) such that the variance for a noise
+        curve N_ell on evalells is 1/np.dot(K,1/N_ell). K only depends on the
+        cosmology, the profile and the ell sampling, so it can be stored and
+        reused for any beam, noise level or frequency combination (see
+        szar.varkernel). out is an optional array (e.g. a memmap) to fill.
+        """
+        M = np.atleast_1d(M)
+        zs = np.atleast_1d(zs)
+        th500 = self.varTheta500(M,zs)
+        ells = self.evalells
+        wts = var_ell_weights(ells)/(2.*np.pi*self.gnorm_pre)**2.
+
+        kernel = self.varKernel(th500.max()*ells.max(),tmaxN,numts)
+        if out is None: out = np.empty((M.size,zs.size,ells.size))
+        K = out.reshape((th500.size,ells.size))
+        step = max(1,chunk_size//ells.size)
+        for i in range(0,th500.size,step):
+            K[i:i+step] = kernel(th500[i:i+step,None]*ells)**2.*wts
+        return out
+
+    def quickVarGrid(self,M,zs,tmaxN=5.,numts=1000,chunk_size=2**22):
+        """
+        quickVar on the full (M,z) grid. The tabulated varKernel is interpolated
+        at ell*theta500 for every cell and contracted against the trapezoid
+        weights of ell*2pi/N_ell. Returns the variance with shape (M.size,zs.size).
+        """
+        M = np.atleast_1d(M)
+        zs = np.atleast_1d(zs)
+        th500 = self.varTheta500(M,zs)
+
+        ells = self.evalells
+        wts = var_ell_weights(ells)/self.varNoise()
+
+        kernel = self.varKernel(th500.max()*ells.max(),tmaxN,numts)
+        step = max(1,chunk_size//ells.size)
+        varinv = np.zeros(th500.size)
+        for i in range(0,th500.size,step):
+            varinv[i:i+step] = np.dot(kernel(th500[i:i+step,None]*ells)**2.,wts)
+        varinv /= (2.*np.pi*self.gnorm_pre)**2.
+
+        return (1./varinv).reshape((M.size,zs.size))
+
     #@timeit
     def quickVar(self,M,z,tmaxN=5.,numts=1000):
 
         R500 = self.cc.rdel_c(M,z,500.).flatten()[0] # R500 in Mpc/h 
-        DAz = self.cc.results.angular_diameter_distance(z) * (self.cc.H0/100.)
+        DAz = self.cc.DA_z(z) * (self.cc.H0/100.)
         th500 = old_div(R500,DAz)
 
         gnorm = 2.*np.pi*(th500**2.)*self.gnorm_pre
@@ -312,84 +376,168 @@ class SZ_Cluster_Model(object):
         ans = old_div(P0, ((xx*xc)**gm * (1 + (xx*xc)**al)**(old_div((bt-gm),al))))
         return ans
 
+    def GNFWtau(self,xx,P0=4e3,xc=0.5,gm=0.2,al=0.88,bt=3.83):
+        # GNFW shape of the electron density (optical depth) profile
+        return self.GNFWvar(xx,P0,xc,gm,al,bt)
+
+    def formFactor(self,qmax,profile='y',xmax=5.,numxs=1000,dlnq=5.e-3):
+        """
+        Sine transform W(q) = int_0^xmax p(x) x^2 sin(q x)/(q x) dx of the
+        3D profile shape p (GNFW for profile='y', GNFWtau for 'tau'), as a
+        spline in q = ell/ell500 = ell*R500/D_A. The Fourier transform of the
+        profile of any cluster is W(ell*R500/D_A) scaled by R500^3/D_A^2 and
+        its amplitude, so this is tabulated once and extended only when a
+        larger q is requested.
+        """
+        key = (profile,xmax,numxs)
+        if key in self._form_factors and self._form_factors[key].x[-1]>=qmax:
+            return self._form_factors[key]
+        # at least 40 points per period of the sine at qmax
+        numxs = max(numxs,int(40.*qmax*xmax/2./np.pi)+1)
+        xs = np.linspace(0.,xmax,numxs)[1:]
+        if profile=='y':
+            px = self.GNFW(xs)
+        elif profile=='tau':
+            px = self.GNFWtau(xs)
+        else:
+            raise ValueError("Unknown profile "+str(profile))
+        wx = np.zeros(xs.size)
+        wx[1:] += np.diff(xs)/2.
+        wx[:-1] += np.diff(xs)/2.
+        wx[0] += xs[0]/2. # p(x) x^2 vanishes at x=0
+        px = px*xs**2.*wx
+        qvals = np.append(0.,np.exp(np.arange(np.log(1.e-4),np.log(max(qmax,1.e-3))+2.*dlnq,dlnq)))
+        W = np.zeros(qvals.size)
+        step = max(1,2**22//xs.size)
+        for i in range(0,qvals.size,step):
+            W[i:i+step] = np.dot(np.sinc(qvals[i:i+step,None]*xs/np.pi),px)
+        self._form_factors[key] = CubicSpline(qvals,W)
+        return self._form_factors[key]
+
     def Prof_tilde(self,ell,M,z):
-        dr = 0.01
-        R500 = self.cc.rdel_c(M,z,500.).flatten()[0] / (self.cc.H0/100.) # Mpc No hs
-        DA_z = self.cc.results.angular_diameter_distance(z) # No hs
-        rr = np.arange(dr,R500*5.0,dr)
+        """
+        Fourier transform of the y profile of a cluster of mass M (Msun, no
+        h) at z, from the tabulated formFactor. ell, M and z broadcast
+        against each other.
+        """
+        shape = np.broadcast(ell,M,z).shape
+        # the background functions of the cosmology only take 1D redshifts
+        zflat = np.ravel(z)
+        R500 = self.cc.rdel_c(M,z,500.) / (self.cc.H0/100.) # Mpc No hs
+        DA_z = self.cc.DA_z(zflat).reshape(np.shape(z)) # No hs
         M_fac = M / (3e14) * (100./self.cc.H0)
-        P500 = 1.65e-3 * (100./self.cc.H0)**2 * M_fac**(old_div(2.,3.)) * self.cc.E_z(z) #keV cm^3
-        intgrl = P500*np.sum(self.GNFW(old_div(rr,R500))*rr**2*np.sin(ell*rr/DA_z) / (ell*rr/DA_z) ) * dr
-        ans = 4.0*np.pi/DA_z**2 * intgrl
+        P500 = 1.65e-3 * (100./self.cc.H0)**2 * M_fac**(old_div(2.,3.)) * self.cc.E_z(zflat).reshape(np.shape(z)) #keV cm^3
+        q = ell*R500/DA_z
+        ans = 4.0*np.pi*R500**3./DA_z**2 * P500 * self.formFactor(np.max(q),'y')(q)
         ans *= self.cc.c['SIGMA_T']/(self.cc.c['ME']*self.cc.c['C']**2)*self.cc.c['MPC2CM']*self.cc.c['eV_2_erg']*1000.0
         #factor of 1000 to convert keV to eV
 
-        return ans
+        return ans.reshape(shape)
 
     def Prof_tilde_tau(self,ell,M,z):
-
-        P0 = 4e3
-        xc = 0.5
-        gm = 0.2
-        al = 0.88
-        bt = 3.83
-
-        dr = 0.01
-        R500 = self.cc.rdel_c(M,z,500.).flatten()[0]
-        DA_z = self.cc.results.angular_diameter_distance(z)
-        rr = np.arange(dr,R500*5.0,dr)
-        M_fac = M / (3e14) * (old_div(100.,70.))
+        """
+        Fourier transform of the optical depth profile (GNFWtau), as
+        Prof_tilde.
+        """
+        shape = np.broadcast(ell,M,z).shape
+        R500 = self.cc.rdel_c(M,z,500.)
+        DA_z = self.cc.DA_z(np.ravel(z)).reshape(np.shape(z))
         tau500 = 1.
-        intgrl = tau500*np.sum(self.GNFWtau(old_div(rr,R500),P0,xc,gm,al,bt)*rr**2*np.sin(ell*rr/DA_z) / (ell*rr/DA_z) ) * dr
-        ans = 4.0*np.pi/DA_z**2 * intgrl
+        q = ell*R500/DA_z
+        ans = 4.0*np.pi*R500**3./DA_z**2 * tau500 * self.formFactor(np.max(q),'tau')(q)
         ans *= self.cc.c['SIGMA_T'] # CHECK Units
         #/(self.cc.c['ME']*self.cc.c['C']**2)*self.cc.c['MPC2CM']*self.cc.c['eV_2_erg']*1000.0
 
-        return ans
-
-    def Pfunc(self,sigN,M,z_arr):
-
-        lnY = self.lnY
-
-        P_func = np.outer(M,np.zeros([len(z_arr)]))
-        M_arr =  np.outer(M,np.ones([len(z_arr)]))
-
-        for i in range(z_arr.size):
-            P_func[:,i] = self.P_of_q(lnY,M_arr[:,i],z_arr[i],sigN[:,i])
-            
-
-        return P_func
-
-    def Pfunc_qarr(self,sigN,M,z_arr,q_arr):
-
-        lnY = self.lnY
+        return ans.reshape(shape)
 
-        P_func = np.zeros((M.size,z_arr.size,q_arr.size))
-        M_arr =  np.outer(M,np.ones([z_arr.size]))
+    def Pfunc(self,sigN,M,z_arr,max_bytes=2**28):
+        # P_func(M,z) = P(q > qmin | M,z)
+        return self.Pfunc_kernel(sigN,M,z_arr,max_bytes=max_bytes)
 
+    def Pfunc_qarr(self,sigN,M,z_arr,q_arr,max_bytes=2**28):
         # P_func(M,z,q)
-        for i in range(z_arr.size):
-            P_func[:,i,:] = self.P_of_qn(lnY,M_arr[:,i],z_arr[i],sigN[:,i],q_arr)
-
-        return P_func
-
-    def Pfunc_qarr_corr(self,sigN,M,z_arr,q_arr,Mexp):#,mass_err):
-
-        M_wl = 10**Mexp
-
+        return self.Pfunc_kernel(sigN,M,z_arr,q_arr=q_arr,max_bytes=max_bytes)
+
+    def Pfunc_qarr_corr(self,sigN,M,z_arr,q_arr,Mexp,max_bytes=2**28):#,mass_err):
+        # P_func(M,z,q,Mwl)
+        return self.Pfunc_kernel(sigN,M,z_arr,q_arr=q_arr,Mwl=10**Mexp,max_bytes=max_bytes)
+
+    def Pfunc_kernel(self,sigN,M,z_arr,q_arr=None,Mwl=None,max_bytes=2**28):
+        """
+        Selection function on the whole (M,z) grid. The lnY integrand is built
+        for a block of redshifts at once and integrated against the detection
+        threshold (q_arr None), every q bin, or every (q,Mwl) bin with one
+        batched matrix product. The number of redshifts per block is chosen so
+        that the largest temporary stays under max_bytes.
+
+        Returns P_func with shape (M,z), (M,z,q) or (M,z,q,Mwl).
+        """
+        M = np.atleast_1d(M)
+        z_arr = np.atleast_1d(z_arr)
         lnY = self.lnY
+        dlnY = np.diff(lnY)
+        wts = np.zeros(lnY.size)
+        wts[1:] += dlnY/2.
+        wts[:-1] += dlnY/2.
+
+        shape = (M.size,z_arr.size)
+        nwidth = 1
+        if q_arr is not None:
+            shape += (q_arr.size,)
+            nwidth += q_arr.size
+        if Mwl is not None:
+            shape += (Mwl.size,)
+            nwidth += Mwl.size
+        P_func = np.zeros(shape)
+
+        zstep = int(max(1,max_bytes//(8*M.size*lnY.size*nwidth)))
+        for i in range(0,z_arr.size,zstep):
+            zs = z_arr[i:i+zstep]
+            Y = np.exp(lnY)/sigN[:,i:i+zstep,None] # Y in units of the noise, i.e. the true S/N
+            if Mwl is None:
+                P_Y = self.P_of_Y_grid(lnY,M,zs)*wts
+            else:
+                P_Y = self.P_of_Y_corr_grid(lnY,M,zs,Mwl)*wts[:,None]
+            if q_arr is None:
+                sig_thresh = 0.5 * (1. + special.erf(old_div((Y - self.qmin),np.sqrt(2.))))
+                P_func[:,i:i+zstep] = np.sum(P_Y*sig_thresh,axis=-1)
+            else:
+                # gaussian(q_arr,Y,1.) on (M,z,lnY,q), built in place
+                sig_thresh = Y[...,None] - q_arr
+                sig_thresh *= sig_thresh
+                sig_thresh *= -0.5
+                np.exp(sig_thresh,out=sig_thresh)
+                sig_thresh *= 1./np.sqrt(2*np.pi)
+                if Mwl is None:
+                    P_func[:,i:i+zstep,:] = np.matmul(P_Y[...,None,:],sig_thresh)[...,0,:]
+                else:
+                    P_func[:,i:i+zstep,:,:] = np.matmul(np.swapaxes(sig_thresh,-1,-2),P_Y)
+        return P_func
 
-        P_func = np.zeros((M.size,z_arr.size,q_arr.size,M_wl.size))
-        M_arr =  np.outer(M,np.ones([z_arr.size]))
+    def P_of_Y_grid(self,lnY,M,z_arr):
+        # P_of_Y on (M,z,lnY)
+        Ma = np.outer(M,np.ones(z_arr.size))
+        Ysig = self.scaling['Ysig'] * (1. + z_arr)**self.scaling['gammaYsig'] * (old_div(Ma,1e14))**self.scaling['betaYsig']
+        diff_Y = lnY - np.log(self.Y_M(Ma,z_arr))[...,None]
+        ans = 1./(Ysig[...,None] * np.sqrt(2*np.pi)) * np.exp(old_div(-1.*diff_Y**2,(2.*Ysig[...,None]**2)))
+        return ans
 
-        # P_func(M,z,q)
-        for i in range(z_arr.size):
-            for jj in range(M_wl.size):
-                P_func[:,i,:,jj] = self.P_of_qn_corr(lnY,M_arr[:,i],z_arr[i],sigN[:,i],q_arr,M_wl[jj])#,mass_err[:,i])
-        return P_func
+    def P_of_Y_corr_grid(self,lnY,M,z_arr,Mwl):
+        # P_of_Y_corr on (M,z,lnY,Mwl), the bivariate Gaussian of gaussianMat2D written out
+        Ma = np.outer(M,np.ones(z_arr.size))
+        Ysig = self.scaling['Ysig'] * (1. + z_arr)**self.scaling['gammaYsig'] * (old_div(Ma,1e14))**self.scaling['betaYsig']
+        Msig = self.scaling['Msig'] * (1. + z_arr)**self.scaling['gammaMsig'] * (old_div(Ma,1e14))**self.scaling['betaMsig']
+        rho = self.scaling['rho_corr'] * (1. + z_arr)**self.scaling['gammarho'] * (old_div(Ma,1e14))**self.scaling['betarho']
+        diff_Y = (lnY - np.log(self.Y_M(Ma,z_arr))[...,None])[...,None]
+        diff_M = np.log(Mwl*self.scaling['b_wl']/M[:,None])[:,None,None,:]
+        Ysig, Msig, rho = Ysig[...,None,None], Msig[...,None,None], rho[...,None,None]
+        expo = old_div((Msig**2*diff_Y**2 - 2.*rho*Ysig*Msig*diff_Y*diff_M + Ysig**2*diff_M**2), (Ysig**2*Msig**2*(1 - rho**2)))
+        ans = np.exp(-0.5 * expo)
+        ans /= gaussian2Dnorm(Ysig,Msig,rho)
+        return ans
 
     def Y_M(self,MM,zz):
-        DA_z = self.cc.results.angular_diameter_distance(zz) * (self.cc.H0/100.)
+        DA_z = self.cc.DA_z(zz) * (self.cc.H0/100.)
 
         Y_star = self.scaling['Y_star'] #= 2.42e-10 #sterads
         #dropped h70 factor
@@ -536,7 +684,7 @@ class Profiles(object):
         NNR = self.NNR
         drint = 1e-3 * (self.cc.c['MPC2CM'])
     
-        AngDist = self.cc.results.angular_diameter_distance(z) * self.cc.H0/100.
+        AngDist = self.cc.DA_z(z) * self.cc.H0/100.
 
         rvir = self.cc.rdel_c(Mvir,z,200)#/cc.c['MPC2CM']
         
@@ -597,7 +745,7 @@ class Profiles(object):
         fwhm = self.fwhm
 
         drint = 1e-3 * (self.cc.c['MPC2CM'])
-        AngDist = self.cc.results.angular_diameter_distance(z) * self.cc.H0/100.
+        AngDist = self.cc.DA_z(z) * self.cc.H0/100.
         disc_fac = self.disc_fac
         l0 = self.l0 
         NNR = self.NNR 
@@ -0,0 +1,159 @@
+"""
+Dynamic task farm over MPI ranks or local processes.
+
+run_tasks hands tasks out one at a time to whichever worker is free, so
+any number of workers can be used and slow tasks do not hold up a fixed
+block of others. With MPI, rank 0 only dispatches and collects results,
+and ranks 1..N-1 do the work. Queue depth and per-task timing are printed
+as results come in.
+"""
+from __future__ import print_function
+from __future__ import division
+from builtins import range
+import numpy as np
+import time
+
+_TASK = 1
+_RESULT = 2
+_STOP = 3
+
+def _timed_call(func,task):
+    t0 = time.time()
+    result = func(task)
+    return task,result,time.time()-t0
+
+class _TimedCall(object):
+    # picklable func wrapper for multiprocessing
+    def __init__(self,func):
+        self.func = func
+    def __call__(self,task):
+        return _timed_call(self.func,task)
+
+class FarmReport(object):
+    def __init__(self,ntasks,nworkers,name="task",verbose=True):
+        self.ntasks = ntasks
+        self.nworkers = nworkers
+        self.name = name
+        self.verbose = verbose
+        self.times = []
+        self.t0 = time.time()
+
+    def done(self,task,elapsed,in_flight):
+        self.times.append(elapsed)
+        if self.verbose:
+            ndone = len(self.times)
+            queued = self.ntasks-ndone-in_flight
+            print("[%d/%d] %s %s took %.2f s, %d queued, %d running" % (ndone,self.ntasks,self.name,str(task),elapsed,queued,in_flight))
+
+    def summary(self):
+        """
+        Dict of wall time, total and mean/max task time, and parallel
+        efficiency (task time over wall time x workers).
+        """
+        wall = time.time()-self.t0
+        times = np.array(self.times)
+        total = times.sum() if times.size>0 else 0.
+        return {'ntasks':len(self.times),'nworkers':self.nworkers,'wall_time':wall,'task_time':total,
+                'mean_task_time':times.mean() if times.size>0 else 0.,
+                'max_task_time':times.max() if times.size>0 else 0.,
+                'efficiency':total/wall/self.nworkers if wall>0. else 0.}
+
+    def print_summary(self):
+        s = self.summary()
+        print("%d %ss on %d worker(s) in %.1f s. Task time: total %.1f s, mean %.2f s, max %.2f s. Efficiency %.0f%%" % (
+            s['ntasks'],self.name,s['nworkers'],s['wall_time'],s['task_time'],s['mean_task_time'],s['max_task_time'],100.*s['efficiency']))
+
+def run_tasks(func,tasks,on_result=None,pool="serial",nprocs=None,initializer=None,initargs=(),name="task",verbose=True,comm=None):
+    """
+    Calls func(task) for every task and on_result(task,result) for every
+    result, in order of completion.
+
+    pool         "serial", "process" (a local multiprocessing pool of nprocs
+                 processes) or "mpi" (all ranks of comm must call run_tasks)
+    initializer  called as initializer(*initargs) once on every worker
+                 before its first task. For "mpi" the tasks, on_result and
+                 initargs of rank 0 are used; they are ignored on other ranks.
+    func and initializer must be module level functions for "process".
+
+    Returns a FarmReport summary dict (on rank 0 for "mpi", None on the
+    other ranks).
+    """
+    if pool=="serial":
+        return _run_serial(func,tasks,on_result,initializer,initargs,name,verbose)
+    elif pool=="process":
+        return _run_process(func,tasks,on_result,nprocs,initializer,initargs,name,verbose)
+    elif pool=="mpi":
+        return _run_mpi(func,tasks,on_result,initializer,initargs,name,verbose,comm)
+    else:
+        raise ValueError("Unknown pool "+str(pool))
+
+def _run_serial(func,tasks,on_result,initializer,initargs,name,verbose):
+    tasks = list(tasks)
+    if initializer is not None: initializer(*initargs)
+    report = FarmReport(len(tasks),1,name,verbose)
+    for task in tasks:
+        task,result,elapsed = _timed_call(func,task)
+        report.done(task,elapsed,0)
+        if on_result is not None: on_result(task,result)
+    if verbose: report.print_summary()
+    return report.summary()
+
+def _run_process(func,tasks,on_result,nprocs,initializer,initargs,name,verbose):
+    import multiprocessing
+    tasks = list(tasks)
+    if nprocs is None: nprocs = multiprocessing.cpu_count()
+    report = FarmReport(len(tasks),nprocs,name,verbose)
+    pool = multiprocessing.Pool(nprocs,initializer=initializer,initargs=initargs)
+    try:
+        # chunksize 1 so that tasks are handed out as workers free up
+        for task,result,elapsed in pool.imap_unordered(_TimedCall(func),tasks,chunksize=1):
+            ndone = len(report.times)+1
+            report.done(task,elapsed,min(nprocs,len(tasks)-ndone))
+            if on_result is not None: on_result(task,result)
+    finally:
+        pool.close()
+        pool.join()
+    if verbose: report.print_summary()
+    return report.summary()
+
+def _run_mpi(func,tasks,on_result,initializer,initargs,name,verbose,comm):
+    from mpi4py import MPI
+    if comm is None: comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+    if size==1:
+        return _run_serial(func,tasks,on_result,initializer,initargs,name,verbose)
+
+    initargs = comm.bcast(initargs if rank==0 else None, root=0)
+    status = MPI.Status()
+    if rank!=0:
+        if initializer is not None: initializer(*initargs)
+        while True:
+            task = comm.recv(source=0,tag=MPI.ANY_TAG,status=status)
+            if status.Get_tag()==_STOP: break
+            comm.send(_timed_call(func,task),dest=0,tag=_RESULT)
+        return None
+
+    pending = list(tasks)
+    pending.reverse()
+    report = FarmReport(len(pending),size-1,name,verbose)
+    in_flight = 0
+    for worker in range(1,size):
+        if pending:
+            comm.send(pending.pop(),dest=worker,tag=_TASK)
+            in_flight += 1
+        else:
+            comm.send(None,dest=worker,tag=_STOP)
+    while in_flight>0:
+        task,result,elapsed = comm.recv(source=MPI.ANY_SOURCE,tag=_RESULT,status=status)
+        worker = status.Get_source()
+        in_flight -= 1
+        if pending:
+            comm.send(pending.pop(),dest=worker,tag=_TASK)
+            in_flight += 1
+        else:
+            comm.send(None,dest=worker,tag=_STOP)
+        report.done(task,elapsed,in_flight)
+        if on_result is not None: on_result(task,result)
+    if verbose: report.print_summary()
+    return report.summary()
@@ -4,6 +4,7 @@ from builtins import range
 from past.utils import old_div
 import numpy as np
 from scipy.interpolate import InterpolatedUnivariateSpline as iuSpline
+from scipy.interpolate import CubicSpline
 np.seterr(divide='ignore', invalid='ignore')
 
 # Tinker stuff
@@ -128,6 +129,112 @@ def sigma_sq_integral(R_grid, power_spt, k_val):
     
     return np.trapz((old_div(1,(2*np.pi**2)))*to_integ, k_val, axis = 0, dx=1e-6)
 
+def sigma_sq_weights(k_val):
+    """
+    Returns trapezoid quadrature weights on the k grid, including the
+    k^2/(2 pi^2) measure, so that sigma^2 = sum_k w_k W^2(kR) P(k).
+    """
+    k_val = np.asarray(k_val,dtype=np.float64)
+    dk = np.diff(k_val)
+    w = np.zeros(k_val.size)
+    w[:-1] += 0.5*dk
+    w[1:] += 0.5*dk
+    return w*k_val**2/(2.*np.pi**2)
+
+class SigmaSqEngine(object):
+    """
+    Batched sigma^2(R) over an (nM, nz) grid of radii for a fixed k grid.
+
+    The quadrature weights are computed once per k grid. If the radii do not
+    depend on redshift (R is (nM,) or (nM,1), or every column is equal) sigma^2
+    is a single (nM,nk)x(nk,nz) matrix product. Otherwise the window is built
+    in blocks of mass rows so that at most max_block elements of the
+    (nM, nz, nk) integrand exist at any time.
+
+    With table_step (in dex) set, z-dependent radii are instead handled by
+    evaluating sigma^2 on a log-spaced R table with one matrix product and
+    cubic-spline interpolating log sigma^2 in log R for each redshift. A step
+    of 0.002 dex agrees with the direct sum to ~1e-9.
+    """
+    def __init__(self,k_val,max_block=2**16):
+        self.k = np.asarray(k_val,dtype=np.float64)
+        self.weights = sigma_sq_weights(self.k)
+        self.max_block = max_block
+
+    def window_sq(self,R):
+        kR = R[...,None]*self.k
+        return top_hatf(kR)**2
+
+    def tabulated(self,R,Pw,table_step):
+        lR = np.log10(R)
+        ltab = np.arange(lR.min()-2*table_step,lR.max()+3*table_step,table_step)
+        nk = self.k.size
+        chunk_size = max(1,self.max_block//nk)
+        sig2tab = np.empty((ltab.size,Pw.shape[0]))
+        for i in range(0,ltab.size,chunk_size):
+            sig2tab[i:i+chunk_size] = np.dot(self.window_sq(10**ltab[i:i+chunk_size]),Pw.T)
+        coeffs = CubicSpline(ltab,np.log(sig2tab),axis=0).c # (4, nR-1, nz)
+        idx = np.clip(np.searchsorted(ltab,lR)-1,0,ltab.size-2)
+        t = lR - ltab[idx]
+        zcol = np.broadcast_to(np.arange(lR.shape[1]),lR.shape)
+        c = coeffs[:,idx,zcol]
+        return np.exp(((c[0]*t + c[1])*t + c[2])*t + c[3])
+
+    def __call__(self,R_grid,power_spt,chunk_size=None,table_step=None):
+        """
+        R_grid     is  (nM), (nM,1) or (nM, nz)
+        power_spt  is  (nz,nk) or (1,nk)
+
+        return is  (nM,nz)
+        """
+        R = np.asarray(R_grid,dtype=np.float64)
+        if R.ndim == 1:
+            R = R[:,None]
+        Pw = np.atleast_2d(power_spt)*self.weights
+        nM = R.shape[0]
+        nz = max(R.shape[1],Pw.shape[0])
+        nk = self.k.size
+
+        if R.shape[1] == 1 or np.all(R == R[:,:1]):
+            if chunk_size is None:
+                chunk_size = max(1,self.max_block//nk)
+            out = np.empty((nM,Pw.shape[0]))
+            for i in range(0,nM,chunk_size):
+                out[i:i+chunk_size] = np.dot(self.window_sq(R[i:i+chunk_size,0]),Pw.T)
+            return np.broadcast_to(out,(nM,nz)).copy()
+
+        R = np.broadcast_to(R,(nM,nz))
+        if table_step is not None:
+            return self.tabulated(R,np.broadcast_to(Pw,(nz,nk)),table_step)
+        Pw = np.broadcast_to(Pw,(nz,nk))
+        if chunk_size is None:
+            chunk_size = max(1,self.max_block//(nz*nk))
+        out = np.empty((nM,nz))
+        for i in range(0,nM,chunk_size):
+            out[i:i+chunk_size] = np.einsum('mzk,zk->mz',self.window_sq(R[i:i+chunk_size]),Pw)
+        return out
+
+_sigma_sq_engines = {}
+
+def get_sigma_sq_engine(k_val):
+    """
+    Returns a SigmaSqEngine for this k grid, reusing the one built on a
+    previous call if the grid is unchanged.
+    """
+    k_val = np.asarray(k_val,dtype=np.float64)
+    key = (k_val.size,k_val.tobytes())
+    if key not in _sigma_sq_engines:
+        if len(_sigma_sq_engines) > 16: _sigma_sq_engines.clear()
+        _sigma_sq_engines[key] = SigmaSqEngine(k_val)
+    return _sigma_sq_engines[key]
+
+def sigma_sq_batched(R_grid, power_spt, k_val, chunk_size=None, table_step=None):
+    """
+    Same as sigma_sq_integral but evaluated with a cached SigmaSqEngine
+    instead of stacking the full (nk, nM, nz) integrand.
+    """
+    return get_sigma_sq_engine(k_val)(R_grid,power_spt,chunk_size=chunk_size,table_step=table_step)
+
 def fnl_correction(sigma2,fnl):
     d_c = 1.686
     S3 = 3.15e-4 * fnl / (sigma2**(old_div(0.838,2.0)))
@@ -155,7 +262,7 @@ def dn_dlogM(M, z, rho, delta, k, P, comoving=False):
     if not comoving:  # if you do this make sure rho still has shape of z.
         R =  R * np.transpose(1+z)
     # Fluctuations on those scales (P and k are comoving)
-    sigma = sigma_sq_integral(R, P, k)**.5
+    sigma = sigma_sq_batched(R, P, k, table_step=0.002)**.5
     # d log(sigma^-1)
     ## gradient is broken.
     if R.shape[-1] == 1:
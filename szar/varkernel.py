@@ -0,0 +1,112 @@
+"""
+On-disk cache of the SZ variance kernel K[M,z,ell].
+
+The quickVar inverse variance is int |u(ell;M,z)|^2 2 pi ell / N_ell dell.
+The filter part |u|^2 (with the ell quadrature weights) only depends on
+the cosmology, the pressure profile and the ell sampling, so it is computed
+once per grid by SZ_Cluster_Model.varKernelGrid and stored here. The
+variance for any experiment is then one matrix product with 1/N_ell (see
+sigN_from_var_kernel), which makes sweeps over noise levels, beams, knees
+and frequencies cheap and serial.
+
+A kernel is a directory holding
+
+    K.npy     the (M,z,ell) kernel, read as a memory map
+    grid.npz  mass and redshift bin edges, ells, tmaxN, numts and the
+              config hash
+
+and is named after the hash of the config sections it depends on, so
+kernels for different cosmologies or profiles live side by side.
+"""
+from __future__ import print_function
+from __future__ import division
+from builtins import object
+import numpy as np
+import os
+from szar.derivarchive import config_hash
+
+def var_kernel_path(bigDataDir,gridName,confighash):
+    return bigDataDir+"varkernel_"+gridName+"_"+confighash
+
+def var_kernel_hash(Config,gridName):
+    """
+    Hash of the config sections the kernel depends on.
+    """
+    return config_hash(Config,['params','constants','cluster_params',gridName])
+
+def sigN_from_var_kernel(K,ells,noise,noise_ells=None,chunk_size=2**22):
+    """
+    sigN = (K . 1/N_ell)^-1/2 on the (M,z) grid of K.
+
+    ells        the ells K was made on
+    noise       N_ell, on ells or on noise_ells (then interpolated onto ells)
+    """
+    if noise_ells is not None:
+        noise = np.interp(ells,noise_ells,noise)
+    ninv = 1./np.asarray(noise)
+    nm,nz,nl = K.shape
+    Kflat = K.reshape((nm*nz,nl))
+    varinv = np.zeros(nm*nz)
+    step = max(1,chunk_size//nl)
+    for i in range(0,nm*nz,step):
+        varinv[i:i+step] = np.dot(Kflat[i:i+step],ninv)
+    return (varinv**-0.5).reshape((nm,nz))
+
+class VarKernel(object):
+    def __init__(self,path):
+        self.path = path
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.path,"grid.npz"))
+
+    def grid(self):
+        """
+        Returns mexp_edges, z_edges, ells, tmaxN, numts and the config hash.
+        """
+        with np.load(os.path.join(self.path,"grid.npz")) as data:
+            return (data['mexp_edges'],data['z_edges'],data['ells'],float(data['tmaxN']),
+                    int(data['numts']),str(data['config_hash']))
+
+    def matches(self,mexp_edges,z_edges,ells,tmaxN=5.,numts=1000,confighash=""):
+        if not(self.exists()): return False
+        old_m,old_z,old_ells,old_tmaxN,old_numts,old_hash = self.grid()
+        return (old_m.shape==np.shape(mexp_edges) and old_z.shape==np.shape(z_edges) and old_ells.shape==np.shape(ells)
+                and np.allclose(old_m,mexp_edges) and np.allclose(old_z,z_edges) and np.allclose(old_ells,ells)
+                and np.isclose(old_tmaxN,tmaxN) and old_numts==numts and old_hash==confighash)
+
+    def save(self,K,mexp_edges,z_edges,ells,tmaxN=5.,numts=1000,confighash=""):
+        if not os.path.exists(self.path): os.makedirs(self.path)
+        filename = os.path.join(self.path,"K.npy")
+        tmp = filename+".tmp"+str(os.getpid())+".npy"
+        np.save(tmp,K)
+        os.replace(tmp,filename)
+        filename = os.path.join(self.path,"grid.npz")
+        tmp = filename+".tmp"+str(os.getpid())+".npz"
+        np.savez(tmp,mexp_edges=mexp_edges,z_edges=z_edges,ells=ells,tmaxN=tmaxN,numts=numts,config_hash=confighash)
+        os.replace(tmp,filename)
+
+    def load(self,mmap=True):
+        return np.load(os.path.join(self.path,"K.npy"),mmap_mode='r' if mmap else None)
+
+    def sigN(self,noise,noise_ells=None):
+        ells = self.grid()[2]
+        return sigN_from_var_kernel(self.load(),ells,noise,noise_ells)
+
+def var_kernel_from_config(Config,bigDataDir,gridName,SZCluster,mexp_edges,z_edges,tmaxN=5.,numts=1000):
+    """
+    The variance kernel for the grid gridName and SZCluster's cosmology,
+    profile and ell sampling. It is read from bigDataDir if it was made
+    before, and computed and stored otherwise.
+    """
+    confighash = var_kernel_hash(Config,gridName)
+    vk = VarKernel(var_kernel_path(bigDataDir,gridName,confighash))
+    if vk.matches(mexp_edges,z_edges,SZCluster.evalells,tmaxN,numts,confighash):
+        print("Using variance kernel in ",vk.path)
+        return vk
+    print("Calculating variance kernel...")
+    M_edges = 10**np.asarray(mexp_edges)
+    M = (M_edges[1:]+M_edges[:-1])/2.
+    zs = (np.asarray(z_edges)[1:]+np.asarray(z_edges)[:-1])/2.
+    K = SZCluster.varKernelGrid(M,zs,tmaxN,numts)
+    vk.save(K,mexp_edges,z_edges,SZCluster.evalells,tmaxN,numts,confighash)
+    return vk
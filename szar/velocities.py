@@ -64,7 +64,7 @@ class pairwise(object):
         dndm_SZ = self.HMF.dn_dmz_SZ(self.SZprop)
 
         R = tinker.radius_from_mass(self.HMF.M200,self.cc.rhoc0om)
-        sigsq = tinker.sigma_sq_integral(R, self.HMF.pk, self.HMF.kh)
+        sigsq = tinker.sigma_sq_batched(R, self.HMF.pk, self.HMF.kh)
 
         blin = tinker.tinker_bias(sigsq,200.)
         #add loop over k for bweight / bnorm
@@ -56,12 +56,15 @@ HMF = Halo_MF(cc,Mexpedge,zedge)
 
 print("PS test")
 
-#start = time.time()
-#print SZ.Prof_tilde(3000,MM,zz)
-#print "Time for new", time.time() - start
-#start2 = time.time()
-#print SZ.Prof_tilde_old(3000,MM,zz)
-#print "Time for old", time.time() - start2
+# tabulated form factor against a direct sine transform of the profile
+R500 = cc.rdel_c(MM,zz,500.).flatten()[0] / (cc.H0/100.)
+DA_z = cc.results.angular_diameter_distance(zz)
+rr = np.linspace(0.,5.*R500,100001)[1:]
+for ell in [100.,3000.,8000.]:
+    direct = np.trapz(SZ.GNFW(rr/R500)*rr**2*np.sinc(ell*rr/DA_z/np.pi),rr)
+    ratio = SZ.Prof_tilde(ell,MM,zz)/SZ.Prof_tilde(0.,MM,zz) / (direct/np.trapz(SZ.GNFW(rr/R500)*rr**2,rr))
+    print(("Prof_tilde at ell ", ell, " rel. diff ", ratio-1.))
+    assert np.isclose(ratio,1.,rtol=1e-4)
 
 ll = np.arange(200,7000,200)
 start3 = time.time()
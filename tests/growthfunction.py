@@ -1,4 +1,6 @@
 import numpy as np
+import time
+from scipy.integrate import quad
 from szar.counts import ClusterCosmology
 from configparser import ConfigParser
 from orphics.io import dict_from_section,list_from_config
@@ -32,7 +34,16 @@ zarrs = np.linspace(0,9,1000)
 scalefacs = 1/(1+zarrs)
 scalefacs = np.flip(scalefacs)
 
+t0 = time.time()
 gfunc = cc.growthfunc(zarrs)
+print("growthfunc on ", zarrs.size, " redshifts took ", time.time()-t0, " s")
+
+# tabulated growth against the direct integral
+for z in [0.,0.5,2.,9.]:
+    a = 1./(1.+z)
+    direct = 5.*Om/2.*cc.E_z(z)*quad(lambda x: 1./(x*cc.E_z(1./x-1.))**3.,1.e-6,a,epsrel=1.e-10,limit=500)[0]
+    print("D at z=", z, " rel. diff ", cc.growthfunc(z)/direct-1.)
+    assert np.isclose(cc.growthfunc(z),direct,rtol=1e-6)
 gfunc_of_a = np.flip(gfunc)
 
 plt.plot(scalefacs, gfunc_of_a)
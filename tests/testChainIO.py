@@ -0,0 +1,66 @@
+from __future__ import print_function
+from __future__ import division
+import numpy as np
+import os
+import shutil
+import tempfile
+from szar.chainio import ChainWriter, load_chain
+
+# A toy sampler in place of emcee: a random walk driven by a RandomState,
+# yielding (position, lnprob, blobs, random_state) like emcee's sample().
+nwalkers, ndim = 6, 3
+
+def run(writer,pos,rstate,nsteps):
+    rng = np.random.RandomState()
+    rng.set_state(rstate)
+    for i in range(nsteps):
+        pos = pos+0.1*rng.normal(size=(nwalkers,ndim))
+        lnprob = -0.5*np.sum(pos**2.,axis=1)
+        writer.add(pos,lnprob,list(pos[:,0]*0.5+0.8),rng.get_state())
+    return pos
+
+pos0 = np.random.RandomState(1).normal(size=(nwalkers,ndim))
+rstate0 = np.random.RandomState(2).get_state()
+tmp = tempfile.mkdtemp()
+try:
+    # reference chain written in one go, with a partial last chunk
+    ref_dir = os.path.join(tmp,"ref")
+    writer = ChainWriter(ref_dir,nwalkers,ndim,flush_every=10)
+    run(writer,pos0,rstate0,35)
+    writer.close()
+    ref_pos,ref_lnprob,ref_s8 = load_chain(ref_dir)
+    assert ref_pos.shape==(35,nwalkers,ndim) and ref_lnprob.shape==(35,nwalkers) and ref_s8.shape==(35,nwalkers)
+    assert np.allclose(ref_lnprob,-0.5*np.sum(ref_pos**2.,axis=2))
+    assert np.allclose(ref_s8,ref_pos[:,:,0]*0.5+0.8)
+    assert writer.nchunks==4
+
+    # a job killed after 25 steps: two flushes on disk, five steps lost
+    chain_dir = os.path.join(tmp,"chain")
+    writer = ChainWriter(chain_dir,nwalkers,ndim,flush_every=10)
+    run(writer,pos0,rstate0,25)
+    pos,lnprob,s8 = load_chain(chain_dir)
+    assert pos.shape[0]==20
+    assert np.array_equal(pos,ref_pos[:20]) and np.array_equal(lnprob,ref_lnprob[:20]) and np.array_equal(s8,ref_s8[:20])
+    # and a chunk that made it to disk without its state
+    np.savez(os.path.join(chain_dir,"chunk_%06d.npz" % 2),position=ref_pos[20:30],
+             lnprob=ref_lnprob[20:30],s8=ref_s8[20:30],step0=20)
+
+    # resume from the last state, which reproduces the reference chain
+    writer = ChainWriter(chain_dir,nwalkers,ndim,flush_every=10,resume=True)
+    state = writer.last_state()
+    assert writer.nsteps==20 and state['nsteps']==20 and writer.nchunks==2
+    assert np.array_equal(state['position'],ref_pos[19]) and np.array_equal(state['lnprob'],ref_lnprob[19])
+    assert np.allclose(state['blobs'],ref_s8[19])
+    run(writer,state['position'],state['random_state'],15)
+    writer.close()
+    assert writer.nsteps==35
+    pos,lnprob,s8 = load_chain(chain_dir)
+    assert pos.shape==ref_pos.shape
+    assert np.array_equal(pos,ref_pos) and np.array_equal(lnprob,ref_lnprob) and np.array_equal(s8,ref_s8)
+
+    # without resume the old chain is removed
+    writer = ChainWriter(chain_dir,nwalkers,ndim,flush_every=10)
+    assert writer.nsteps==0 and writer.nchunks==0 and writer.last_state() is None
+finally:
+    shutil.rmtree(tmp)
+print("Tests of buffered chain storage passed!")
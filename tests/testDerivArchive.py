@@ -0,0 +1,101 @@
+from __future__ import print_function
+from __future__ import division
+from past.utils import old_div
+import numpy as np
+import tempfile
+import shutil
+import os
+from szar.derivarchive import DerivArchive
+from szar import fisher
+
+# Round trip of the derivative archive (float64, float32 and compressed),
+# lazy slicing, legacy .npy export, and a Fisher matrix read from the
+# archive against one read from the legacy files.
+
+paramList = ["H0","ombh2","omch2","tau","As","ns","b_ym","alpha_ym","Ysig","b_wl"]
+mexp_edges = np.arange(13.5,15.72,0.03)
+z_edges = np.arange(0.,3.05,0.1)
+qbin_edges = np.logspace(np.log10(6.),np.log10(500.),7)
+shape = (mexp_edges.size-1,z_edges.size-1,qbin_edges.size-1)
+pzcutoff = 2.0
+fsky = 0.4
+
+np.random.seed(2)
+fid = np.abs(np.random.normal(size=shape))
+ups = {}
+dns = {}
+steps = {}
+for param in paramList:
+    if param=='tau': continue
+    ups[param] = fid*(1.+0.1*np.random.normal(size=shape))
+    dns[param] = fid*(1.+0.1*np.random.normal(size=shape))
+    steps[param] = np.random.uniform(0.01,1.)
+
+tmpdir = tempfile.mkdtemp()
+try:
+    for dtype,compress,rtol in [(np.float64,False,1e-15),(np.float32,False,1e-6),(np.float32,True,1e-6)]:
+        path = os.path.join(tmpdir,"derivs_test_"+np.dtype(dtype).name+str(compress))
+        archive = DerivArchive(path,dtype=dtype,compress=compress)
+        archive.save_grid(mexp_edges,z_edges,qbin_edges,"hash")
+        archive.save_fid(fid)
+        for param in ups.keys(): archive.save_param(param,ups[param],dns[param],steps[param])
+
+        archive = DerivArchive(path)
+        assert archive.exists()
+        m,z,q,h = archive.grid(return_hash=True)
+        assert np.all(m==mexp_edges) and np.all(z==z_edges) and np.all(q==qbin_edges) and h=="hash"
+        assert archive.params()==sorted(ups.keys())
+        assert np.allclose(archive.fid(),fid,rtol=rtol,atol=0.)
+        for param in ups.keys():
+            dNdp = old_div((ups[param]-dns[param]),steps[param])
+            assert archive.step(param)==steps[param]
+            assert np.allclose(archive.up(param),ups[param],rtol=rtol,atol=0.)
+            assert np.allclose(archive.dn(param),dns[param],rtol=rtol,atol=0.)
+            assert np.allclose(archive.deriv(param),dNdp,rtol=rtol,atol=rtol*np.abs(dNdp).max())
+            sl = (slice(10,20),3,slice(None))
+            assert np.all(archive.deriv(param,sl)==archive.deriv(param)[sl])
+            assert archive.deriv(param).dtype==np.float64
+
+        # a different grid or config is refused
+        try:
+            archive.save_grid(mexp_edges,z_edges,qbin_edges,"other")
+            raise AssertionError("save_grid accepted a different config hash")
+        except ValueError:
+            pass
+
+    # Fisher from the float64 archive and from the exported legacy files
+    archive = DerivArchive(os.path.join(tmpdir,"derivs_test_float64False"))
+    archive.export_npy(tmpdir+"/","test")
+    derivRoot = fisher.deriv_root(tmpdir+"/","test")
+    new_z_edges, N_fid = fisher.rebinN(np.load(fisher.fid_file(tmpdir+"/","test")),pzcutoff,z_edges)
+    N_fid = N_fid*fsky
+    Fnpy = fisher.getFisher(N_fid,paramList,["tau"],[0.01],derivRoot,pzcutoff,z_edges,fsky)
+    Farc = fisher.getFisher(N_fid,paramList,["tau"],[0.01],archive,pzcutoff,z_edges,fsky,mmap=True)
+    assert np.allclose(Farc,Fnpy,rtol=1e-14,atol=0.)
+
+    # an archive missing some parameters and fiducials falls back to the
+    # legacy files one parameter at a time
+    saveId = "partial"
+    partial = DerivArchive(os.path.join(tmpdir,"derivs_"+saveId))
+    partial.save_grid(mexp_edges,z_edges,qbin_edges,"hash")
+    partial.save_fid(fid)
+    legacy = [param for param in ups.keys()][:3]
+    for param in ups.keys():
+        if param in legacy:
+            shutil.copy(derivRoot+param+".npy",fisher.deriv_root(tmpdir+"/",saveId)+param+".npy")
+        else:
+            partial.save_param(param,ups[param],dns[param],steps[param])
+    np.save(tmpdir+"/N_mzq_"+saveId+"_fid_sigma8.npy",2.*fid)
+    assert np.all(fisher.fid_counts(tmpdir+"/",saveId)==fid)
+    assert np.all(fisher.fid_counts(tmpdir+"/",saveId,"fid_sigma8")==2.*fid)
+    Fmix = fisher.getFisher(N_fid,paramList,["tau"],[0.01],fisher.deriv_sources(tmpdir+"/",saveId),pzcutoff,z_edges,fsky)
+    assert np.allclose(Fmix,Fnpy,rtol=1e-14,atol=0.)
+    try:
+        fisher.load_deriv(fisher.deriv_sources(tmpdir+"/",saveId),"nonexistent")
+        raise AssertionError("load_deriv found a missing parameter")
+    except KeyError:
+        pass
+finally:
+    shutil.rmtree(tmpdir)
+
+print("Tests of derivative archive passed!")
@@ -0,0 +1,118 @@
+from __future__ import print_function
+from __future__ import division
+from past.utils import old_div
+import numpy as np
+import itertools
+import tempfile
+import shutil
+import time
+import os
+from szar.counts import rebinN
+from szar import fisher
+
+# Compares the stacked single-pass Fisher with the original pairwise loop
+# over parameter combinations, on random derivatives written to a temporary
+# directory.
+
+def pairwise_fisher(N_fid,paramList,priorNameList,priorValueList,derivRoot,pzcutoff,z_edges,fsky):
+    numParams = len(paramList)
+    Fisher = np.zeros((numParams,numParams))
+    for param1,param2 in itertools.combinations_with_replacement(paramList,2):
+        i = paramList.index(param1)
+        j = paramList.index(param2)
+        if not(param1=='tau' or param2=='tau'):
+            new_z_edges, dN1 = rebinN(np.load(derivRoot+param1+".npy"),pzcutoff,z_edges)
+            new_z_edges, dN2 = rebinN(np.load(derivRoot+param2+".npy"),pzcutoff,z_edges)
+            with np.errstate(divide='ignore'):
+                Fell = (dN1*fsky*dN2*fsky*np.nan_to_num(old_div(1.,N_fid))).sum()
+        else:
+            Fell = 0.
+        if i==j and (param1 in priorNameList):
+            priorVal = old_div(1.,priorValueList[priorNameList.index(param1)]**2.)
+        else:
+            priorVal = 0.
+        Fisher[i,j] = Fell+priorVal
+        if j!=i: Fisher[j,i] = Fell
+    return Fisher
+
+paramList = ["H0","ombh2","omch2","tau","As","ns","mnu","w0","wa","b_ym","alpha_ym","Ysig",
+             "gamma_ym","beta_ym","gammaYsig","betaYsig","b_wl","wa2","w02","ns2"]
+priorNameList = ["tau","b_wl","H0"]
+priorValueList = [0.01,0.01,10.]
+z_edges = np.arange(0.,3.05,0.1)
+pzcutoff = 2.0
+fsky = 0.4
+nm, nq = 74, 6
+
+np.random.seed(1)
+tmpdir = tempfile.mkdtemp()
+try:
+    derivRoot = os.path.join(tmpdir,"dNdp_mzq_test_")
+    for param in paramList:
+        if param=='tau': continue
+        np.save(derivRoot+param+".npy",np.random.normal(size=(nm,z_edges.size-1,nq)))
+    N = np.abs(np.random.normal(size=(nm,z_edges.size-1,nq)))
+    N[0,0,0] = 0.
+    new_z_edges, N_fid = rebinN(N,pzcutoff,z_edges)
+    N_fid = N_fid*fsky
+
+    t0 = time.time()
+    Fref = pairwise_fisher(N_fid,paramList,priorNameList,priorValueList,derivRoot,pzcutoff,z_edges,fsky)
+    t_ref = time.time()-t0
+    t0 = time.time()
+    F = fisher.getFisher(N_fid,paramList,priorNameList,priorValueList,derivRoot,pzcutoff,z_edges,fsky)
+    t_new = time.time()-t0
+    Fmmap = fisher.getFisher(N_fid,paramList,priorNameList,priorValueList,derivRoot,pzcutoff,z_edges,fsky,
+                             mmap=True,stack_file=os.path.join(tmpdir,"stack.npy"))
+    dNs = fisher.stack_derivs(paramList,derivRoot,pzcutoff,z_edges,fsky)
+    Fchunk = fisher.fisher_from_stack(dNs,N_fid,chunk_size=1000)
+
+    for Ftest in [F,Fmmap]:
+        assert np.allclose(Ftest,Fref,rtol=1e-12,atol=1e-10*np.abs(Fref).max())
+    assert np.allclose(Fchunk,fisher.fisher_from_stack(dNs,N_fid),rtol=1e-12,atol=0.)
+    print("Pairwise Fisher : ",t_ref*1e3," ms")
+    print("Stacked Fisher  : ",t_new*1e3," ms, speedup ",t_ref/t_new)
+
+    # super sample variance against a dense inverse of the full covariance,
+    # on a smaller grid with shells merged above pzcutoff
+    sv_edges = np.arange(0.,3.05,0.25)
+    Nsmall = np.abs(np.random.normal(size=(nm,sv_edges.size-1,2)))*50.
+    Nsmall[3,1,0] = 0.
+    bias = 1.+np.random.uniform(size=(nm,sv_edges.size-1))
+    sv_root = os.path.join(tmpdir,"dNdp_mzq_sv_")
+    svParams = ["H0","omch2","tau","As","b_ym"]
+    for param in svParams:
+        if param=='tau': continue
+        np.save(sv_root+param+".npy",np.random.normal(size=Nsmall.shape)*10.)
+    new_z_edges, N_sv = rebinN(Nsmall,pzcutoff,sv_edges)
+    N_sv = N_sv*fsky
+    W = fisher.sample_variance_weights(Nsmall,bias,pzcutoff,sv_edges,fsky)
+    K = sv_edges.size-1
+    corr = 0.3**np.abs(np.subtract.outer(np.arange(K),np.arange(K)))
+    S = 1.e-4*np.outer(np.linspace(1.,0.3,K),np.linspace(1.,0.3,K))*corr
+    t0 = time.time()
+    Fsv = fisher.getFisher(N_sv,svParams,[],[],sv_root,pzcutoff,sv_edges,fsky,sv_weights=W,sv_cov=S)
+    t_sv = time.time()-t0
+    Fpois = fisher.getFisher(N_sv,svParams,[],[],sv_root,pzcutoff,sv_edges,fsky)
+    D = fisher.stack_derivs(svParams,sv_root,pzcutoff,sv_edges,fsky).reshape((len(svParams),-1))
+    n = N_sv.ravel()
+    sel = n>0
+    t0 = time.time()
+    C = np.diag(n[sel])+np.dot(W[sel],np.dot(S,W[sel].T))
+    Fdense = np.dot(D[:,sel],np.linalg.solve(C,D[:,sel].T))
+    t_dense = time.time()-t0
+    assert np.allclose(Fsv,Fdense,rtol=1e-8,atol=1e-10*np.abs(Fdense).max())
+    assert not np.allclose(Fsv,Fpois,rtol=1e-3)
+    # one shell, S = 1: the rank one Sherman-Morrison update
+    Wz = W[:,:1]
+    F1 = fisher.fisher_from_stack(D,N_sv,sv_weights=Wz)
+    with np.errstate(divide='ignore'):
+        invN = np.nan_to_num(1./n)
+    u = Wz[:,0]*invN
+    F1ref = np.dot(D*invN,D.T)-np.outer(np.dot(D,u),np.dot(D,u))/(1.+np.dot(Wz[:,0],u))
+    assert np.allclose(F1,F1ref,rtol=1e-10)
+    print("Sample variance Fisher : ",t_sv*1e3," ms, dense covariance ",t_dense*1e3," ms")
+finally:
+    shutil.rmtree(tmpdir)
+
+print("Tests of stacked Fisher passed!")
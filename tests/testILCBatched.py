@@ -0,0 +1,47 @@
+from __future__ import print_function
+from __future__ import division
+from builtins import range
+import numpy as np
+import time
+from szar import ilc
+
+# Compares the batched ILC weights and noise, solved for all multipoles at
+# once, with the per-ell weightcalculator / constweightcalculator calls that
+# ILC_simple used to make, on a stack of random covariances.
+
+nl, nf = 4000, 6
+np.random.seed(1)
+A = np.random.normal(size=(nl,nf,nf))
+N = np.einsum('lij,lkj->lik',A,A) + 0.1*np.eye(nf)
+f1 = np.random.normal(size=nf)
+f2 = np.ones(nf)
+
+t0 = time.time()
+W_ref = np.zeros((nl,nf))
+Wc_ref = np.zeros((nl,nf))
+N_ref = np.zeros(nl)
+Nc_ref = np.zeros(nl)
+for ii in range(nl):
+    W_ref[ii,:] = ilc.weightcalculator(f1,N[ii])
+    Wc_ref[ii,:] = ilc.constweightcalculator(f2,f1,np.linalg.inv(N[ii]))
+    N_ref[ii] = np.dot(np.transpose(W_ref[ii,:]),np.dot(N[ii],W_ref[ii,:]))
+    Nc_ref[ii] = np.dot(np.transpose(Wc_ref[ii,:]),np.dot(N[ii],Wc_ref[ii,:]))
+t_ref = time.time()-t0
+
+t0 = time.time()
+W = ilc.weightcalculator_batched(f1,N)
+Wc = ilc.constweightcalculator_batched(f2,f1,N)
+N_ilc = ilc.ilc_noise_batched(W,N)
+Nc_ilc = ilc.ilc_noise_batched(Wc,N)
+t_new = time.time()-t0
+
+assert np.allclose(W,W_ref,rtol=1e-8,atol=0.)
+assert np.allclose(Wc,Wc_ref,rtol=1e-8,atol=0.)
+assert np.allclose(N_ilc,N_ref,rtol=1e-8,atol=0.)
+assert np.allclose(Nc_ilc,Nc_ref,rtol=1e-8,atol=0.)
+# unit response to the ILC frequency function
+assert np.allclose(np.dot(W,f1),1.)
+
+print("Per-ell ILC : ",t_ref*1e3," ms")
+print("Batched ILC : ",t_new*1e3," ms, speedup ",t_ref/t_new)
+print("Tests of batched ILC passed!")
@@ -0,0 +1,90 @@
+from __future__ import print_function
+from __future__ import division
+from builtins import range
+from builtins import object
+import numpy as np
+import time
+from scipy.special import j0
+from scipy.integrate import quad
+from szar.lensgrid import nfw_sigma_shape, NFWKappaTable, LensMassKernel
+
+# Checks the tabulated NFW convergence kernel against direct integrals and
+# against a brute force 2D stamp matched filter, the way makeGrid.py's
+# per cell lensing grid is made. Only distances and R500 are needed, so a
+# toy flat cosmology stands in for ClusterCosmology.
+
+class ToyResults(object):
+    def comoving_radial_distance(self,z):
+        return 9460.*(1.-1./np.sqrt(1.+np.asarray(z,dtype=np.float64)))
+    def angular_diameter_distance(self,z):
+        return self.comoving_radial_distance(z)/(1.+np.asarray(z))
+
+class ToyCosmology(object):
+    h = 0.7
+    c = {'G_CGS':6.67259e-08,'MSUN_CGS':1.98900e+33,'MPC2CM':3.085678e+24,'C':2.99792e+10}
+    results = ToyResults()
+    def DA_z(self,z):
+        return self.results.angular_diameter_distance(z)
+    def chi_z(self,z):
+        return self.results.comoving_radial_distance(z)
+    def rdel_c(self,M,z,delta):
+        rhocz = 2.775e11*(0.3*(1.+z)**3.+0.7)
+        return (3.*M/(4.*np.pi*delta*rhocz))**(1./3.)
+
+# projected mass within x: int_0^x f(x) x dx = ln(x/2) + arccos(1/x)/sqrt(x^2-1)
+for x in [0.5,2.,20.]:
+    num = quad(lambda y: nfw_sigma_shape(y)*y,0.,x,points=[1.],limit=200)[0]
+    ana = np.log(x/2.) + (np.arccosh(1./x)/np.sqrt(1.-x**2.) if x<1. else np.arccos(1./x)/np.sqrt(x**2.-1.))
+    assert np.isclose(num,ana,rtol=1e-6)
+
+table = NFWKappaTable(2.,10.,0.01,30.)
+for c,s in [(2.,0.01),(4.3,1.),(7.7,13.)]:
+    direct = quad(lambda x: nfw_sigma_shape(c*x)*j0(s*x)*x,0.,5.,limit=2000,points=[1./c])[0]
+    assert np.isclose(table(c,s),direct,rtol=1e-3)
+
+cc = ToyCosmology()
+mexp = np.array([14.0,14.6,15.2])
+zs = np.array([0.1,0.5,1.5])
+conc = np.array([[4.,3.5,3.],[3.6,3.2,2.8],[3.2,2.9,2.6]])
+ls = np.arange(10.,8000.,10.)
+Nls = 2e-8*(1.+(ls/3000.)**4.)
+lmin = 600.
+ray = 1.0
+
+t0 = time.time()
+lk = LensMassKernel(cc,mexp,zs,ls[ls>=lmin],concentration=conc)
+sn = lk.sn(Nls,ls)
+snray = lk.sn(Nls,ls,rayleighSigmaArcmin=ray)
+print("Kernel S/N grid took ",time.time()-t0," s")
+
+# stamps large enough that the lattice of ell modes does not matter
+arc, px = 400., 0.1
+N = int(arc/px)
+L = arc*np.pi/180./60.
+d = L/N
+x = (np.arange(N)-N/2.+0.5)*d
+r = np.sqrt(x[:,None]**2.+x[None,:]**2.)
+lx = np.fft.fftfreq(N,d)*2.*np.pi
+modl = np.sqrt(lx[:,None]**2.+lx[None,:]**2.)
+Nmap = np.interp(modl,ls,Nls,left=np.inf,right=np.inf)
+Nmap[modl<lmin] = np.inf
+sig = ray*np.pi/180./60.
+t0 = time.time()
+for i in range(mexp.size):
+    for j in range(zs.size):
+        th500 = lk.th500[i,j]
+        kappa = lk.kappa_s[i,j]*nfw_sigma_shape(conc[i,j]*r/th500)
+        kappa[r>5.*th500] = 0.
+        kk2 = np.abs(np.fft.fft2(kappa)*d*d)**2.
+        sn_stamp = np.sqrt(np.sum(kk2/Nmap))/L
+        snray_stamp = np.sqrt(np.sum(kk2*np.exp(-modl**2.*sig**2.)/Nmap))/L
+        print(mexp[i],zs[j]," S/N ",sn[i,j]," stamp ",sn_stamp)
+        assert np.isclose(sn[i,j],sn_stamp,rtol=5e-3)
+        assert np.isclose(snray[i,j],snray_stamp,rtol=5e-3)
+print("Stamps took ",time.time()-t0," s")
+
+MerrGrids = lk.merr_grids(Nls,ls,rayFid=ray,rayStep=0.2,miscentered=zs>1.)
+assert np.allclose(MerrGrids[0][:,-1],1./snray[:,-1])
+assert np.all(MerrGrids[1][:,-1]>MerrGrids[0][:,-1]) and np.all(MerrGrids[2][:,-1]<MerrGrids[0][:,-1])
+assert np.allclose(MerrGrids[:,:,:-1],1./sn[:,:-1])
+print("Tests of lensing mass kernel passed!")
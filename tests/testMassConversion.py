@@ -0,0 +1,73 @@
+from __future__ import print_function
+from __future__ import division
+from szar.counts import ClusterCosmology
+import numpy as np
+import time
+from configparser import SafeConfigParser 
+from orphics.io import dict_from_section
+import szar._fast as fast
+
+# Compares the (M,z) grid conversion M500c -> M200m with the original
+# per-element scalar iteration (copied below), and the interpolation table
+# with both.
+
+def Mass_con_del_2_del_mean200_scalar(Mdel,delta,z,rhocz,rhoc0om,ERRTOL):
+    # the per-element loop _fast.Mass_con_del_2_del_mean200 used to run
+    Mass = 2.*Mdel
+    rdels = fast.rdel_c(Mdel,z,delta,rhocz)
+    ans = Mass*0.0
+    for i in range(len(Mdel)):
+        while abs(ans[i]/Mass[i] - 1) > ERRTOL :
+            ans[i] = Mass[i]
+            conz = fast.con_M_rel_duffy200(Mass[i],z) #DUFFY
+            rs = fast.rdel_m(Mass[i],z,200,rhoc0om)/conz
+            xx = rdels[i]/rs
+            Mass[i] = Mdel[i] * fast.m_x(conz) / fast.m_x(xx)
+    return ans
+
+iniFile = "input/pipeline.ini"
+Config = SafeConfigParser()
+Config.optionxform=str
+Config.read(iniFile)
+
+constDict = dict_from_section(Config,'constants')
+fparams = {}
+for (key, val) in Config.items('params'):
+    if ',' in val:
+        param, step = val.split(',')
+        fparams[key] = float(param)
+    else:
+        fparams[key] = float(val)
+
+clttfile = Config.get('general','clttfile')
+cc = ClusterCosmology(fparams,constDict,clTTFixFile=clttfile)
+
+mgrid = np.arange(14.0,15.702,0.01)
+zgrid = np.arange(0.1,2.001,0.05)
+M = 10**mgrid
+zarr = (zgrid[1:]+zgrid[:-1])/2.
+
+t0 = time.time()
+M200_loop = np.zeros((M.size,zarr.size))
+for i in range(zarr.size):
+    M200_loop[:,i] = Mass_con_del_2_del_mean200_scalar(M.copy(),500,zarr[i],cc.rhoc(zarr[i]),cc.rhoc0om,cc.c['ERRTOL'])
+t_loop = time.time()-t0
+
+t0 = time.time()
+M200_grid = cc.Mass_con_del_2_del_mean200(M[:,None],500,zarr[None,:])
+t_grid = time.time()-t0
+
+t0 = time.time()
+table = cc.mass_conversion_table(500,mgrid[0],mgrid[-1],zgrid[0],zgrid[-1])
+t_build = time.time()-t0
+t0 = time.time()
+M200_tab = cc.Mass_con_del_2_del_mean200(M[:,None],500,zarr[None,:],table=table)
+t_tab = time.time()-t0
+
+assert np.allclose(M200_grid,M200_loop,rtol=1e-10,atol=0.)
+assert np.allclose(M200_tab,M200_loop,rtol=1e-7,atol=0.)
+print("Grid (nM, nz) = ",M.size,zarr.size)
+print("scalar loop: ",t_loop*1e3," ms")
+print("grid       : ",t_grid*1e3," ms, speedup ",t_loop/t_grid)
+print("table      : ",t_tab*1e3," ms (build ",t_build*1e3," ms), max rel. err ",np.abs(M200_tab/M200_loop-1.).max())
+print("Tests of Mass_con_del_2_del_mean200 passed!")
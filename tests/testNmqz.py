@@ -0,0 +1,84 @@
+from __future__ import print_function
+from __future__ import division
+from past.utils import old_div
+import numpy as np
+import sys, time
+from szar.counts import ClusterCosmology,Halo_MF
+from szar.szproperties import SZ_Cluster_Model
+from configparser import SafeConfigParser 
+from orphics.io import dict_from_section, list_from_config
+
+# Regression test and timing of the Mwl kernel contraction in N_of_mqz_SZ
+# and N_of_mqz_SZ_corr against the triple loop they replaced.
+# Usage: python tests/testNmqz.py [expName] [gridName]
+
+expName = sys.argv[1] if len(sys.argv)>1 else "S4-1.0-paper"
+gridName = sys.argv[2] if len(sys.argv)>2 else "grid-owl2"
+
+iniFile = "input/pipeline.ini"
+Config = SafeConfigParser()
+Config.optionxform=str
+Config.read(iniFile)
+
+fparams = {}   
+for (key, val) in Config.items('params'):
+    if ',' in val:
+        param, step = val.split(',')
+        fparams[key] = float(param)
+    else:
+        fparams[key] = float(val)
+constDict = dict_from_section(Config,'constants')
+clusterDict = dict_from_section(Config,'cluster_params')
+clttfile = Config.get('general','clttfile')
+
+beam = list_from_config(Config,expName,'beams')
+noise = list_from_config(Config,expName,'noises')
+freq = list_from_config(Config,expName,'freqs')
+lknee = list_from_config(Config,expName,'lknee')[0]
+alpha = list_from_config(Config,expName,'alpha')[0]
+
+ms = list_from_config(Config,gridName,'mexprange')
+mexp_edges = np.arange(ms[0],ms[1]+ms[2],ms[2])
+zs = list_from_config(Config,gridName,'zrange')
+z_edges = np.arange(zs[0],zs[1]+zs[2],zs[2])
+
+qs = list_from_config(Config,'general','qbins')
+qbin_edges = np.logspace(np.log10(qs[0]),np.log10(qs[1]),int(qs[2])+1)
+
+cc = ClusterCosmology(fparams,constDict,clTTFixFile=clttfile)
+HMF = Halo_MF(cc,mexp_edges,z_edges)
+SZProf = SZ_Cluster_Model(cc,clusterDict,rms_noises = noise,fwhms=beam,freqs=freq,lknee=lknee,alpha=alpha)
+lndM = 0.1 + 0.1*HMF.zarr[None,:]*np.ones((HMF.M.size,1))
+
+def loop_counts(P_func,corr):
+    q_arr = old_div((qbin_edges[1:]+qbin_edges[:-1]),2.)
+    z_arr = HMF.zarr
+    M_arr =  np.outer(HMF.M,np.ones([len(z_arr)]))
+    dNdzmq = np.zeros([len(HMF.M),len(z_arr),len(q_arr)])
+    m_wl = HMF.Mexp
+    dn_dVdm = HMF.dn_dM(HMF.M200,200.) 
+    dV_dz = HMF.dVdz
+    for kk in range(q_arr.size):
+        for jj in range(m_wl.size):
+            for i in range (z_arr.size):
+                dM = np.diff(HMF.M200_edges[:,i])
+                Pq = P_func[:,i,kk,jj] if corr else P_func[:,i,kk]
+                dNdzmq[jj,i,kk] = np.dot(dn_dVdm[:,i]*Pq*SZProf.Mwl_prob(10**(m_wl[jj]),M_arr[:,i],lndM[:,i]),dM) * dV_dz[i]*4.*np.pi
+    return dNdzmq
+
+print("Grid (nM, nz, nq) = ",HMF.M.size,HMF.zarr.size,qbin_edges.size-1)
+HMF.N_of_mqz_SZ(lndM,qbin_edges,SZProf) # fills sigN and Pfunc_qarr
+HMF.N_of_mqz_SZ_corr(lndM,qbin_edges,SZProf) # fills Pfunc_qarr_corr
+
+for name,corr,P_func,func in [("N_of_mqz_SZ",False,HMF.Pfunc_qarr,HMF.N_of_mqz_SZ),
+                              ("N_of_mqz_SZ_corr",True,HMF.Pfunc_qarr_corr,HMF.N_of_mqz_SZ_corr)]:
+    t0 = time.time()
+    ref = loop_counts(P_func,corr)
+    t_loop = time.time()-t0
+    t0 = time.time()
+    new = func(lndM,qbin_edges,SZProf)
+    t_new = time.time()-t0
+    assert np.allclose(new,ref,rtol=1e-10,atol=1e-14*np.abs(ref).max())
+    print(name," loop : ",t_loop," s, kernel : ",t_new," s, speedup ",old_div(t_loop,t_new))
+
+print("Tests of N_of_mqz_SZ passed!")
@@ -0,0 +1,69 @@
+from __future__ import print_function
+from __future__ import division
+import numpy as np
+import time
+from szar.szproperties import SZ_Cluster_Model
+
+# The batched selection function kernel (Pfunc, Pfunc_qarr, Pfunc_qarr_corr)
+# against the per-redshift, per-q and per-Mwl loops over P_of_q, P_of_qn and
+# P_of_qn_corr it replaced, on a toy background.
+
+class ToyCosmology(object):
+    H0 = 70.
+    paramDict = {'Y_star':2.42e-10,'alpha_ym':1.79,'b_ym':0.8,'beta_ym':0.,'gamma_ym':0.,
+                 'Ysig':0.127,'gammaYsig':0.,'betaYsig':0.,
+                 'Msig':0.2,'gammaMsig':0.,'betaMsig':0.,
+                 'rho_corr':0.3,'gammarho':0.,'betarho':0.,'b_wl':1.}
+    def DA_z(self,z):
+        return 4285.7*np.asarray(z)/(1.+np.asarray(z))**1.5
+    def E_z(self,z):
+        return np.sqrt(0.3*(1.+np.asarray(z))**3.+0.7)
+
+def Pfunc_loop(SZ,sigN,M,z_arr):
+    P_func = np.zeros((M.size,z_arr.size))
+    for i in range(z_arr.size):
+        P_func[:,i] = SZ.P_of_q(SZ.lnY,M,z_arr[i],sigN[:,i])
+    return P_func
+
+def Pfunc_qarr_loop(SZ,sigN,M,z_arr,q_arr):
+    P_func = np.zeros((M.size,z_arr.size,q_arr.size))
+    for i in range(z_arr.size):
+        P_func[:,i,:] = SZ.P_of_qn(SZ.lnY,M,z_arr[i],sigN[:,i],q_arr)
+    return P_func
+
+def Pfunc_qarr_corr_loop(SZ,sigN,M,z_arr,q_arr,Mexp):
+    M_wl = 10**Mexp
+    P_func = np.zeros((M.size,z_arr.size,q_arr.size,M_wl.size))
+    for i in range(z_arr.size):
+        for jj in range(M_wl.size):
+            P_func[:,i,:,jj] = SZ.P_of_qn_corr(SZ.lnY,M,z_arr[i],sigN[:,i],q_arr,M_wl[jj])
+    return P_func
+
+SZ = object.__new__(SZ_Cluster_Model)
+SZ.cc = ToyCosmology()
+SZ.scaling = SZ.cc.paramDict
+SZ.qmin = 5.
+SZ.lnY = np.arange(np.log(1.e-14),np.log(4.42e-9),0.1)
+
+Mexp = np.arange(14.,15.,0.05)
+M = 10.**Mexp
+z_arr = np.arange(0.1,1.5,0.1)
+q_arr = np.logspace(np.log10(6.),np.log10(500.),12)
+np.random.seed(5)
+sigN = 2.e-12*np.random.uniform(0.5,2.,(M.size,z_arr.size))
+
+for max_bytes in [2**28,2**16]:
+    t0 = time.time()
+    P = SZ.Pfunc(sigN,M,z_arr,max_bytes=max_bytes)
+    Pq = SZ.Pfunc_qarr(sigN,M,z_arr,q_arr,max_bytes=max_bytes)
+    Pqc = SZ.Pfunc_qarr_corr(sigN,M,z_arr,q_arr,Mexp,max_bytes=max_bytes)
+    print(("Batched kernels with max_bytes ", max_bytes, " took ", time.time()-t0, " s"))
+    for new,ref in [(P,Pfunc_loop(SZ,sigN,M,z_arr)),
+                    (Pq,Pfunc_qarr_loop(SZ,sigN,M,z_arr,q_arr)),
+                    (Pqc,Pfunc_qarr_corr_loop(SZ,sigN,M,z_arr,q_arr,Mexp))]:
+        assert new.shape==ref.shape
+        assert np.any(ref>0.)
+        print(("Max diff relative to max ", np.abs(new-ref).max()/np.abs(ref).max()))
+        assert np.allclose(new,ref,rtol=1e-12,atol=1e-14*np.abs(ref).max())
+
+print("Tests of the selection function kernel passed!")
@@ -0,0 +1,88 @@
+from __future__ import print_function
+from __future__ import division
+import numpy as np
+import shutil
+import tempfile
+from szar import pkcache
+from szar.counts import Halo_MF
+
+# cache keys: scaling relation and nuisance parameters do not change the key,
+# CAMB parameters, redshifts and k settings do
+params = {'H0':67.,'ombh2':0.0222,'omch2':0.1197,'As':2.2e-9,'ns':0.9655,'tau':0.06,'mnu':0.06,'w0':-1.}
+zarr = np.arange(0.05,2.,0.1)
+key = pkcache.cosmology_key(params,zarr,1e-4,5.,200)
+nuisance = dict(params)
+for i,name in enumerate(pkcache.non_camb_params): nuisance[name] = 0.1*(i+1)
+assert pkcache.cosmology_key(nuisance,zarr,1e-4,5.,200)==key
+assert pkcache.cosmology_key(dict(params,H0=67.1),zarr,1e-4,5.,200)!=key
+assert pkcache.cosmology_key(params,zarr[:-1],1e-4,5.,200)!=key
+assert pkcache.cosmology_key(params,zarr,1e-4,5.,201)!=key
+
+def entry(seed):
+    rng = np.random.default_rng(seed)
+    return {'kh':np.logspace(-4,np.log10(5.),200),'pk':rng.uniform(size=(zarr.size,200)),
+            's8':0.8+0.01*seed,'DAz':rng.uniform(size=zarr.size),'Hz':rng.uniform(size=zarr.size)}
+
+# LRU eviction: a get refreshes an entry, the least recently used one goes
+cache = pkcache.PowerSpectrumCache(maxsize=2)
+cache.put('a',entry(0),elapsed=1.)
+cache.put('b',entry(1),elapsed=2.)
+assert cache.get('a') is not None
+cache.put('c',entry(2),elapsed=3.)
+assert len(cache)==2
+assert cache.get('b') is None
+assert cache.get('a') is not None and cache.get('c') is not None
+stats = cache.stats()
+assert stats['hits']==3 and stats['misses']==1 and stats['disk_hits']==0
+assert np.isclose(stats['camb_time'],6.) and np.isclose(stats['time_saved'],5.)
+print("Tests of LRU eviction passed!")
+
+# npz round trip through a second cache on the same directory
+cache_dir = tempfile.mkdtemp()
+try:
+    e = entry(3)
+    pkcache.PowerSpectrumCache(cache_dir=cache_dir).put(key,e,elapsed=4.)
+    fresh = pkcache.PowerSpectrumCache(cache_dir=cache_dir)
+    got = fresh.get(key)
+    assert fresh.disk_hits==1 and len(fresh)==1
+    for name in ['kh','pk','DAz','Hz']:
+        assert np.array_equal(got[name],e[name])
+    assert isinstance(got['s8'],float) and got['s8']==e['s8']
+    assert got['camb_time']==4.
+    assert fresh.get(key) is got and fresh.disk_hits==1
+    fresh.clear(disk=True)
+    assert len(fresh)==0 and fresh.get(key) is None
+finally:
+    shutil.rmtree(cache_dir)
+print("Tests of the on-disk tier passed!")
+
+# Halo_MF._cached_pk computes once per CAMB cosmology, with a toy _pk in
+# place of CAMB
+class ToyCosmology(object):
+    def __init__(self,paramDict):
+        self.paramDict = paramDict
+    def DA_z(self,z):
+        return 4285.7*np.asarray(z)/(1.+np.asarray(z))**1.5
+    def H_z(self,z):
+        return 70.*np.sqrt(0.3*(1.+np.asarray(z))**3.+0.7)
+
+class ToyHMF(Halo_MF):
+    ncalls = 0
+    def _pk(self,zarr,kmin,kmax,knum):
+        ToyHMF.ncalls += 1
+        self.cc.s8 = 0.8
+        return np.logspace(np.log10(kmin),np.log10(kmax),knum), np.outer(1./(1.+zarr),np.ones(knum))
+
+cache = pkcache.PowerSpectrumCache()
+hmfs = []
+for pars in [params,nuisance,dict(params,H0=70.)]:
+    hmf = object.__new__(ToyHMF)
+    hmf.cc = ToyCosmology(pars)
+    hmf.zarr = zarr
+    hmf._cached_pk(cache,1e-4,5.,200)
+    hmfs.append(hmf)
+assert ToyHMF.ncalls==2 and cache.hits==1 and cache.misses==2
+assert np.array_equal(hmfs[0].pk,hmfs[1].pk) and hmfs[1].cc.s8==0.8
+hmfs[1].pk[:] = 0.
+assert np.all(cache.get(key)['pk']>0.)
+print("Tests of the power spectrum cache passed!")
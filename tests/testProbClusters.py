@@ -0,0 +1,57 @@
+from __future__ import print_function
+from __future__ import division
+import numpy as np
+import time
+import szar.likelihood as lk
+
+# The batched clusterLike.Prob_clusters against the per-cluster
+# Prob_per_cluster on a synthetic catalog, with a toy Y-M relation in
+# place of the nemo one (NaN below a mass cut to check that those masses
+# get zero probability in both).
+
+class ToySimsTools(object):
+    def y0FromLogM500(self,logM,z,tckQFit,sigma_int=0.2,B0=0.08,H0=70.,OmegaM0=0.3,OmegaL0=0.7):
+        logM = np.asarray(logM,dtype=np.float64)
+        Ytilde = 10.**(-4.3+(1.+B0)*(logM-14.5))*(1.+z)**0.6
+        Ytilde[logM<13.85] = np.nan
+        return Ytilde, None, None
+
+class ToyCosmology(object):
+    def Mass_con_del_2_del_mean200(self,M,delta,z,table=None):
+        return M*(1.3+0.1*z)
+
+class ToyHMF(object):
+    def __init__(self):
+        self.M = 10.**np.arange(13.7,15.72,0.02)
+        self.cc = ToyCosmology()
+
+def dn_dzdm_int(z,logM):
+    return np.outer(10.**(-2.*(logM-14.)),np.exp(-np.atleast_1d(z)))
+
+lk.simsTools = ToySimsTools()
+like = object.__new__(lk.clusterLike)
+like.LgY = np.arange(-6,-3,0.01)
+like.tckQFit = None
+like.HMF = ToyHMF()
+param_vals = {'omch2':0.1225,'ombh2':0.0245,'H0':70.,'massbias':1.,'scat':0.2,'yslope':0.08}
+
+np.random.seed(3)
+ncl = 60
+c_z = np.random.uniform(0.2,1.4,ncl)
+c_zerr = np.where(np.random.uniform(size=ncl)<0.3,0.,np.random.choice([0.02,0.05],ncl))
+c_y = 10.**np.random.uniform(-4.6,-3.8,ncl)
+c_yerr = 0.2*c_y
+cluster_props = (c_z,c_zerr,c_y,c_yerr)
+
+t0 = time.time()
+ref = np.array([like.Prob_per_cluster(like.HMF,(c_z[i],c_zerr[i],c_y[i],c_yerr[i]),dn_dzdm_int,param_vals) for i in range(ncl)])
+print(("Per cluster loop took ", time.time()-t0, " s"))
+t0 = time.time()
+N_per = like.Prob_clusters(like.HMF,cluster_props,dn_dzdm_int,param_vals,max_bytes=2**20)
+print(("Batched took ", time.time()-t0, " s"))
+
+assert np.all(np.isfinite(N_per)) and np.all(N_per>0.)
+print(("Max rel. diff ", np.abs(N_per/ref-1.).max()))
+assert np.allclose(N_per,ref,rtol=1e-12,atol=0.)
+assert np.isclose(np.sum(np.log(N_per)),np.sum(np.log(ref)),rtol=1e-14,atol=1e-10)
+print("Tests of batched cluster probabilities passed!")
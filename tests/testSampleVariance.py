@@ -0,0 +1,54 @@
+from __future__ import print_function
+from __future__ import division
+import numpy as np
+import time
+from scipy.integrate import quad
+from scipy.special import eval_legendre
+from szar.samplevariance import cap_mask_weights,shell_covariance,shell_variance
+
+# cap weights: Parseval (sum_ell K_ell = 1/Omega) and direct quadrature
+fsky = 0.4
+K = cap_mask_weights(fsky,4000)
+print(("Parseval ", K.sum()*4.*np.pi*fsky-1.))
+assert np.isclose(K.sum()*4.*np.pi*fsky,1.,rtol=1e-3)
+x = 1.-2.*fsky
+for ell in [0,1,5,40]:
+    m = 2.*np.pi*np.sqrt((2.*ell+1.)/4./np.pi)*quad(lambda c: eval_legendre(ell,c),x,1.)[0]
+    assert np.isclose(K[ell],m**2./(4.*np.pi*fsky)**2.,rtol=1e-8)
+
+# toy matter dominated distances and a broken power law spectrum
+class ToyCosmology(object):
+    h = 0.7
+    def chi_z(self,z):
+        return 2.*2997.9/self.h*(1.-1./np.sqrt(1.+np.asarray(z,dtype=np.float64)))
+
+cc = ToyCosmology()
+kh = np.logspace(-4.5,1.,400)
+z_edges = np.arange(0.,3.05,0.1)
+zs = (z_edges[1:]+z_edges[:-1])/2.
+keq = 0.015
+pk = (2.e4*(kh/keq)/(1.+(kh/keq)**2.6))[None,:]/(1.+zs[:,None])**2.
+
+t0 = time.time()
+v = shell_variance(cc,kh,pk,z_edges,cap_mask_weights(fsky,1000))
+print(("Limber variance took ", time.time()-t0, " s"))
+t0 = time.time()
+S = shell_covariance(cc,kh,pk,z_edges,cap_mask_weights(fsky,1000),lmax_exact=30)
+print(("Covariance with exact ell<30 took ", time.time()-t0, " s"))
+assert np.all(v>0.)
+assert np.allclose(S,S.T)
+assert np.linalg.eigvalsh(S).min()>-1.e-10*np.abs(S).max()
+
+# a thick shell at ell=60 is in the Limber regime
+Kl = np.zeros(61)
+Kl[60] = 1.
+ze = np.array([0.3,1.8])
+exact = shell_covariance(cc,kh,pk[:1],ze,Kl,lmin=60,lmax_exact=61)
+limber = shell_covariance(cc,kh,pk[:1],ze,Kl)
+print(("Thick shell exact/Limber-1 ", exact[0,0]/limber[0,0]-1.))
+assert np.isclose(exact[0,0],limber[0,0],rtol=0.05)
+
+# the exact projection is converged in k and in the Bessel table spacing
+fine = shell_covariance(cc,kh,pk,z_edges,cap_mask_weights(fsky,1000),lmax_exact=30,kmax_exact=0.4,dx=0.02)
+print(("Convergence ", np.abs(S-fine).max()/np.abs(fine).max()))
+assert np.abs(S-fine).max()<1.e-3*np.abs(fine).max()
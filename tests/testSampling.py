@@ -0,0 +1,67 @@
+from __future__ import print_function
+from __future__ import division
+import numpy as np
+import time
+from szar.sampling import GridSampler, interp_rows
+
+rng = np.random.default_rng(1)
+Mexp_edges = np.linspace(13.5,15.5,51)
+z_edges = np.linspace(0.,3.,31)
+N = rng.uniform(0.,50.,(Mexp_edges.size-1,z_edges.size-1))
+sampler = GridSampler(N,Mexp_edges,z_edges)
+
+# many Poisson realizations, binned back onto the grid
+nreal = 200
+t0 = time.time()
+cats = sampler.realizations(nreal,rng=2)
+print((nreal, " catalogs of ~", int(N.sum()), " clusters took ", time.time()-t0, " s"))
+mean = sum(np.histogram2d(c[:,0],c[:,1],bins=(Mexp_edges,z_edges))[0] for c in cats)/nreal
+pull = (mean-N)/np.sqrt(N/nreal)
+print(("max pull ", np.abs(pull).max()))
+assert np.abs(pull).max()<5.
+assert np.isclose(np.var([c.shape[0] for c in cats]),N.sum(),rtol=0.3)
+
+# fixed total, reproducible seeding
+cat = sampler.sample(3,poisson=False)
+assert cat.shape==(int(N.sum()),2)
+assert np.array_equal(sampler.sample(5),sampler.sample(5))
+
+# row wise inverse interpolation against np.interp
+xp = np.cumsum(rng.uniform(0.,1.,(100,20)),axis=1)
+fp = np.linspace(0.,1.,20)
+x = rng.uniform(xp[:,0],xp[:,-1])
+assert np.allclose(interp_rows(x,xp,fp),[np.interp(x[i],xp[i],fp) for i in range(x.size)],rtol=0.,atol=1e-14)
+print("Tests of grid sampler passed!")
+
+# exact draws from a power law in x times a linear ramp in y, in a box
+# cutting through cells
+slope = -12.
+x_edges = np.linspace(14.,15.5,16)
+y_edges = np.linspace(0.,2.,11)
+ycent = (y_edges[1:]+y_edges[:-1])/2.
+xint = (np.exp(slope*x_edges[1:])-np.exp(slope*x_edges[:-1]))/slope
+N = np.outer(xint,ycent*np.diff(y_edges))
+sampler = GridSampler(N,x_edges,y_edges,x_slopes=slope)
+n = 400000
+t0 = time.time()
+xy = sampler.draw(n,rng=4,x_range=[14.23,15.1],y_range=[0.35,1.8])
+print((n, " exact draws took ", time.time()-t0, " s"))
+assert xy[:,0].min()>=14.23 and xy[:,0].max()<=15.1
+assert xy[:,1].min()>=0.35 and xy[:,1].max()<=1.8
+# fine histogram in x against the truncated exponential
+xb = np.linspace(14.23,14.8,20)
+h = np.histogram(xy[:,0],bins=xb)[0]/float(n)
+expect = np.diff(np.exp(slope*xb))/(np.exp(slope*15.1)-np.exp(slope*14.23))
+pull = (h-expect)/np.sqrt(expect/n)
+print(("max pull in x ", np.abs(pull).max()))
+assert np.abs(pull).max()<5.
+# y is uniform within a cell, so the weights follow the cell centres
+yb = y_edges[1:-1].copy()
+yb[0],yb[-1] = 0.35,1.8
+h = np.histogram(xy[:,1],bins=yb)[0]/float(n)
+w = ycent[1:-1]*np.diff(yb)
+expect = w/w.sum()
+pull = (h-expect)/np.sqrt(expect/n)
+print(("max pull in y ", np.abs(pull).max()))
+assert np.abs(pull).max()<5.
+print("Tests of exact draws passed!")
@@ -0,0 +1,61 @@
+from __future__ import print_function
+from __future__ import division
+import numpy as np
+import time
+from szar import tinker
+
+# Compares the batched sigma^2 engine with the stacked sigma_sq_integral on
+# the 0.01 dex x 0.05 z grids used by clustLikeTest. A toy power spectrum is
+# used so that this runs without CAMB.
+
+logm_min = 14.0
+logm_max = 15.702
+logm_spacing = 0.01
+mgrid = np.arange(logm_min,logm_max,logm_spacing)
+zgrid = np.arange(0.1,2.001,0.05)
+
+M_edges = 10**mgrid
+M = (M_edges[1:]+M_edges[:-1])/2.
+zarr = (zgrid[1:]+zgrid[:-1])/2.
+
+kh = np.logspace(-4,np.log10(5.),200)
+k0 = 0.02
+growth = 1./(1.+zarr)
+pk = (growth**2.)[:,None] * 2.e4 * (kh/k0) / (1.+(kh/k0)**2.)**1.6
+
+rhoc0om = 2.775e11*0.3
+# M200 depends on z, so R is a full (nM, nz) grid
+M200 = np.outer(M,1.+0.05*zarr)
+R = tinker.radius_from_mass(M200,rhoc0om)
+
+def timed(func,*args,**kwargs):
+    niter = 5
+    t0 = time.time()
+    for i in range(niter):
+        ans = func(*args,**kwargs)
+    return ans, (time.time()-t0)/niter
+
+print("Grid (nM, nz, nk) = ",R.shape[0],R.shape[1],kh.size)
+
+sig_ref, t_ref = timed(tinker.sigma_sq_integral,R,pk,kh)
+sig_new, t_new = timed(tinker.sigma_sq_batched,R,pk,kh)
+sig_chunk, t_chunk = timed(tinker.sigma_sq_batched,R,pk,kh,chunk_size=8)
+sig_tab, t_tab = timed(tinker.sigma_sq_batched,R,pk,kh,table_step=0.002)
+
+assert np.allclose(sig_new,sig_ref,rtol=1e-10,atol=0.)
+assert np.allclose(sig_chunk,sig_ref,rtol=1e-10,atol=0.)
+assert np.allclose(sig_tab,sig_ref,rtol=1e-8,atol=0.)
+print("sigma_sq_integral          : ",t_ref*1e3," ms")
+print("sigma_sq_batched           : ",t_new*1e3," ms, speedup ",t_ref/t_new)
+print("sigma_sq_batched (chunk 8) : ",t_chunk*1e3," ms, speedup ",t_ref/t_chunk)
+print("sigma_sq_batched (table)   : ",t_tab*1e3," ms, speedup ",t_ref/t_tab, ", max rel. err ",np.abs(sig_tab/sig_ref-1.).max())
+
+# z-independent radii (linBias / haloBias) go through a single matrix product
+R1 = tinker.radius_from_mass(np.outer(M,np.ones(zarr.size)),rhoc0om)
+sig_ref, t_ref = timed(tinker.sigma_sq_integral,R1,pk,kh)
+sig_new, t_new = timed(tinker.sigma_sq_batched,R1,pk,kh)
+assert np.allclose(sig_new,sig_ref,rtol=1e-10,atol=0.)
+print("z-independent R, sigma_sq_integral : ",t_ref*1e3," ms")
+print("z-independent R, sigma_sq_batched  : ",t_new*1e3," ms, speedup ",t_ref/t_new)
+
+print("Tests of sigma_sq_batched passed!")
@@ -0,0 +1,38 @@
+from __future__ import print_function
+from __future__ import division
+import numpy as np
+import time
+from szar import taskfarm
+
+# Runs uneven tasks through the serial and process task farms and checks
+# that every task is done exactly once with its own result.
+
+_offset = None
+
+def init(offset):
+    global _offset
+    _offset = offset
+
+def work(task):
+    # task durations vary so that results come back out of order
+    time.sleep(0.01*(task%4))
+    return task**2+_offset
+
+def main():
+    tasks = list(range(40))
+    for pool in ["serial","process"]:
+        results = {}
+        def on_result(task,result):
+            assert task not in results
+            results[task] = result
+        report = taskfarm.run_tasks(work,tasks,on_result,pool=pool,nprocs=4,initializer=init,initargs=(3,),verbose=False)
+        assert sorted(results.keys())==tasks
+        assert all(results[t]==t**2+3 for t in tasks)
+        assert report['ntasks']==len(tasks)
+        print(pool," : ",report['wall_time']," s, efficiency ",report['efficiency'])
+
+    print("Tests of task farm passed!")
+
+# the process pool re-imports this module in its workers
+if __name__ == "__main__":
+    main()
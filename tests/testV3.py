@@ -74,6 +74,36 @@ SZProfExample = SZ_Cluster_Model(clusterCosmology=cc,clusterDict=clusterDict,rms
 
 
 print(("quickvar " , np.sqrt(SZProfExample.quickVar(MM,zz,tmaxN=tmaxN,numts=numts))))
+
+# vectorized grid against the per-cell quickVar on a few cells
+Ms = 10**np.arange(13.5,15.7,0.1)
+zs = np.arange(0.05,2.0,0.1)
+t0 = time.time()
+vargrid = SZProfExample.quickVarGrid(Ms,zs,tmaxN=tmaxN,numts=numts)
+print(("quickVarGrid on ", vargrid.shape, " grid took ", time.time()-t0, " s"))
+for j,i in [(0,0),(5,3),(Ms.size-1,zs.size-1),(0,zs.size-1),(Ms.size-1,0)]:
+    t0 = time.time()
+    var = SZProfExample.quickVar(Ms[j],zs[i],tmaxN=tmaxN,numts=numts)
+    print(("quickVar cell took ", time.time()-t0, " s, rel. diff ", vargrid[j,i]/var-1.))
+    assert np.isclose(vargrid[j,i],var,rtol=1e-8,atol=0.)
+
+# the experiment independent variance kernel, stored and contracted with the noise
+import tempfile, shutil
+from szar.varkernel import VarKernel
+t0 = time.time()
+K = SZProfExample.varKernelGrid(Ms,zs,tmaxN=tmaxN,numts=numts)
+print(("varKernelGrid took ", time.time()-t0, " s"))
+tmpdir = tempfile.mkdtemp()
+try:
+    vk = VarKernel(os.path.join(tmpdir,"varkernel"))
+    vk.save(K,np.log10(Ms),zs,SZProfExample.evalells,tmaxN,numts)
+    assert vk.matches(np.log10(Ms),zs,SZProfExample.evalells,tmaxN,numts)
+    t0 = time.time()
+    siggrid = vk.sigN(SZProfExample.varNoise())
+    print(("sigN from stored kernel took ", time.time()-t0, " s"))
+    assert np.allclose(siggrid**2.,vargrid,rtol=1e-10,atol=0.)
+finally:
+    shutil.rmtree(tmpdir)
 #print "filtvar " , np.sqrt(SZProfExample.filter_variance(MM,zz))
 
 